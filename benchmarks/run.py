@@ -0,0 +1,257 @@
+"""
+benchmarks/run.py
+
+Measures Sonar's own overhead: everything it does around Docker, AWS and the
+registries, which are replaced by the fake backend (sonar/builders/fake.py).
+
+    python -m benchmarks.run                  # run and compare with the baseline
+    python -m benchmarks.run --save-baseline  # run and store a new baseline
+    python -m benchmarks.run -k interpolate   # only run matching benchmarks
+
+Every run is appended to the history file, so results can be followed over
+time. A benchmark regresses when its median is slower than the baseline's by
+more than the threshold; in that case the exit code is 1.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+import yaml
+
+from sonar.builders.fake import FakeBackend
+from sonar.sonar import (
+    build_context,
+    find_inventory,
+    interpolate_vars,
+    process_image,
+)
+from sonar.template import render
+
+BENCHMARKS: Dict[str, Callable[[str], Callable[[], None]]] = {}
+
+DEFAULT_RESULTS_DIR = ".benchmarks"
+
+
+def benchmark(name: str):
+    """Registers a benchmark. The decorated function receives a scratch
+    directory, does its setup and returns the callable to measure."""
+
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return decorator
+
+
+def generate_inventory(images: int, stages: int) -> Dict:
+    """Returns an inventory with `images` images of `stages` stages each."""
+    return {
+        "vars": {"registry": "localhost:5000", "context": "."},
+        "images": [
+            {
+                "name": "image{}".format(i),
+                "vars": {"context": ".", "image_var": "value{}".format(i)},
+                "inputs": ["input0"],
+                "stages": [
+                    {
+                        "name": "stage{}".format(s),
+                        "task_type": "docker_build",
+                        "tags": ["tag{}".format(s % 10)],
+                        "dockerfile": "Dockerfile",
+                        "buildargs": {
+                            "version": "$(inputs.params.input0)",
+                            "image_var": "$(inputs.params.image_var)",
+                        },
+                        "labels": {"version_id": "$(inputs.params.version_id)"},
+                        "output": [
+                            {
+                                "registry": "$(inputs.params.registry)/image{}".format(i),
+                                "tag": "$(inputs.params.input0)-stage{}".format(s),
+                            }
+                        ],
+                    }
+                    for s in range(stages)
+                ],
+            }
+            for i in range(images)
+        ],
+    }
+
+
+def write_inventory(directory: str, images: int, stages: int) -> str:
+    path = os.path.join(directory, "inventory-{}x{}.yaml".format(images, stages))
+    with open(path, "w") as fd:
+        yaml.safe_dump(generate_inventory(images, stages), fd)
+
+    return path
+
+
+@contextlib.contextmanager
+def discarded_output():
+    """Discards Sonar's output."""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+@benchmark("inventory_load_20x50")
+def bench_inventory_load(directory: str):
+    path = write_inventory(directory, 20, 50)
+    return lambda: find_inventory(path)
+
+
+@benchmark("build_context_20x50")
+def bench_build_context(directory: str):
+    path = write_inventory(directory, 20, 50)
+    return lambda: build_context("image19", [], [], {"input0": "v"}, path)
+
+
+@benchmark("interpolate_vars_10000")
+def bench_interpolate_vars(directory: str):
+    path = write_inventory(directory, 1, 1)
+    ctx = build_context("image0", [], [], {"input0": "v"}, path)
+    ctx.stage = ctx.image["stages"][0]
+    string = "$(inputs.params.registry)/image:$(inputs.params.input0)-$(inputs.params.image_var)"
+
+    def run():
+        for _ in range(10000):
+            interpolate_vars(ctx, string, stage=ctx.stage)
+
+    return run
+
+
+@benchmark("render")
+def bench_render(directory: str):
+    with open(os.path.join(directory, "Dockerfile.bench"), "w") as fd:
+        fd.write(
+            "FROM {{ base }}\n"
+            "{% for package in packages %}RUN install {{ package }}\n{% endfor %}"
+        )
+    params = {"base": "ubuntu:22.04", "packages": ["p{}".format(i) for i in range(50)]}
+
+    return lambda: render(directory, "bench", params)
+
+
+@benchmark("process_image_2000_stages")
+def bench_process_image(directory: str):
+    path = write_inventory(directory, 1, 2000)
+
+    def run():
+        with discarded_output():
+            process_image(
+                image_name="image0",
+                skip_tags=[],
+                include_tags=[],
+                build_args={"input0": "v"},
+                inventory=path,
+                build_options={"pipeline": True, "backend": FakeBackend()},
+            )
+
+    return run
+
+
+def measure(func: Callable[[], None], repeat: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "max": max(timings),
+    }
+
+
+def run_benchmarks(names: List[str], repeat: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for name in names:
+        with tempfile.TemporaryDirectory() as directory:
+            func = BENCHMARKS[name](directory)
+            results[name] = measure(func, repeat)
+
+    return results
+
+
+def find_regressions(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float,
+) -> List[str]:
+    """Returns the benchmarks slower than their baseline by more than
+    threshold (a fraction, 0.2 is 20%)."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        if result["median"] > baseline[name]["median"] * (1 + threshold):
+            regressions.append(name)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-k", dest="filter", default="", type=str)
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--results-dir", default=DEFAULT_RESULTS_DIR, type=str)
+    parser.add_argument(
+        "--threshold",
+        default=0.2,
+        type=float,
+        help="Allowed slowdown over the baseline, as a fraction.",
+    )
+    parser.add_argument("--save-baseline", default=False, action="store_true")
+
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = run_benchmarks(names, args.repeat)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    baseline_file = os.path.join(args.results_dir, "baseline.json")
+    history_file = os.path.join(args.results_dir, "history.jsonl")
+
+    with open(history_file, "a") as fd:
+        entry = {"date": datetime.now(timezone.utc).isoformat(), "results": results}
+        fd.write(json.dumps(entry) + "\n")
+
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as fd:
+            baseline = json.load(fd)
+
+    for name, result in results.items():
+        line = "{:<30} median {:>10.4f}s  min {:>10.4f}s".format(
+            name, result["median"], result["min"]
+        )
+        if name in baseline:
+            change = result["median"] / baseline[name]["median"] - 1
+            line += "  {:+.1%} vs baseline".format(change)
+        print(line)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(baseline_file, "w") as fd:
+            json.dump(baseline, fd, indent=2)
+        return 0
+
+    regressions = find_regressions(results, baseline, args.threshold)
+    for name in regressions:
+        print("regression: {}".format(name), file=sys.stderr)
+
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
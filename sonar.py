@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
 from typing import Dict, List
 import sys
 
-from sonar.sonar import process_image
-
+# Only what parsing the arguments needs is imported here. Everything else is
+# imported by the command that uses it, so `--help` and the subcommands that
+# need less of Sonar start faster.
+from sonar import graph, shard
 
 def convert_parser_arguments_to_key_value(parameters: List[str]) -> Dict[str, str]:
     """Converts a list of parameters passed to `ArgumentParser` into a dictionary.
@@ -34,26 +37,374 @@ def convert_parser_arguments_to_key_value(parameters: List[str]) -> Dict[str, st
     return d
 
 
+def plan_command(argv: List[str]) -> int:
+    """Compiles the plans of images, and estimates how long running them
+    would take."""
+    parser = argparse.ArgumentParser(prog="sonar.py plan")
+    parser.add_argument("--image", action="append", required=True)
+    parser.add_argument("-p", dest="parameters", nargs=1, action="append")
+    parser.add_argument("--skip-tags", default="", type=str)
+    parser.add_argument("--include-tags", default="", type=str)
+    parser.add_argument("--inventory", default="inventory.yaml", type=str)
+    parser.add_argument("--parallel-images", default=graph.MAX_CONCURRENT_IMAGES, type=int)
+    parser.add_argument(
+        "--estimate",
+        default=False,
+        action="store_true",
+        help="Prints the expected duration of the run and its bottleneck stages, "
+        "from the durations recorded with --history, instead of the plans.",
+    )
+
+    args = parser.parse_args(argv)
+
+    from sonar.plan import InventoryValidationError, compile_plan, estimate_plans, format_estimate
+    from sonar.sonar import find_image_dependencies, make_list_of_str
+
+    images = [i for value in args.image for i in make_list_of_str(value)]
+    build_args = convert_parser_arguments_to_key_value(args.parameters)
+
+    plans = {}
+    errors = []
+    for image in images:
+        try:
+            plans[image] = compile_plan(
+                image_name=image,
+                skip_tags=args.skip_tags,
+                include_tags=args.include_tags,
+                build_args=build_args,
+                inventory=args.inventory,
+            )
+        except InventoryValidationError as e:
+            errors.extend(e.errors)
+
+    if len(errors) > 0:
+        for error in errors:
+            print(error, file=sys.stderr)
+        return 1
+
+    if not args.estimate:
+        for compiled in plans.values():
+            print(compiled.to_json())
+        return 0
+
+    dependencies = find_image_dependencies(
+        images, args.skip_tags, args.include_tags, build_args, args.inventory
+    )
+    print(format_estimate(estimate_plans(plans, dependencies, args.parallel_images)))
+    return 0
+
+
+def analyze_command(argv: List[str]) -> int:
+    """Reports what makes the Dockerfiles of images miss the build cache."""
+    parser = argparse.ArgumentParser(prog="sonar.py analyze")
+    parser.add_argument("--image", action="append", required=True)
+    parser.add_argument("-p", dest="parameters", nargs=1, action="append")
+    parser.add_argument("--skip-tags", default="", type=str)
+    parser.add_argument("--include-tags", default="", type=str)
+    parser.add_argument("--inventory", default="inventory.yaml", type=str)
+    parser.add_argument(
+        "--volatile",
+        action="append",
+        default=[],
+        help="A parameter whose value changes every run, like a build number. "
+        "version_id always does.",
+    )
+    parser.add_argument(
+        "--strict",
+        default=False,
+        action="store_true",
+        help="Exits with an error if anything is found.",
+    )
+
+    args = parser.parse_args(argv)
+
+    from sonar import analyze
+    from sonar.sonar import make_list_of_str
+
+    images = [i for value in args.image for i in make_list_of_str(value)]
+    build_args = convert_parser_arguments_to_key_value(args.parameters)
+
+    reports = []
+    for image in images:
+        try:
+            reports.extend(
+                analyze.analyze_image(
+                    image,
+                    args.skip_tags,
+                    args.include_tags,
+                    build_args,
+                    args.inventory,
+                    analyze.VOLATILE_PARAMS + tuple(args.volatile),
+                )
+            )
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+
+    print(analyze.format_reports(reports))
+    if args.strict and any(len(r.findings) > 0 or r.error is not None for r in reports):
+        return 1
+    return 0
+
+
 def main():
+    if sys.argv[1:2] == ["plan"]:
+        return plan_command(sys.argv[2:])
+
+    if sys.argv[1:2] == ["analyze"]:
+        return analyze_command(sys.argv[2:])
+
+    if sys.argv[1:2] == ["merge"]:
+        return shard.main(sys.argv[2:])
+
+    if sys.argv[1:2] == ["serve"]:
+        from sonar.server import main as serve
+
+        return serve(sys.argv[2:])
+
+    if sys.argv[1:2] == ["gc"]:
+        from sonar.cleanup import main as gc
+
+        return gc(sys.argv[2:])
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("--image", required=True)
+    parser.add_argument(
+        "--image",
+        action="append",
+        help="Image to build. Several images, in the same or in more --image, "
+        "are built in the order of their dependencies.",
+    )
+    parser.add_argument(
+        "--parallel-images",
+        default=graph.MAX_CONCURRENT_IMAGES,
+        type=int,
+        help="How many images, that do not depend on each other, to build at the same time.",
+    )
     parser.add_argument("-p", dest="parameters", nargs=1, action="append")
     parser.add_argument("--pipeline", default=False, action="store_true")
     parser.add_argument("--skip-tags", default="", type=str)
     parser.add_argument("--include-tags", default="", type=str)
     parser.add_argument("--inventory", default="inventory.yaml", type=str)
+    parser.add_argument(
+        "--events-fd",
+        type=int,
+        help="Writes the events of the run as JSON lines to this file descriptor.",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        help="Writes metrics of the run to this file, for a textfile collector.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        default=False,
+        action="store_true",
+        help="Validates the image and prints its compiled plan, without running it.",
+    )
+    parser.add_argument(
+        "--plan-output", type=str, help="Saves the compiled plan into this file."
+    )
+    parser.add_argument(
+        "--plan", type=str, help="Runs a plan previously saved with --plan-output."
+    )
+
+    parser.add_argument(
+        "--snapshot-contexts",
+        default=False,
+        action="store_true",
+        help="Hashes Docker contexts, reporting their digest and size, before building.",
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        default=False,
+        action="store_true",
+        help="Pulls the base and source images of every stage, concurrently, before building.",
+    )
+
+    parser.add_argument(
+        "--gc",
+        default=False,
+        action="store_true",
+        help="Removes the local images created by the run, and dangling images, when it ends.",
+    )
+
+    parser.add_argument(
+        "--image-analytics",
+        default=False,
+        action="store_true",
+        help="Reports the size and layers of every built image.",
+    )
+
+    parser.add_argument(
+        "--builder",
+        action="append",
+        help="Builds in this buildx builder, or in the Docker daemon at this DOCKER_HOST, "
+        "with an optional =capacity. Can be repeated, and replaces the builders of the inventory.",
+    )
+
+    parser.add_argument(
+        "--history",
+        default=False,
+        action="store_true",
+        help="Records the durations of the run, and builds the images expected "
+        "to take the longest first.",
+    )
+
+    parser.add_argument(
+        "--ecr-login",
+        default=False,
+        action="store_true",
+        help="Gets the tokens of the ECR registries the run uses once, and points Docker "
+        "to a config with them while the run lasts, instead of relying on `docker login`.",
+    )
+
+    parser.add_argument(
+        "--workspace-dir",
+        type=str,
+        help="Creates the workspace of the run, where its temporary files are written, in "
+        "this directory, like a tmpfs such as /dev/shm. Defaults to $SONAR_WORKSPACE_DIR.",
+    )
+
+    parser.add_argument(
+        "--shard",
+        type=shard.parse_shard,
+        help="Only builds the images of shard i out of n, like 2/4. Without --image, "
+        "the images are split out of every image in the inventory.",
+    )
+    parser.add_argument(
+        "--shard-by-history",
+        default=False,
+        action="store_true",
+        help="Balances the shards by the recorded durations of the images, instead of "
+        "their weight. Every shard has to see the same history.",
+    )
+    parser.add_argument(
+        "--pipeline-output",
+        type=str,
+        help="Saves the pipeline output of the run into this file, to be merged with "
+        "the ones of other shards with `sonar.py merge`.",
+    )
 
     args = parser.parse_args()
 
+    from sonar import metrics
+    from sonar.builders.pool import BuilderPool
+    from sonar.events import NDJSONWriter
+    from sonar.plan import InventoryValidationError, Plan, compile_plan, run_plan
+    from sonar.sonar import (
+        find_image_names,
+        find_shards,
+        make_list_of_str,
+        process_image,
+        process_images,
+    )
+
+    if args.metrics_file is not None:
+        atexit.register(metrics.REGISTRY.write_textfile, args.metrics_file)
+
+    build_options = {
+        "pipeline": args.pipeline,
+        "snapshot_contexts": args.snapshot_contexts,
+        "prefetch": args.prefetch,
+        "gc": args.gc,
+        "image_analytics": args.image_analytics,
+        "history": args.history,
+        "ecr_login": args.ecr_login,
+    }
+    if args.pipeline_output is not None:
+        build_options["pipeline"] = True
+    if args.workspace_dir is not None:
+        build_options["workspace_dir"] = args.workspace_dir
+    if args.builder is not None:
+        build_options["builders"] = BuilderPool.from_config(args.builder)
+    if args.events_fd is not None:
+        build_options["event_listeners"] = [NDJSONWriter.from_fd(args.events_fd)]
+
+    if args.plan is not None:
+        with open(args.plan) as fd:
+            run_plan(Plan.from_json(fd.read()), build_options=build_options)
+        return 0
+
+    if args.image is None and args.shard is None:
+        parser.error("the following arguments are required: --image")
+
+    if args.image is None:
+        images = find_image_names(args.inventory)
+    else:
+        images = [i for value in args.image for i in make_list_of_str(value)]
     build_args = convert_parser_arguments_to_key_value(args.parameters)
 
+    if args.shard is not None or args.pipeline_output is not None or len(images) > 1:
+        if args.dry_run or args.plan_output is not None:
+            parser.error("plans can only be compiled for a single --image")
+
+        shard_index, shard_count = args.shard or (1, 1)
+        selected = images
+        shards = [images]
+        if shard_count > 1:
+            shards = find_shards(
+                selected,
+                shard_count,
+                skip_tags=args.skip_tags,
+                include_tags=args.include_tags,
+                build_args=build_args,
+                inventory=args.inventory,
+                use_history=args.shard_by_history,
+            )
+            images = shards[shard_index - 1]
+            print("shard {}/{}: {}".format(shard_index, shard_count, ", ".join(images)), file=sys.stderr)
+
+        output = None
+        if len(images) > 0:
+            output = process_images(
+                image_names=images,
+                skip_tags=args.skip_tags,
+                include_tags=args.include_tags,
+                build_args=build_args,
+                inventory=args.inventory,
+                build_options=build_options,
+                max_workers=args.parallel_images,
+            )
+
+        if args.pipeline_output is not None:
+            shard.write_partial_output(
+                args.pipeline_output, (shard_index, shard_count), images, output, selected, shards
+            )
+        return 0
+
+    if args.dry_run or args.plan_output is not None:
+        try:
+            plan = compile_plan(
+                image_name=images[0],
+                skip_tags=args.skip_tags,
+                include_tags=args.include_tags,
+                build_args=build_args,
+                inventory=args.inventory,
+            )
+        except InventoryValidationError as e:
+            for error in e.errors:
+                print(error, file=sys.stderr)
+            return 1
+
+        if args.plan_output is not None:
+            with open(args.plan_output, "w") as fd:
+                fd.write(plan.to_json())
+
+        if args.dry_run:
+            print(plan.to_json())
+            return 0
+
+        run_plan(plan, build_options=build_options)
+        return 0
+
     process_image(
-        image_name=args.image,
+        image_name=images[0],
         skip_tags=args.skip_tags,
         include_tags=args.include_tags,
         build_args=build_args,
         inventory=args.inventory,
-        build_options={"pipeline": args.pipeline},
+        build_options=build_options,
     )
 
 
@@ -0,0 +1,141 @@
+"""
+sonar/analytics.py
+
+Reports on the size of built images: their total size, their layers and,
+optionally, the largest files they add.
+
+The size of each image is kept in the cache directory, so the next build of
+the same stage can be compared against it, and fail if it grew too much.
+"""
+
+import heapq
+import io
+import tarfile
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+from sonar import cache
+
+SIZES_FILE = "image-sizes.json"
+
+# Layer commands are truncated to this length in reports.
+MAX_COMMAND_LENGTH = 80
+
+
+@dataclass
+class ImageReport:
+    size: int
+    layers: int
+    # Size and command of every layer that adds files, from the base up.
+    layer_sizes: List[Dict[str, Any]] = field(default_factory=list)
+    largest_files: List[Dict[str, Any]] = field(default_factory=list)
+    previous_size: Optional[int] = None
+
+    @property
+    def size_increase(self) -> Optional[float]:
+        """Returns how much the image grew since the previous build, in percent."""
+        if not self.previous_size:
+            return None
+
+        return (self.size - self.previous_size) * 100.0 / self.previous_size
+
+    def to_dict(self) -> Dict[str, Any]:
+        report = asdict(self)
+        report["size_increase"] = self.size_increase
+        return report
+
+
+def layer_sizes(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Returns the layers that add files, from the image history."""
+    layers = []
+    for entry in reversed(history):
+        if entry.get("Size", 0) == 0:
+            continue
+
+        command = " ".join((entry.get("CreatedBy") or "").split())
+        if len(command) > MAX_COMMAND_LENGTH:
+            command = command[: MAX_COMMAND_LENGTH - 3] + "..."
+        layers.append({"size": entry["Size"], "command": command})
+
+    return layers
+
+
+def largest_files(image_tar, count: int) -> List[Dict[str, Any]]:
+    """Returns the count largest files in the layers of an image, from the
+    stream of `docker save`, without writing it to disk."""
+    largest: List[tuple] = []
+    with tarfile.open(fileobj=image_tar, mode="r|") as outer:
+        for member in outer:
+            # Layers are `<id>/layer.tar`, or blobs in newer Docker versions.
+            if not member.isfile() or not (
+                member.name.endswith("layer.tar") or member.name.startswith("blobs/")
+            ):
+                continue
+
+            try:
+                with tarfile.open(fileobj=outer.extractfile(member), mode="r|*") as layer:
+                    for entry in layer:
+                        if not entry.isfile() or "/.wh." in "/" + entry.name:
+                            continue
+                        item = (entry.size, "/" + entry.name.lstrip("./"))
+                        if len(largest) < count:
+                            heapq.heappush(largest, item)
+                        else:
+                            heapq.heappushpop(largest, item)
+            except tarfile.TarError:
+                # Blobs are also the image configuration and manifests.
+                continue
+
+    return [{"path": path, "size": size} for size, path in sorted(largest, reverse=True)]
+
+
+def inspect_image(image, files: int = 0) -> ImageReport:
+    """Returns the report of a docker-py Image. The largest files are only
+    looked for if files is positive, as it requires reading the whole image."""
+    report = ImageReport(
+        size=image.attrs["Size"],
+        layers=len(image.attrs.get("RootFS", {}).get("Layers", [])),
+        layer_sizes=layer_sizes(image.history()),
+    )
+
+    if files > 0:
+        stream = io.BufferedReader(ChunkReader(image.save(named=False)))
+        report.largest_files = largest_files(stream, files)
+
+    return report
+
+
+class ChunkReader(io.RawIOBase):
+    """A readable stream over an iterator of bytes."""
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = iter(chunks)
+        self.leftover = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while len(self.leftover) == 0:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.leftover = memoryview(chunk)
+
+        size = min(len(buffer), len(self.leftover))
+        buffer[:size] = self.leftover[:size]
+        self.leftover = self.leftover[size:]
+        return size
+
+
+def compare_with_previous(key: str, report: ImageReport):
+    """Sets the size of the previous build of key in the report."""
+    report.previous_size = cache.load_json(SIZES_FILE, {}).get(key)
+
+
+def save_size(key: str, report: ImageReport):
+    """Records the size of the image, to compare the next build of key with it."""
+    sizes = cache.load_json(SIZES_FILE, {})
+    sizes[key] = report.size
+    cache.save_json(SIZES_FILE, sizes)
@@ -0,0 +1,559 @@
+"""
+sonar/analyze.py
+
+Finds what makes the builds of an image miss the build cache, without
+building anything.
+
+Every Dockerfile built by a docker_build stage, local or remote, and every
+template rendered by a dockerfile_template stage, is checked for:
+
+* volatile-arg: an ARG bound to a value that changes every run, like
+  `$(inputs.params.version_id)`, declared before RUN instructions. Every RUN
+  after an ARG sees its value, so they run again every time.
+* copy-before-install: the whole context copied before the dependencies
+  are installed, so they are installed again whenever any file changes.
+* unpinned-base: a base image without a digest, which changes, and misses
+  the cache, whenever its tag is pushed again.
+* missing-dockerignore: a large context without a .dockerignore, sent to
+  the builder on every build.
+
+Using the buildargs of the stage, each Dockerfile also gets an estimate of
+how many of its instructions are cached in a run where only the parameters
+change, and in a run where the sources change.
+"""
+
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from sonar import docker_context, prefetch
+from sonar.sonar import (
+    Context,
+    build_context,
+    expand_template_variants,
+    find_docker_context,
+    find_dockerfile,
+    find_functions_to_interpolate,
+    find_template_context,
+    find_variables_to_interpolate,
+    find_variables_to_interpolate_from_stage,
+    get_rendering_params,
+    iter_stages,
+    references_arg,
+    should_include_stage,
+    should_skip_stage,
+)
+from sonar.template import render
+
+# Parameters and functions whose values are different every run.
+VOLATILE_PARAMS = ("version_id",)
+VOLATILE_FUNCTIONS = ("tempfile", "timestamp")
+
+# Contexts larger than this, in bytes, should have a .dockerignore.
+LARGE_CONTEXT = 50 * 1024 * 1024
+
+# Sources of COPY and ADD that are the whole context.
+WHOLE_CONTEXT = (".", "./", "*", "./*")
+
+DEPENDENCY_INSTALL = re.compile(
+    r"\b(pip3?|pipenv|poetry|npm|pnpm|bundle|composer)\s+(install|ci|sync)\b"
+    r"|\byarn(\s+install)?\s*($|&&|;)"
+    r"|\bgo\s+mod\s+download\b|\bcargo\s+(fetch|build)\b|\bmvn\b|\bgradlew?\b"
+)
+
+COPY_FROM = re.compile(r"--from=(\S+)")
+
+
+@dataclass
+class Finding:
+    rule: str
+    # Line of the Dockerfile, or 0 if the finding is not about a line.
+    line: int
+    message: str
+
+
+@dataclass
+class Instruction:
+    line: int
+    instruction: str
+    arguments: str
+
+
+@dataclass
+class BuildStage:
+    """A FROM of a Dockerfile, and the instructions after it."""
+
+    name: str
+    base: str
+    line: int
+    # ARGs used in the FROM line.
+    base_args: Set[str] = field(default_factory=set)
+    instructions: List[Instruction] = field(default_factory=list)
+
+    @property
+    def layers(self) -> List[Instruction]:
+        """The instructions that are cached, ARGs being only declarations."""
+        return [i for i in self.instructions if i.instruction != "ARG"]
+
+    def cached_layers(self, first_miss: Optional[int]) -> int:
+        """Returns how many layers come before the instruction at first_miss."""
+        if first_miss is None:
+            return len(self.layers)
+        return len([i for i in self.instructions[:first_miss] if i.instruction != "ARG"])
+
+
+@dataclass
+class Report:
+    """What was found in the Dockerfile of a stage."""
+
+    name: str
+    dockerfile: str
+    instructions: int = 0
+    # Instructions cached when only the parameters of the run change.
+    cached_on_new_run: int = 0
+    # Instructions cached when files of the context change.
+    cached_on_changes: int = 0
+    findings: List[Finding] = field(default_factory=list)
+    # Why the Dockerfile could not be analyzed.
+    error: Optional[str] = None
+
+
+def referenced_args(value: str) -> Set[str]:
+    return {m.group(1) or m.group(3) for m in prefetch.ARG_REFERENCE.finditer(value)}
+
+
+def parse_stages(dockerfile: str, buildargs: Dict[str, str]) -> List[BuildStage]:
+    """Returns the build stages of a Dockerfile, with their base images
+    resolved with the buildargs."""
+    args: Dict[str, str] = {}
+    stages: List[BuildStage] = []
+
+    for line, instruction, arguments in prefetch.numbered_instructions(dockerfile):
+        if instruction == "FROM":
+            words = [w for w in arguments.split() if not w.startswith("--")]
+            base = words[0] if len(words) > 0 else ""
+            name = str(len(stages))
+            if len(words) >= 3 and words[1].upper() == "AS":
+                name = words[2].lower()
+            stages.append(
+                BuildStage(name, prefetch.substitute_args(base, args), line, referenced_args(base))
+            )
+        elif len(stages) > 0:
+            stages[-1].instructions.append(Instruction(line, instruction, arguments))
+        elif instruction == "ARG":
+            name, _, default = arguments.partition("=")
+            name = name.strip()
+            if name in buildargs:
+                args[name] = buildargs[name]
+            elif default != "":
+                args[name] = prefetch.substitute_args(default.strip().strip('"'), args)
+
+    return stages
+
+
+def needed_stages(stages: List[BuildStage]) -> List[BuildStage]:
+    """Returns the stages the last one needs, as BuildKit only builds those."""
+    by_name = {s.name: s for s in stages}
+    needed = set()
+    pending = stages[-1:]
+    while len(pending) > 0:
+        stage = pending.pop()
+        if stage.name in needed:
+            continue
+        needed.add(stage.name)
+
+        sources = [stage.base.lower()]
+        for instruction in stage.instructions:
+            match = COPY_FROM.search(instruction.arguments)
+            if instruction.instruction in ("COPY", "ADD") and match is not None:
+                sources.append(match.group(1).lower())
+        pending.extend(by_name[s] for s in sources if s in by_name)
+
+    return [s for s in stages if s.name in needed]
+
+
+def first_miss(
+    stage: BuildStage,
+    missed: Dict[str, bool],
+    changes: Callable[[Instruction, Set[str]], bool],
+) -> Optional[int]:
+    """Returns the index of the first instruction of stage that misses the
+    cache, or None if all of it is cached. missed has the stages before it
+    that miss the cache, and changes tells if an instruction changes, given
+    the ARGs declared before it (for FROM, the ARGs it uses)."""
+    base = Instruction(stage.line, "FROM", stage.base)
+    if missed.get(stage.base.lower()) or changes(base, stage.base_args):
+        return 0
+
+    declared: Set[str] = set()
+    for i, instruction in enumerate(stage.instructions):
+        if instruction.instruction == "ARG":
+            declared.add(instruction.arguments.partition("=")[0].strip())
+            continue
+
+        match = COPY_FROM.search(instruction.arguments)
+        if instruction.instruction in ("COPY", "ADD") and match is not None:
+            if missed.get(match.group(1).lower()):
+                return i
+        elif changes(instruction, declared):
+            return i
+
+    return None
+
+
+def first_misses(
+    stages: List[BuildStage], changes: Callable[[Instruction, Set[str]], bool]
+) -> Dict[str, Optional[int]]:
+    """Returns, by stage, the index of its first instruction missing the
+    cache, in a build where the instructions for which changes is true do."""
+    missed: Dict[str, bool] = {}
+    result = {}
+    for stage in stages:
+        result[stage.name] = first_miss(stage, missed, changes)
+        missed[stage.name] = result[stage.name] is not None
+
+    return result
+
+
+def is_whole_context_copy(instruction: Instruction) -> bool:
+    if instruction.instruction not in ("COPY", "ADD") or "--from=" in instruction.arguments:
+        return False
+
+    words = [w for w in instruction.arguments.split() if not w.startswith("--")]
+    return any(w in WHOLE_CONTEXT for w in words[:-1])
+
+
+def context_size(path: str, limit: int) -> int:
+    """Returns the size of the files in path, stopping once it is over limit."""
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+            if size > limit:
+                return size
+
+    return size
+
+
+def analyze_dockerfile(
+    name: str,
+    label: str,
+    dockerfile: str,
+    buildargs: Dict[str, str],
+    volatile: Dict[str, str],
+    context: Optional[str] = None,
+    path: Optional[str] = None,
+) -> Report:
+    """
+    Analyzes a Dockerfile built with buildargs. volatile has the buildargs
+    that change every run, with their definitions in the inventory. context
+    and path, if known, are the context of the build and the path of the
+    Dockerfile, to look for its .dockerignore.
+    """
+    report = Report(name, label)
+    stages = parse_stages(dockerfile, buildargs)
+    if len(stages) == 0:
+        report.error = "no FROM instruction"
+        return report
+
+    names = {s.name for s in stages}
+    stages = needed_stages(stages)
+
+    def changes_every_run(instruction: Instruction, declared: Set[str]) -> bool:
+        used = declared & set(volatile)
+        if instruction.instruction in ("FROM", "RUN") and len(used) > 0:
+            return True
+        return len(referenced_args(instruction.arguments) & used) > 0
+
+    def changes_with_sources(instruction: Instruction, declared: Set[str]) -> bool:
+        return is_whole_context_copy(instruction)
+
+    on_new_run = first_misses(stages, changes_every_run)
+    on_changes = first_misses(stages, changes_with_sources)
+
+    for stage in stages:
+        report.instructions += len(stage.layers)
+        report.cached_on_new_run += stage.cached_layers(on_new_run[stage.name])
+        report.cached_on_changes += stage.cached_layers(on_changes[stage.name])
+
+        report.findings.extend(find_volatile_args(stage, on_new_run[stage.name], volatile))
+        report.findings.extend(find_early_copies(stage))
+
+        if stage.base.lower() not in names:
+            report.findings.extend(find_unpinned_base(stage))
+
+    if context is not None and docker_context.find_dockerignore(context, path) is None:
+        size = context_size(context, LARGE_CONTEXT)
+        if size > LARGE_CONTEXT:
+            report.findings.append(
+                Finding(
+                    "missing-dockerignore",
+                    0,
+                    "the context {} is over {} MiB and has no .dockerignore: all of it is sent "
+                    "to the builder on every build, and copying it changes with any file "
+                    "in it".format(context, LARGE_CONTEXT // (1024 * 1024)),
+                )
+            )
+
+    report.findings.sort(key=lambda f: f.line)
+    return report
+
+
+def find_volatile_args(
+    stage: BuildStage, first: Optional[int], volatile: Dict[str, str]
+) -> List[Finding]:
+    if len(stage.base_args & set(volatile)) > 0:
+        arg = sorted(stage.base_args & set(volatile))[0]
+        return [
+            Finding(
+                "volatile-arg",
+                stage.line,
+                "FROM uses ARG {} ({}), which changes every run, so no instruction "
+                "of the stage is ever cached".format(arg, volatile[arg]),
+            )
+        ]
+
+    if first is None:
+        return []
+
+    missed = stage.instructions[first:]
+    runs = len([i for i in missed if i.instruction == "RUN"])
+    if runs == 0:
+        return []
+
+    declared = [
+        i
+        for i in stage.instructions[:first]
+        if i.instruction == "ARG" and i.arguments.partition("=")[0].strip() in volatile
+    ]
+    if len(declared) == 0:
+        # The stage misses the cache because of a stage it builds on.
+        return []
+
+    arg = declared[0].arguments.partition("=")[0].strip()
+    advice = "Declare it after the RUNs that do not use it"
+    # Volatile buildargs are not passed to the build, so they are only an
+    # option for ARGs no instruction uses.
+    if not any(references_arg(i.arguments, arg) for i in stage.layers):
+        advice += ", or list it in volatile_buildargs if it is only metadata"
+
+    return [
+        Finding(
+            "volatile-arg",
+            declared[0].line,
+            "ARG {} is {}, which changes every run, so the {} instructions from line {} on, "
+            "{} of them RUN, are never cached. {}".format(
+                arg,
+                volatile[arg],
+                len([i for i in missed if i.instruction != "ARG"]),
+                missed[0].line,
+                runs,
+                advice,
+            ),
+        )
+    ]
+
+
+def find_early_copies(stage: BuildStage) -> List[Finding]:
+    findings = []
+    for i, instruction in enumerate(stage.instructions):
+        if not is_whole_context_copy(instruction):
+            continue
+
+        for later in stage.instructions[i + 1 :]:
+            if later.instruction == "RUN" and DEPENDENCY_INSTALL.search(later.arguments):
+                findings.append(
+                    Finding(
+                        "copy-before-install",
+                        instruction.line,
+                        "{} copies the whole context before the dependencies are installed, "
+                        "at line {}, so they are installed again whenever any file changes. "
+                        "Copy the files listing the dependencies and install them "
+                        "first".format(instruction.instruction, later.line),
+                    )
+                )
+                break
+
+    return findings
+
+
+def find_unpinned_base(stage: BuildStage) -> List[Finding]:
+    base = stage.base
+    if base in ("", "scratch") or "$" in base or "@" in base:
+        return []
+
+    repository, tag = prefetch.split_image(base)
+    if tag == "latest":
+        message = "{} has no tag but latest, and no digest: builds change whenever it is pushed"
+    else:
+        message = "{} is not pinned to a digest: builds change whenever the tag is pushed again"
+
+    return [
+        Finding(
+            "unpinned-base",
+            stage.line,
+            (message + ". Use {}:{}@sha256:<digest>").format(base, repository, tag),
+        )
+    ]
+
+
+def volatile_buildargs(stage: Dict, volatile_params: Iterable[str]) -> Dict[str, str]:
+    """Returns the buildargs of a stage that change every run, with their
+    definitions. The ones in volatile_buildargs are not used by the build,
+    so they do not change it."""
+    result = {}
+    for name, value in stage.get("buildargs", {}).items():
+        if name in stage.get("volatile_buildargs", []):
+            continue
+
+        value = str(value)
+        params = set(find_variables_to_interpolate(value)) & set(volatile_params)
+        functions = set(find_functions_to_interpolate(value)) & set(VOLATILE_FUNCTIONS)
+        if len(params) > 0 or len(functions) > 0:
+            result[name] = value
+
+    return result
+
+
+def resolve_buildargs(ctx: Context, stage: Dict) -> Dict[str, str]:
+    """Returns the buildargs of a stage that are known before running it."""
+    resolved = {}
+    for name, value in stage.get("buildargs", {}).items():
+        if name in stage.get("volatile_buildargs", []):
+            continue
+        try:
+            resolved[name] = ctx.I(value)
+        except (ValueError, KeyError, IndexError):
+            continue
+
+    return resolved
+
+
+def analyze_image(
+    image_name: str,
+    skip_tags,
+    include_tags,
+    build_args: Optional[Dict[str, str]] = None,
+    inventory=None,
+    volatile_params: Iterable[str] = VOLATILE_PARAMS,
+) -> List[Report]:
+    """
+    Returns a Report for the Dockerfile of every docker_build stage of the
+    image, and for every template rendered by its dockerfile_template
+    stages. Dockerfiles rendered by a previous stage are analyzed with the
+    buildargs of the docker_build stage building them.
+    """
+    ctx = build_context(image_name, skip_tags, include_tags, build_args, inventory)
+    volatile_params = list(volatile_params)
+
+    stages = [
+        stage
+        for _, stage in iter_stages(ctx)
+        if not should_skip_stage(stage, ctx.skip_tags)
+        and should_include_stage(stage, ctx.include_tags)
+    ]
+
+    # The docker_build stages building what each stage renders.
+    builds: Dict[str, Dict] = {}
+    for stage in stages:
+        if stage["task_type"] == "docker_build":
+            for source, _, _ in find_variables_to_interpolate_from_stage(str(stage["dockerfile"])):
+                builds.setdefault(source, stage)
+
+    reports = []
+    for stage in stages:
+        ctx.stage = stage
+        name = "{}/{}".format(image_name, stage["name"])
+        try:
+            if stage["task_type"] == "docker_build":
+                if len(find_variables_to_interpolate_from_stage(str(stage["dockerfile"]))) > 0:
+                    continue
+
+                path = find_dockerfile(ctx.I(stage["dockerfile"]))
+                with open(path) as f:
+                    dockerfile = f.read()
+                reports.append(
+                    analyze_dockerfile(
+                        name,
+                        ctx.I(stage["dockerfile"]),
+                        dockerfile,
+                        resolve_buildargs(ctx, stage),
+                        volatile_buildargs(stage, volatile_params),
+                        find_docker_context(ctx),
+                        path,
+                    )
+                )
+            elif stage["task_type"] == "dockerfile_template":
+                build = builds.get(stage["name"])
+                reports.extend(analyze_templates(ctx, name, build, volatile_params))
+        except (ValueError, KeyError, IndexError, OSError) as e:
+            reports.append(Report(name, stage.get("dockerfile", ""), error=str(e)))
+        finally:
+            ctx.stage = None
+
+    return reports
+
+
+def analyze_templates(
+    ctx: Context, name: str, build: Optional[Dict], volatile_params: List[str]
+) -> List[Report]:
+    """Renders the templates of the current stage and analyzes them, with the
+    buildargs and context of build, the stage building them, if there is one."""
+    stage = ctx.stage
+    template_context = find_template_context(ctx)
+
+    buildargs: Dict[str, str] = {}
+    volatile: Dict[str, str] = {}
+    context = None
+    if build is not None:
+        ctx.stage = build
+        buildargs = resolve_buildargs(ctx, build)
+        volatile = volatile_buildargs(build, volatile_params)
+        try:
+            context = find_docker_context(ctx)
+        except ValueError:
+            context = None
+        ctx.stage = stage
+
+    reports = []
+    for variant in expand_template_variants(stage):
+        extension = variant["template_file_extension"]
+        template = "Dockerfile" if extension is None else "Dockerfile.{}".format(extension)
+        rendered = render(template_context, extension, get_rendering_params(ctx, variant))
+        reports.append(
+            analyze_dockerfile(
+                name,
+                os.path.join(template_context, template),
+                rendered,
+                buildargs,
+                volatile,
+                context,
+            )
+        )
+
+    return reports
+
+
+def format_reports(reports: List[Report]) -> str:
+    lines = []
+    for report in reports:
+        lines.append("{} ({})".format(report.name, report.dockerfile))
+        if report.error is not None:
+            lines.append("  Not analyzed: {}".format(report.error))
+            continue
+
+        lines.append(
+            "  Cached: {} of {} instructions when only the parameters change, "
+            "{} when sources change".format(
+                report.cached_on_new_run, report.instructions, report.cached_on_changes
+            )
+        )
+        for finding in report.findings:
+            where = "line {}: ".format(finding.line) if finding.line > 0 else ""
+            lines.append("  {}{}: {}".format(where, finding.rule, finding.message))
+
+    return "\n".join(lines)
@@ -1,3 +1,6 @@
+from typing import Dict, Optional, Tuple
+
+
 class SonarBuildError(Exception):
     """Wrapper over docker.errors.BuildError"""
 
@@ -10,6 +13,87 @@ class SonarAPIError(Exception):
     pass
 
 
+class Backend:
+    """The operations Sonar runs against builders, registries and the cloud.
+
+    The default backend uses Docker and AWS; others can be passed to a run
+    in `Context.backend`, like the in-process fake in sonar/builders/fake.py.
+    Methods raise SonarAPIError when the operation fails.
+    """
+
+    def build(
+        self,
+        path: str,
+        dockerfile: str,
+        buildargs=None,
+        labels=None,
+        platform=None,
+        progress=None,
+        tag=None,
+        builder=None,
+    ):
+        """Builds an image and returns it, tagged locally as tag. builder is
+        the sonar.builders.pool.Builder to build in, if there is a pool."""
+        raise NotImplementedError
+
+    def pull(self, registry: str, tag: str):
+        """Pulls an image and returns it."""
+        raise NotImplementedError
+
+    def tag(self, image, registry: str, tag: str):
+        """Tags an image as registry:tag."""
+        raise NotImplementedError
+
+    def push(self, registry: str, tag: str) -> Optional[str]:
+        """Pushes registry:tag. Returns the digest of the pushed image, if
+        the backend knows it."""
+        raise NotImplementedError
+
+    def find_build_id(self, registry: str, tag: str) -> Optional[Tuple[str, str]]:
+        """Returns the id of the image registry:tag was built as, before
+        add_metadata, and the digest of registry:tag. None if it has no
+        metadata added by Sonar."""
+        raise NotImplementedError
+
+    def add_metadata(
+        self,
+        registry: str,
+        tag: str,
+        build_id: str,
+        labels: Optional[Dict[str, str]] = None,
+        annotations: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """Adds labels and annotations to the pushed image registry:tag, built
+        as build_id, without building or pushing its layers again. Returns
+        the new digest of registry:tag."""
+        raise NotImplementedError
+
+    def push_oci_image(self, image, registry: str, tag: str) -> bool:
+        """Pushes an image assembled by sonar/oci.py, without a builder.
+        Returns False if registry:tag already was that image."""
+        raise NotImplementedError
+
+    def create_repository(self, registry: str):
+        """Creates the repository in the registry, if it needs to be created."""
+        raise NotImplementedError
+
+    def get_secret(self, name: str, region: str) -> str:
+        """Returns the value of a secret."""
+        raise NotImplementedError
+
+    def save_file(self, path: str, destination: str):
+        """Copies a local file into destination, a path or an S3 URL."""
+        raise NotImplementedError
+
+    def remove_images(self, references) -> list:
+        """Removes local tags, and returns the ones that were removed."""
+        raise NotImplementedError
+
+    def prune(self) -> int:
+        """Removes dangling images, and returns the bytes reclaimed."""
+        raise NotImplementedError
+
+
 def buildarg_from_dict(args):
     if args is None:
         return ""
@@ -1,29 +1,63 @@
 import logging
-import random
+import os
+import re
 import subprocess
-from typing import Dict, Optional
+import uuid
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Union
 
-import docker
-import docker.errors
+from sonar import metrics, ratelimit, tracing
+from sonar.lazy import lazy_import
 
 from . import SonarAPIError, SonarBuildError, buildarg_from_dict, labels_from_dict
+from .pool import Builder
 
+docker = lazy_import("docker")
 
-def docker_client() -> docker.DockerClient:
+CACHED_STEP = re.compile(r"^#\d+ CACHED$", re.MULTILINE)
+
+
+@lru_cache(maxsize=None)
+def docker_client(docker_host: Optional[str] = None) -> "docker.DockerClient":
+    if docker_host is not None:
+        return docker.DockerClient(base_url=docker_host, timeout=60 * 60 * 24)
     return docker.client.from_env(timeout=60 * 60 * 24)
 
 
+def reload_docker_config():
+    """Makes the clients already created read the Docker config again, after
+    it changed."""
+    if docker_client.cache_info().currsize > 0:
+        docker_client().api.reload_config()
+
+
+def docker_host_env(docker_host: Optional[str]) -> Dict:
+    """Returns the keyword arguments running the docker CLI against
+    docker_host, or against the default daemon if it is None."""
+    if docker_host is None:
+        return {}
+    return {"env": dict(os.environ, DOCKER_HOST=docker_host)}
+
+
 def docker_build(
         path: str,
         dockerfile: str,
         buildargs: Optional[Dict[str, str]] = None,
         labels: Optional[Dict[str, str]] = None,
         platform: Optional[str] = None,
+        progress: Optional[Callable[[str], None]] = None,
+        tag: Optional[str] = None,
+        builder: Optional[Builder] = None,
 ):
-    """Builds a docker image."""
+    """Builds a docker image, tagged locally as tag. If progress is set, it is
+    called with each line of the build output as it is produced. Builds run
+    in the default buildx builder, unless another builder is passed; images
+    built by a builder with a docker_host stay in its daemon."""
     logger = logging.getLogger(__name__)
 
-    image_name = "sonar-docker-build-{}".format(random.randint(1, 10000))
+    image_name = tag
+    if image_name is None:
+        image_name = "sonar-docker-build-{}".format(uuid.uuid4().hex)
 
     logger.info("path: {}".format(path))
     logger.info("dockerfile: {}".format(dockerfile))
@@ -35,15 +69,16 @@ def docker_build(
         # docker build from docker-py has bugs resulting in errors or invalid platform when building with specified --platform=linux/amd64 on M1
         docker_build_cli(
             logger=logger, path=path, dockerfile=dockerfile, tag=image_name, buildargs=buildargs, labels=labels, platform=platform,
+            progress=progress, builder=builder,
         )
 
-        client = docker_client()
+        client = docker_client(builder.docker_host if builder is not None else None)
         return client.images.get(image_name)
     except docker.errors.APIError as e:
         raise SonarAPIError from e
 
 
-def _get_build_log(e: docker.errors.BuildError) -> str:
+def _get_build_log(e: "docker.errors.BuildError") -> str:
     build_logs = "\n"
     for item in e.build_log:
         if "stream" not in item:
@@ -59,21 +94,59 @@ def docker_build_cli(
         tag: str,
         buildargs: Optional[Dict[str, str]],
         labels=Optional[Dict[str, str]],
-        platform=Optional[str]
+        platform=Optional[str],
+        progress: Optional[Callable[[str], None]] = None,
+        builder: Optional[Builder] = None,
 ):
     dockerfile_path = dockerfile
     # if dockerfile is relative it has to be set as relative to context (path)
     if not dockerfile_path.startswith('/'):
         dockerfile_path = f"{path}/{dockerfile_path}"
 
-    args = get_docker_build_cli_args(path=path, dockerfile=dockerfile_path, tag=tag, buildargs=buildargs, labels=labels, platform=platform)
+    args = get_docker_build_cli_args(
+        path=path, dockerfile=dockerfile_path, tag=tag, buildargs=buildargs, labels=labels, platform=platform,
+        builder=builder.name if builder is not None else None,
+    )
+    env = docker_host_env(builder.docker_host if builder is not None else None)
 
     args_str = " ".join(args)
     logger.info(f"executing cli docker build: {args_str}")
 
-    cp = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if cp.returncode != 0:
-        raise SonarAPIError(cp.stderr)
+    with metrics.BUILD_DURATION.time(), tracing.span(
+        "docker build",
+        tag=tag,
+        dockerfile=dockerfile,
+        platform=platform,
+        builder=builder.id if builder is not None else "default",
+    ):
+        if progress is None:
+            cp = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **env)
+            returncode, output = cp.returncode, cp.stderr
+        else:
+            lines = []
+            with subprocess.Popen(
+                args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, **env
+            ) as process:
+                for line in process.stdout:
+                    lines.append(line)
+                    progress(line.rstrip("\n"))
+            returncode, output = process.returncode, "".join(lines)
+
+        if returncode != 0:
+            metrics.BUILDS.inc(status="failure")
+            raise SonarAPIError(output)
+
+    metrics.BUILDS.inc(status="success")
+    metrics.BUILD_CACHE_HITS.inc(count_cached_steps(output))
+
+
+def count_cached_steps(output: Union[str, bytes]) -> int:
+    """Returns the number of build steps reported as CACHED in the output of a
+    build with `--progress plain`."""
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", errors="replace")
+
+    return len(CACHED_STEP.findall(output))
 
 
 def get_docker_build_cli_args(
@@ -82,9 +155,12 @@ def get_docker_build_cli_args(
         tag: str,
         buildargs: Optional[Dict[str, str]],
         labels=Optional[Dict[str, str]],
-        platform=Optional[str]
+        platform=Optional[str],
+        builder: Optional[str] = None,
 ):
     args = ["docker", "buildx", "build", "--load" , "--progress", "plain", path, "-f", dockerfile, "-t", tag]
+    if builder is not None:
+        args[3:3] = ["--builder", builder]
     if buildargs is not None:
         for k, v in buildargs.items():
             args.append("--build-arg")
@@ -109,13 +185,20 @@ def docker_pull(
     client = docker_client()
 
     try:
-        return client.images.pull(image, tag=tag)
+        with metrics.PULL_DURATION.time(), tracing.span(
+            "docker pull", registry=image, tag=tag
+        ):
+            pulled = client.images.pull(image, tag=tag)
     except docker.errors.APIError as e:
+        metrics.PULLS.inc(status="failure")
         raise SonarAPIError from e
 
+    metrics.PULLS.inc(status="success")
+    return pulled
+
 
 def docker_tag(
-        image: docker.models.images.Image,
+        image: "docker.models.images.Image",
         registry: str,
         tag: str,
 ):
@@ -125,27 +208,61 @@ def docker_tag(
         raise SonarAPIError from e
 
 
-def docker_push(registry: str, tag: str):
+PUSHED_DIGEST = re.compile(r"digest: (sha256:[0-9a-f]{64})")
+
+
+def docker_push(registry: str, tag: str, docker_host: Optional[str] = None) -> Optional[str]:
+    """Pushes registry:tag from the daemon at docker_host, or the default
+    one, retrying on errors, and returns the digest the registry knows the
+    image by. Throttled pushes are not retried here, but raised, so the
+    caller lowers its rate limit of the registry before retrying them."""
+
     def inner_docker_push(should_raise=False):
 
         # We can't use docker-py here
         # as it doesn't support DOCKER_CONTENT_TRUST
         # env variable, which could be needed
-        cp = subprocess.run(
-            ["docker", "push", f"{registry}:{tag}"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
+        with tracing.span("docker push", registry=registry, tag=tag) as span:
+            cp = subprocess.run(
+                ["docker", "push", f"{registry}:{tag}"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                **docker_host_env(docker_host),
+            )
+            if span is not None:
+                span.set_attributes(returncode=cp.returncode)
         if cp.returncode != 0:
-            if should_raise:
+            if should_raise or ratelimit.is_throttled(cp.stderr):
+                metrics.PUSHES.inc(status="failure")
                 raise SonarAPIError(cp.stderr)
 
-            return False
+            return None
 
-        return True
+        metrics.PUSHES.inc(status="success")
+        count_pushed_layers(cp.stdout)
+        return cp
 
     retries = 3
-    while retries >= 0:
-        if inner_docker_push(retries == 0):
-            break
-        retries -= 1
+    with metrics.PUSH_DURATION.time():
+        while retries >= 0:
+            cp = inner_docker_push(retries == 0)
+            if cp is not None:
+                break
+            retries -= 1
+            metrics.PUSH_RETRIES.inc()
+
+    match = PUSHED_DIGEST.search(cp.stdout.decode("utf-8", errors="replace"))
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def count_pushed_layers(output: bytes):
+    """Counts the layers docker push uploaded and the ones the registry
+    already had."""
+    output = output.decode("utf-8", errors="replace")
+    for line in output.splitlines():
+        if line.endswith(": Pushed"):
+            metrics.PUSHED_LAYERS.inc(result="pushed")
+        elif line.endswith(": Layer already exists"):
+            metrics.PUSHED_LAYERS.inc(result="exists")
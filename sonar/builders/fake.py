@@ -0,0 +1,297 @@
+"""
+sonar/builders/fake.py
+
+An in-process backend that builds, pushes and pulls nothing, but keeps
+track of what it was asked to do.
+
+It can simulate the latency of each operation, random failures, throttling
+by the registry or AWS, and a limited number of concurrent operations, so
+whole inventories can be run end to end without a Docker daemon or network:
+
+    backend = FakeBackend(latency={"build": 0.5, "push": 0.2}, failure_rate={"push": 0.1})
+    process_image("image", [], [], build_options={"backend": backend})
+"""
+
+import hashlib
+import io
+import random
+import tarfile
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from sonar.oci import BUILD_ID_ANNOTATION
+from sonar.ratelimit import TokenBucket
+
+from . import Backend, SonarAPIError
+
+OPERATIONS = (
+    "build",
+    "pull",
+    "tag",
+    "push",
+    "find_build_id",
+    "add_metadata",
+    "push_oci_image",
+    "create_repository",
+    "get_secret",
+    "save_file",
+    "remove_images",
+    "prune",
+)
+
+
+@dataclass
+class FakeImage:
+    """An image with the attributes of a docker-py Image that Sonar uses."""
+
+    id: str
+    size: int = 1024 * 1024
+    tags: List[str] = field(default_factory=list)
+    labels: Dict[str, str] = field(default_factory=dict)
+    annotations: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def attrs(self) -> Dict[str, Any]:
+        return {
+            "Id": self.id,
+            "Size": self.size,
+            "RootFS": {"Layers": [self.id]},
+            "Config": {"Labels": self.labels},
+        }
+
+    def history(self) -> List[Dict[str, Any]]:
+        return [{"CreatedBy": "fake", "Size": self.size}]
+
+    def save(self, named: bool = False):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w"):
+            pass
+        yield buffer.getvalue()
+
+
+class FakeBackend(Backend):
+    """
+    Simulates the backend of a run.
+
+    * latency: seconds each operation takes, by operation name.
+    * jitter: fraction of the latency that is added or removed at random.
+    * failure_rate: probability of each operation failing.
+    * rate_limits: operations per second allowed, above which they fail as
+      throttled.
+    * max_concurrency: operations of each kind that run at the same time;
+      the rest wait.
+    * strict_pulls: if set, pulling an image that was never pushed fails.
+    * seed: makes the random failures and jitter reproducible.
+    """
+
+    def __init__(
+        self,
+        latency: Optional[Dict[str, float]] = None,
+        jitter: float = 0.0,
+        failure_rate: Optional[Dict[str, float]] = None,
+        rate_limits: Optional[Dict[str, float]] = None,
+        max_concurrency: Optional[Dict[str, int]] = None,
+        strict_pulls: bool = False,
+        secrets: Optional[Dict[str, str]] = None,
+        seed: Optional[int] = None,
+    ):
+        for option in (latency, failure_rate, rate_limits, max_concurrency):
+            for name in option or {}:
+                if name not in OPERATIONS:
+                    raise ValueError("Unknown operation {}".format(name))
+
+        self.latency = latency or {}
+        self.jitter = jitter
+        self.failure_rate = failure_rate or {}
+        self.rate_limits = {k: TokenBucket(v) for k, v in (rate_limits or {}).items()}
+        self.slots = {
+            k: threading.BoundedSemaphore(v) for k, v in (max_concurrency or {}).items()
+        }
+        self.strict_pulls = strict_pulls
+        self.secrets = secrets or {}
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.calls: List[Tuple[str, Tuple]] = []
+        self.images: Dict[str, FakeImage] = {}
+        self.registry: Dict[str, FakeImage] = {}
+        self.repositories = set()
+        self.files: Dict[str, bytes] = {}
+
+    @property
+    def counts(self) -> Counter:
+        """Returns the number of calls of each operation."""
+        with self.lock:
+            return Counter(name for name, _ in self.calls)
+
+    def call(self, name: str, *args):
+        """Records a call, and simulates its latency, throttling and failures."""
+        with self.lock:
+            self.calls.append((name, args))
+            failed = self.random.random() < self.failure_rate.get(name, 0)
+            latency = self.latency.get(name, 0)
+            if latency > 0 and self.jitter > 0:
+                latency *= 1 + self.random.uniform(-self.jitter, self.jitter)
+
+        bucket = self.rate_limits.get(name)
+        if bucket is not None and not bucket.take():
+            raise SonarAPIError("{}: ThrottlingException: Rate exceeded".format(name))
+
+        slot = self.slots.get(name)
+        if slot is not None:
+            slot.acquire()
+        try:
+            if latency > 0:
+                time.sleep(latency)
+        finally:
+            if slot is not None:
+                slot.release()
+
+        if failed:
+            raise SonarAPIError("{}: simulated failure".format(name))
+
+    def build(
+        self,
+        path,
+        dockerfile,
+        buildargs=None,
+        labels=None,
+        platform=None,
+        progress=None,
+        tag=None,
+        builder=None,
+    ):
+        builder_id = builder.id if builder is not None else None
+        self.call("build", path, dockerfile, buildargs, labels, platform, tag, builder_id)
+
+        # Like Docker, the same inputs build the same image.
+        inputs = (
+            path,
+            dockerfile,
+            sorted((buildargs or {}).items()),
+            sorted((labels or {}).items()),
+            platform,
+        )
+        digest = hashlib.sha256(repr(inputs).encode("utf-8")).hexdigest()
+        image = FakeImage(id="sha256:" + digest, labels=dict(labels or {}))
+        if progress is not None:
+            progress("#1 [internal] load build definition from {}".format(dockerfile))
+            progress("#2 DONE 0.0s")
+
+        with self.lock:
+            if tag is not None:
+                image.tags.append(tag)
+                self.images[tag] = image
+
+        return image
+
+    def pull(self, registry, tag):
+        self.call("pull", registry, tag)
+
+        reference = "{}:{}".format(registry, tag)
+        with self.lock:
+            image = self.registry.get(reference)
+            if image is None:
+                if self.strict_pulls:
+                    raise SonarAPIError("{}: manifest unknown".format(reference))
+                image = FakeImage(id="sha256:" + hashlib.sha256(reference.encode()).hexdigest())
+            self.images[reference] = image
+
+        return image
+
+    def tag(self, image, registry, tag):
+        self.call("tag", registry, tag)
+
+        reference = "{}:{}".format(registry, tag)
+        with self.lock:
+            image.tags.append(reference)
+            self.images[reference] = image
+
+    def push(self, registry, tag):
+        self.call("push", registry, tag)
+
+        reference = "{}:{}".format(registry, tag)
+        with self.lock:
+            if reference not in self.images:
+                raise SonarAPIError("{}: no such image".format(reference))
+            self.registry[reference] = self.images[reference]
+            return self.images[reference].id
+
+    def find_build_id(self, registry, tag):
+        self.call("find_build_id", registry, tag)
+
+        with self.lock:
+            pushed = self.registry.get("{}:{}".format(registry, tag))
+        if pushed is None or BUILD_ID_ANNOTATION not in pushed.annotations:
+            return None
+        return pushed.annotations[BUILD_ID_ANNOTATION], pushed.id
+
+    def add_metadata(self, registry, tag, build_id, labels=None, annotations=None):
+        self.call("add_metadata", registry, tag, build_id, labels, annotations)
+
+        reference = "{}:{}".format(registry, tag)
+        with self.lock:
+            pushed = self.registry.get(reference)
+            if pushed is None:
+                raise SonarAPIError("{} was not pushed".format(reference))
+
+            annotations = dict(annotations or {}, **{BUILD_ID_ANNOTATION: build_id})
+            labels = dict(pushed.labels, **(labels or {}))
+            digest = hashlib.sha256(
+                repr((pushed.id, sorted(labels.items()), sorted(annotations.items()))).encode("utf-8")
+            ).hexdigest()
+            self.registry[reference] = FakeImage(
+                id="sha256:" + digest,
+                size=pushed.size,
+                tags=[reference],
+                labels=labels,
+                annotations=annotations,
+            )
+            return self.registry[reference].id
+
+    def push_oci_image(self, image, registry, tag):
+        self.call("push_oci_image", registry, tag)
+
+        reference = "{}:{}".format(registry, tag)
+        with self.lock:
+            pushed = self.registry.get(reference)
+            if pushed is not None and pushed.id == image.digest:
+                return False
+            size = sum(layer.size for layer in image.layers)
+            self.registry[reference] = FakeImage(id=image.digest, size=size, tags=[reference])
+
+        return True
+
+    def create_repository(self, registry):
+        self.call("create_repository", registry)
+
+        with self.lock:
+            self.repositories.add(registry)
+
+    def get_secret(self, name, region):
+        self.call("get_secret", name, region)
+
+        return self.secrets.get(name, "secret-{}".format(name))
+
+    def save_file(self, path, destination):
+        self.call("save_file", path, destination)
+
+        with open(path, "rb") as f:
+            contents = f.read()
+        with self.lock:
+            self.files[destination] = contents
+
+    def remove_images(self, references):
+        references = list(references)
+        self.call("remove_images", references)
+
+        with self.lock:
+            return [r for r in references if self.images.pop(r, None) is not None]
+
+    def prune(self):
+        self.call("prune")
+
+        return 0
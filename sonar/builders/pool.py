@@ -0,0 +1,133 @@
+"""
+sonar/builders/pool.py
+
+A pool of builders that `docker_build` stages are spread across.
+
+Builders are buildx builders, by name, or Docker daemons, by their
+DOCKER_HOST endpoint, each one running up to `capacity` builds at a time.
+They are listed in the inventory:
+
+    builders:
+    - name: remote-amd64
+      capacity: 4
+    - docker_host: tcp://builder-1:2376
+      capacity: 2
+
+A build goes to the builder that last built the same image, if it has room,
+so its layer cache is warm; otherwise it goes to the least loaded builder.
+Builds wait while every builder is full.
+"""
+
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+from sonar import cache
+
+AFFINITY_FILE = "builder-affinity.json"
+
+
+@dataclass
+class Builder:
+    # Name of a buildx builder.
+    name: Optional[str] = None
+
+    # Endpoint of a Docker daemon, for builders that are not buildx builders.
+    docker_host: Optional[str] = None
+
+    capacity: int = 1
+    running: int = 0
+
+    @property
+    def id(self) -> str:
+        return self.name or self.docker_host
+
+    @property
+    def load(self) -> float:
+        return self.running / self.capacity
+
+    @property
+    def full(self) -> bool:
+        return self.running >= self.capacity
+
+    @classmethod
+    def from_config(cls, config) -> "Builder":
+        """Returns a builder from its entry in the inventory, or from a
+        string: a buildx builder name or a DOCKER_HOST endpoint, with an
+        optional `=capacity`."""
+        if isinstance(config, str):
+            endpoint, _, capacity = config.partition("=")
+            config = {"capacity": int(capacity or 1)}
+            if "://" in endpoint:
+                config["docker_host"] = endpoint
+            else:
+                config["name"] = endpoint
+
+        if ("name" in config) == ("docker_host" in config):
+            raise ValueError("builders need either a name or a docker_host: {}".format(config))
+
+        capacity = int(config.get("capacity", 1))
+        if capacity < 1:
+            raise ValueError("builder {} needs a capacity of at least 1".format(config))
+
+        return cls(name=config.get("name"), docker_host=config.get("docker_host"), capacity=capacity)
+
+
+class BuilderPool:
+    """Hands out builders to builds, which hold them while they run."""
+
+    def __init__(self, builders: List[Builder], persist: bool = True):
+        if len(builders) == 0:
+            raise ValueError("a pool needs at least one builder")
+        ids = [b.id for b in builders]
+        if len(set(ids)) != len(ids):
+            raise ValueError("builders are listed more than once: {}".format(ids))
+
+        self.builders = builders
+        self.persist = persist
+        self.condition = threading.Condition()
+
+        # The builder that last built each key.
+        self.affinity: Dict[str, str] = {}
+        if persist:
+            self.affinity.update(cache.load_json(AFFINITY_FILE, {}))
+
+    @classmethod
+    def from_config(cls, config: List, persist: bool = True) -> "BuilderPool":
+        return cls([Builder.from_config(c) for c in config], persist)
+
+    def choose(self, key: str) -> Optional[Builder]:
+        """Returns the builder for key, or None if every builder is full."""
+        available = [b for b in self.builders if not b.full]
+        for builder in available:
+            if builder.id == self.affinity.get(key):
+                return builder
+
+        if len(available) == 0:
+            return None
+
+        # Ties go to the builder listed first.
+        return min(available, key=lambda b: b.load)
+
+    @contextmanager
+    def acquire(self, key: str) -> Iterator[Builder]:
+        """Holds a builder for the build of key, waiting until one has room."""
+        with self.condition:
+            builder = self.choose(key)
+            while builder is None:
+                self.condition.wait()
+                builder = self.choose(key)
+            builder.running += 1
+
+        try:
+            yield builder
+        finally:
+            with self.condition:
+                builder.running -= 1
+                self.affinity[key] = builder.id
+                if self.persist:
+                    affinity = cache.load_json(AFFINITY_FILE, {})
+                    affinity[key] = builder.id
+                    cache.save_json(AFFINITY_FILE, affinity)
+                self.condition.notify_all()
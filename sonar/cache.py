@@ -0,0 +1,42 @@
+"""
+sonar/cache.py
+
+Location of the files Sonar keeps between runs.
+"""
+
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any
+
+
+def cache_dir() -> Path:
+    """Returns the directory where Sonar stores data between runs, which is
+    $SONAR_CACHE_DIR, or `sonar` in the user's cache directory."""
+    if "SONAR_CACHE_DIR" in os.environ:
+        path = Path(os.environ["SONAR_CACHE_DIR"])
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", str(Path.home() / ".cache"))
+        path = Path(base) / "sonar"
+
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def load_json(name: str, default: Any = None) -> Any:
+    """Returns the contents of a JSON file in the cache directory."""
+    try:
+        with open(cache_dir() / name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(name: str, value: Any):
+    """Atomically replaces a JSON file in the cache directory."""
+    directory = cache_dir()
+    fd, tmp = tempfile.mkstemp(dir=str(directory), prefix=".{}.".format(name))
+    with os.fdopen(fd, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp, str(directory / name))
@@ -0,0 +1,172 @@
+"""
+sonar/cleanup.py
+
+Removes the local images Sonar creates.
+
+Every image built by Sonar is tagged in the `sonar-local` repository, with
+a tag made from the run, the image and the stage that built it. At the end
+of a run, the images it created can be removed; images left by earlier
+runs can be removed by age, or oldest first until they take less than a
+given size, with:
+
+    sonar.py gc --max-age 3d --max-size 50G
+
+Both remove dangling layers afterwards.
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import re
+from typing import Iterable, List, Optional
+
+from sonar.builders.docker import SonarAPIError, docker, docker_client
+
+LOCAL_REPOSITORY = "sonar-local"
+
+# Docker tags are limited to 128 characters.
+MAX_TAG_LENGTH = 128
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def sanitize(value: str, allowed: str) -> str:
+    return re.sub("[^{}]+".format(allowed), "-", value).strip("-._")
+
+
+def local_image_tag(run_id: str, image: str, stage: str) -> str:
+    """Returns the local tag of the image built by a stage in a run. The
+    same run, image and stage always get the same tag, and different ones
+    never share a tag."""
+    repository = sanitize(image.lower(), "a-z0-9._-") or "image"
+    stage_tag = sanitize(stage, "A-Za-z0-9_.-")
+    tag = "{}-{}".format(run_id, stage_tag)
+
+    digest = ""
+    if repository != image or stage_tag != stage or len(tag) > MAX_TAG_LENGTH:
+        # Names that had to be changed, like "a b" and "a/b", or cut, like
+        # those of matrix stages, keep a digest of the image and stage they
+        # come from, so they stay unique.
+        digest = "-" + hashlib.sha256(json.dumps([image, stage]).encode("utf-8")).hexdigest()[:12]
+    tag = tag[: MAX_TAG_LENGTH - len(digest)] + digest
+
+    return "{}/{}:{}".format(LOCAL_REPOSITORY, repository, tag)
+
+
+def parse_duration(value: str) -> int:
+    """Returns the seconds in a duration like `90m`, `12h` or `7d`."""
+    match = re.fullmatch(r"(\d+)([smhdw]?)", value.strip().lower())
+    if match is None:
+        raise ValueError("Invalid duration: {}".format(value))
+
+    return int(match.group(1)) * DURATION_UNITS[match.group(2) or "s"]
+
+
+def parse_size(value: str) -> int:
+    """Returns the bytes in a size like `500M` or `50G`."""
+    match = re.fullmatch(r"(\d+)([kmgt]?)i?b?", value.strip().lower())
+    if match is None:
+        raise ValueError("Invalid size: {}".format(value))
+
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def image_created(image: "docker.models.images.Image") -> datetime.datetime:
+    # The daemon reports nanoseconds, which datetime does not parse.
+    created = image.attrs["Created"][:19]
+    return datetime.datetime.strptime(created, "%Y-%m-%dT%H:%M:%S").replace(
+        tzinfo=datetime.timezone.utc
+    )
+
+
+def remove_images(references: Iterable[str]) -> List[str]:
+    """Removes the given tags, and the images left without tags. Returns the
+    tags that were removed; the ones that cannot be removed, because they do
+    not exist or are used by a container, are logged and left."""
+    logger = logging.getLogger(__name__)
+    client = docker_client()
+
+    removed = []
+    for reference in references:
+        try:
+            client.images.remove(reference)
+        except docker.errors.APIError as e:
+            logger.info("Could not remove %s: %s", reference, e)
+            continue
+        removed.append(reference)
+
+    return removed
+
+
+def prune_dangling() -> int:
+    """Removes dangling images, and returns the bytes reclaimed."""
+    try:
+        pruned = docker_client().images.prune(filters={"dangling": True})
+    except docker.errors.APIError as e:
+        raise SonarAPIError from e
+
+    return pruned.get("SpaceReclaimed") or 0
+
+
+def local_images() -> List["docker.models.images.Image"]:
+    """Returns the images in the local repository, oldest first."""
+    images = docker_client().images.list(filters={"reference": LOCAL_REPOSITORY + "/*"})
+    return sorted(images, key=image_created)
+
+
+def collect_garbage(
+    max_age: Optional[int] = None,
+    max_size: Optional[int] = None,
+    now: Optional[datetime.datetime] = None,
+) -> List[str]:
+    """Removes local images older than max_age seconds, and then the oldest
+    ones until the rest take at most max_size bytes. Returns the removed tags."""
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    images = local_images()
+    expired = []
+    if max_age is not None:
+        expired = [
+            i for i in images if (now - image_created(i)).total_seconds() > max_age
+        ]
+        images = [i for i in images if i not in expired]
+
+    if max_size is not None:
+        size = sum(i.attrs.get("Size", 0) for i in images)
+        while size > max_size and len(images) > 0:
+            oldest = images.pop(0)
+            expired.append(oldest)
+            size -= oldest.attrs.get("Size", 0)
+
+    tags = [
+        tag for image in expired for tag in image.tags if tag.startswith(LOCAL_REPOSITORY + "/")
+    ]
+    removed = remove_images(tags)
+    prune_dangling()
+
+    return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="sonar.py gc")
+    parser.add_argument(
+        "--max-age",
+        type=parse_duration,
+        help="Removes images built longer than this ago, like 12h or 7d.",
+    )
+    parser.add_argument(
+        "--max-size",
+        type=parse_size,
+        help="Removes the oldest images until the rest take at most this, like 50G.",
+    )
+
+    args = parser.parse_args(argv)
+
+    for tag in collect_garbage(max_age=args.max_age, max_size=args.max_size):
+        print("removed {}".format(tag))
+
+    return 0
@@ -0,0 +1,224 @@
+"""
+sonar/credentials.py
+
+Logs in to ECR registries without `docker login`.
+
+ECR authorization tokens are requested once per account and region, and
+kept, in memory and in the cache directory (readable only by the user),
+until they are about to expire. They are written into a Docker config
+directory that belongs to the run, which DOCKER_CONFIG points to while the
+run lasts, so `docker push` and `docker pull` use them. The rest of the
+user's Docker config is kept: its auths, credential helpers and credential
+store are copied, with the ECR registries mapped to no helper so Docker reads
+their tokens from the config instead of a credsStore like Docker Desktop's,
+and everything else in the directory (buildx builders, CLI plugins, trust
+keys) is linked, so other registries and tools keep working.
+"""
+
+import atexit
+import base64
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sonar import cache
+
+ECR_REGISTRY = re.compile(r"^(\d+)\.dkr\.ecr\.([a-z0-9-]+)\.amazonaws\.com$")
+
+TOKENS_FILE = "ecr-tokens.json"
+
+# Tokens are refreshed when they expire in less than this many seconds, so
+# they never expire in the middle of a push.
+REFRESH_MARGIN = 30 * 60
+
+MAX_CONCURRENT_LOGINS = 8
+
+
+@dataclass
+class Token:
+    username: str
+    password: str
+    # Seconds since the epoch.
+    expires_at: float
+
+    @property
+    def fresh(self) -> bool:
+        return self.expires_at - time.time() > REFRESH_MARGIN
+
+
+def ecr_account_region(host: str) -> Optional[Tuple[str, str]]:
+    """Returns the account and region of an ECR registry host, or None if
+    it is not one."""
+    match = ECR_REGISTRY.match(host)
+    if match is None:
+        return None
+
+    return match.group(1), match.group(2)
+
+
+def user_docker_config_dir() -> str:
+    return os.environ.get("DOCKER_CONFIG", str(Path.home() / ".docker"))
+
+
+def user_docker_config() -> Dict:
+    try:
+        with open(os.path.join(user_docker_config_dir(), "config.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def link_docker_config(source: str, destination: str):
+    """Links everything in a Docker config directory but its config.json."""
+    try:
+        names = os.listdir(source)
+    except OSError:
+        return
+
+    for name in names:
+        if name != "config.json":
+            os.symlink(os.path.join(source, name), os.path.join(destination, name))
+
+
+class CredentialStore:
+    """Keeps ECR tokens, and the Docker config of the run."""
+
+    def __init__(self, ecr_client: Callable[[str], Any]):
+        # Returns an ECR client for a region.
+        self.ecr_client = ecr_client
+        self.lock = threading.Lock()
+        self.tokens: Dict[str, Token] = {}
+        self.config_dir: Optional[str] = None
+        self.previous_config: Optional[str] = None
+        self.base_config: Dict = {}
+
+    def load_tokens(self) -> Dict[str, Token]:
+        path = cache.cache_dir() / TOKENS_FILE
+        try:
+            with open(path) as f:
+                return {host: Token(**t) for host, t in json.load(f).items()}
+        except (OSError, ValueError, TypeError):
+            return {}
+
+    def save_tokens(self):
+        tokens = self.load_tokens()
+        tokens.update(self.tokens)
+        tokens = {host: vars(t) for host, t in tokens.items() if t.expires_at > time.time()}
+
+        path = cache.cache_dir() / TOKENS_FILE
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=".{}.".format(TOKENS_FILE))
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f)
+        os.replace(tmp, str(path))
+
+    def fetch_token(self, host: str) -> Token:
+        account, region = ecr_account_region(host)
+        client = self.ecr_client(region)
+        data = client.get_authorization_token(registryIds=[account])["authorizationData"][0]
+        username, _, password = (
+            base64.b64decode(data["authorizationToken"]).decode("utf-8").partition(":")
+        )
+        return Token(username, password, data["expiresAt"].timestamp())
+
+    def token(self, host: str) -> Token:
+        """Returns a fresh token for an ECR registry, requesting a new one
+        only if the cached one is about to expire."""
+        with self.lock:
+            token = self.tokens.get(host)
+            if token is None or not token.fresh:
+                token = self.load_tokens().get(host)
+        if token is not None and token.fresh:
+            with self.lock:
+                self.tokens[host] = token
+            return token
+
+        token = self.fetch_token(host)
+        with self.lock:
+            self.tokens[host] = token
+            self.save_tokens()
+        return token
+
+    def credentials(self, host: str) -> Optional[Tuple[str, str]]:
+        """Returns the username and password of an ECR registry, or None if
+        host is not one."""
+        if ecr_account_region(host) is None:
+            return None
+
+        token = self.token(host)
+        return token.username, token.password
+
+    def login(self, hosts: List[str]) -> Optional[str]:
+        """Gets the tokens of the ECR registries in hosts, concurrently, and
+        writes them into the Docker config of the run. Returns the directory
+        of the config, or None if there are no ECR registries."""
+        hosts = sorted({h for h in hosts if ecr_account_region(h) is not None})
+        if len(hosts) == 0:
+            return self.config_dir
+
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LOGINS) as executor:
+            list(executor.map(self.token, hosts))
+
+        return self.write_config()
+
+    def refresh(self, host: str):
+        """Renews the token of an ECR registry in the Docker config of the run,
+        if it is about to expire."""
+        with self.lock:
+            token = self.tokens.get(host)
+            logged_in = self.config_dir is not None
+        if logged_in and token is not None and not token.fresh:
+            self.token(host)
+            self.write_config()
+
+    def write_config(self) -> str:
+        with self.lock:
+            if self.config_dir is None:
+                self.base_config = user_docker_config()
+                self.config_dir = tempfile.mkdtemp(prefix="sonar-docker-config-")
+                self.previous_config = os.environ.get("DOCKER_CONFIG")
+                link_docker_config(user_docker_config_dir(), self.config_dir)
+                atexit.register(self.logout)
+
+            config = self.base_config
+
+            config = dict(config)
+            auths = dict(config.get("auths", {}))
+            helpers = dict(config.get("credHelpers", {}))
+            for host, token in self.tokens.items():
+                auth = "{}:{}".format(token.username, token.password).encode("utf-8")
+                auths[host] = {"auth": base64.b64encode(auth).decode("ascii")}
+                # The token is used instead of the ECR credential helper, or
+                # the credsStore: an empty helper makes Docker read auths.
+                helpers[host] = ""
+            config["auths"] = auths
+            config["credHelpers"] = helpers
+
+            fd, tmp = tempfile.mkstemp(dir=self.config_dir, prefix=".config.json.")
+            with os.fdopen(fd, "w") as f:
+                json.dump(config, f)
+            os.replace(tmp, os.path.join(self.config_dir, "config.json"))
+
+            os.environ["DOCKER_CONFIG"] = self.config_dir
+            return self.config_dir
+
+    def logout(self):
+        """Removes the Docker config of the run, and points DOCKER_CONFIG back
+        to where it was."""
+        with self.lock:
+            if self.config_dir is None:
+                return
+
+            shutil.rmtree(self.config_dir, ignore_errors=True)
+            self.config_dir = None
+            if self.previous_config is None:
+                os.environ.pop("DOCKER_CONFIG", None)
+            else:
+                os.environ["DOCKER_CONFIG"] = self.previous_config
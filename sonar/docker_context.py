@@ -0,0 +1,252 @@
+"""
+sonar/docker_context.py
+
+Manifests of Docker build contexts.
+
+A manifest lists the files of a context that are sent to the builder, this
+is, the ones not excluded by its .dockerignore, with their digests. The
+digest of the manifest identifies the contents of the context, so it can be
+compared between stages and runs.
+
+Hashing a large context is expensive, so file digests are kept in the cache
+directory and only computed again for files whose inode, size or mtime
+changed.
+"""
+
+import hashlib
+import os
+import re
+import stat
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Pattern, Tuple
+
+from sonar import cache
+
+HASHES_FILE = "context-hashes.json"
+DIGESTS_FILE = "context-digests.json"
+
+# Contexts bigger than this (in bytes) are reported.
+SIZE_WARNING = int(os.environ.get("SONAR_CONTEXT_SIZE_WARNING", 512 * 1024 * 1024))
+
+
+def translate_pattern(pattern: str) -> str:
+    """Translates a .dockerignore pattern into a regular expression, with
+    the same rules as Docker: `*` and `?` do not match `/`, and `**` matches
+    any number of directories."""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "*":
+            if pattern[i + 1 : i + 2] == "*":
+                i += 1
+                if pattern[i + 1 : i + 2] == "/":
+                    i += 1
+                    regex += "(.*/)?"
+                else:
+                    regex += ".*"
+            else:
+                regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end < 0:
+                regex += re.escape(c)
+            else:
+                chars = pattern[i + 1 : end]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                regex += "[" + chars.replace("\\", "\\\\") + "]"
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+
+    return "^" + regex + "$"
+
+
+def parse_dockerignore(contents: str) -> List[Tuple[Pattern, bool]]:
+    """Returns the patterns in a .dockerignore, and if they are exceptions
+    (they start with `!`)."""
+    patterns = []
+    for line in contents.splitlines():
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+
+        exception = line.startswith("!")
+        if exception:
+            line = line[1:].strip()
+
+        line = os.path.normpath(line).lstrip("/")
+        if line in ("", "."):
+            continue
+
+        patterns.append((re.compile(translate_pattern(line)), exception))
+
+    return patterns
+
+
+def is_excluded(path: str, patterns: List[Tuple[Pattern, bool]]) -> bool:
+    """Returns True if path, relative to the context, is excluded. The last
+    pattern matching path, or one of its parent directories, wins."""
+    excluded = False
+    parents = path.split("/")
+    for pattern, exception in patterns:
+        if excluded == (not exception):
+            continue
+
+        for i in range(len(parents), 0, -1):
+            if pattern.match("/".join(parents[:i])):
+                excluded = not exception
+                break
+
+    return excluded
+
+
+def find_dockerignore(path: str, dockerfile: Optional[str] = None) -> Optional[str]:
+    """Returns the ignore file used for a context. As with BuildKit, a
+    `<Dockerfile>.dockerignore` next to the Dockerfile takes precedence
+    over the .dockerignore of the context. A relative dockerfile is relative
+    to the context, as it is for the build."""
+    candidates = [os.path.join(path, ".dockerignore")]
+    if dockerfile is not None:
+        candidates.insert(0, os.path.join(path, dockerfile) + ".dockerignore")
+
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+
+    return None
+
+
+class HashCache:
+    """Digests of files, keyed by path and valid while the file's device,
+    inode, size and mtime do not change."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hashes: Optional[Dict[str, List]] = None
+
+    def load(self):
+        if self.hashes is None:
+            self.hashes = cache.load_json(HASHES_FILE, {})
+
+    def save(self):
+        with self.lock:
+            if self.hashes is not None:
+                cache.save_json(HASHES_FILE, self.hashes)
+
+    def digest(self, path: str, st: os.stat_result) -> str:
+        key = [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+        with self.lock:
+            self.load()
+            cached = self.hashes.get(path)
+        if cached is not None and cached[:4] == key:
+            return cached[4]
+
+        digest = hash_file(path, st)
+        with self.lock:
+            self.hashes[path] = key + [digest]
+
+        return digest
+
+
+HASH_CACHE = HashCache()
+
+
+def hash_file(path: str, st: os.stat_result) -> str:
+    sha = hashlib.sha256()
+    if stat.S_ISLNK(st.st_mode):
+        sha.update(os.readlink(path).encode("utf-8"))
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+
+    return "sha256:" + sha.hexdigest()
+
+
+@dataclass
+class ContextManifest:
+    path: str
+    dockerignore: Optional[str] = None
+    # Digest and mode of every file sent to the builder, by relative path.
+    files: Dict[str, Tuple[str, int]] = field(default_factory=dict)
+    size: int = 0
+    digest: str = ""
+    # The digest of this context in the previous run, if any.
+    previous_digest: Optional[str] = None
+
+    @property
+    def unchanged(self) -> bool:
+        return self.previous_digest == self.digest
+
+    def compute_digest(self) -> str:
+        sha = hashlib.sha256()
+        for name in sorted(self.files):
+            digest, mode = self.files[name]
+            sha.update("{}\0{:o}\0{}\n".format(name, mode, digest).encode("utf-8"))
+
+        return "sha256:" + sha.hexdigest()
+
+
+def build_manifest(
+    path: str, dockerfile: Optional[str] = None, hashes: HashCache = HASH_CACHE
+) -> ContextManifest:
+    """Walks the context in path and returns its manifest."""
+    dockerignore = find_dockerignore(path, dockerfile)
+    patterns = []
+    if dockerignore is not None:
+        with open(dockerignore) as f:
+            patterns = parse_dockerignore(f.read())
+
+    # Excluded directories can only be skipped when no exception could
+    # include something inside them again.
+    has_exceptions = any(exception for _, exception in patterns)
+
+    manifest = ContextManifest(path=path, dockerignore=dockerignore)
+    for root, dirs, files in os.walk(path):
+        relroot = os.path.relpath(root, path)
+        relroot = "" if relroot == "." else relroot + "/"
+
+        if not has_exceptions:
+            dirs[:] = [d for d in dirs if not is_excluded(relroot + d, patterns)]
+        dirs.sort()
+
+        # Links to directories are not followed, they are sent as links.
+        links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+        for name in sorted(files + links):
+            relpath = relroot + name
+            if is_excluded(relpath, patterns):
+                continue
+
+            fullpath = os.path.join(root, name)
+            st = os.lstat(fullpath)
+            manifest.files[relpath] = (hashes.digest(fullpath, st), stat.S_IMODE(st.st_mode))
+            manifest.size += st.st_size
+
+    manifest.digest = manifest.compute_digest()
+
+    return manifest
+
+
+def snapshot(path: str, dockerfile: Optional[str] = None) -> ContextManifest:
+    """Returns the manifest of a context, compared with the previous run,
+    and records its digest for the next one."""
+    manifest = build_manifest(path, dockerfile)
+    HASH_CACHE.save()
+
+    key = os.path.abspath(path)
+    digests = cache.load_json(DIGESTS_FILE, {})
+    manifest.previous_digest = digests.get(key)
+    if manifest.previous_digest != manifest.digest:
+        digests[key] = manifest.digest
+        cache.save_json(DIGESTS_FILE, digests)
+
+    return manifest
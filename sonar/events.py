@@ -0,0 +1,121 @@
+"""
+sonar/events.py
+
+Events emitted while Sonar runs.
+
+Every event has a type, a timestamp and the image and stage it belongs to.
+Events are passed to the functions in `Context.event_listeners` as soon as
+they happen, so consumers can react to a pushed image while the rest of the
+run continues. NDJSONWriter writes them as newline-delimited JSON, and
+iter_events yields them from a run in a background thread.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterator, Optional, TextIO
+
+IMAGE_START = "image_start"
+IMAGE_END = "image_end"
+STAGE_START = "stage_start"
+STAGE_END = "stage_end"
+STAGE_SKIPPED = "stage_skipped"
+BUILD_PROGRESS = "build_progress"
+PUSH_RESULT = "push_result"
+ERROR = "error"
+MESSAGE = "message"
+
+
+@dataclass
+class Event:
+    type: str
+    image: Optional[str] = None
+    stage: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+    data: Dict[str, Any] = field(default_factory=dict)
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), default=str)
+
+
+def detach(ctx, listener: Callable[[Event], None]):
+    """Stops sending events to listener."""
+    try:
+        ctx.event_listeners.remove(listener)
+    except ValueError:
+        pass
+
+
+def emit(ctx, event_type: str, **data):
+    """Sends an event of event_type to every listener of the context. A
+    listener that raises is detached, and the run continues without it."""
+    if len(ctx.event_listeners) == 0:
+        return
+
+    event = Event(
+        type=event_type,
+        image=ctx.image.get("name"),
+        stage=ctx.stage["name"] if ctx.stage else None,
+        data=data,
+    )
+    for listener in list(ctx.event_listeners):
+        try:
+            listener(event)
+        except Exception:  # pylint: disable=W0703
+            logging.getLogger(__name__).exception("Detaching event listener %s", listener)
+            detach(ctx, listener)
+
+
+class NDJSONWriter:
+    """Writes events to a stream as newline-delimited JSON."""
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_fd(cls, fd: int) -> "NDJSONWriter":
+        return cls(os.fdopen(fd, "w", buffering=1))
+
+    def __call__(self, event: Event):
+        with self.lock:
+            self.stream.write(event.to_json() + "\n")
+            self.stream.flush()
+
+
+def iter_events(run: Callable[[Callable[[Event], None]], Any]) -> Iterator[Event]:
+    """Calls run in a background thread with a listener, and yields the
+    events it receives as they happen. Exceptions raised by run are raised
+    once every event has been yielded.
+
+        iter_events(lambda listener: process_image(..., build_options={
+            "event_listeners": [listener],
+        }))
+    """
+    events: "queue.Queue[Optional[Event]]" = queue.Queue()
+    errors = []
+
+    def target():
+        try:
+            run(events.put)
+        except Exception as e:  # pylint: disable=W0703
+            errors.append(e)
+        finally:
+            events.put(None)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+
+    while True:
+        event = events.get()
+        if event is None:
+            break
+        yield event
+
+    thread.join()
+    if len(errors) > 0:
+        raise errors[0]
@@ -0,0 +1,219 @@
+"""
+sonar/graph.py
+
+Orders and runs the images of an inventory that depend on each other.
+
+Dependencies are a dictionary from each image to the images it needs:
+
+    {"base": [], "server": ["base"], "tools": ["base"], "bundle": ["server", "tools"]}
+
+An image runs as soon as every image it depends on has finished, so
+independent images run at the same time, and the images depending on an
+image that failed are not run. When more images are ready than can run,
+the ones starting the longest path to the end of the run go first.
+"""
+
+import contextvars
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+MAX_CONCURRENT_IMAGES = 4
+
+
+class DependencyCycleError(ValueError):
+    """Raised when images depend on each other."""
+
+    def __init__(self, cycle: List[str]):
+        super().__init__("Images depend on each other: {}".format(" -> ".join(cycle)))
+        self.cycle = cycle
+
+
+def find_cycle(dependencies: Dict[str, List[str]]) -> Optional[List[str]]:
+    """Returns a cycle of dependencies, as a path that starts and ends in the
+    same image, or None if there are no cycles."""
+    visiting: List[str] = []
+    visited = set()
+
+    def visit(name: str) -> Optional[List[str]]:
+        if name in visiting:
+            return visiting[visiting.index(name):] + [name]
+        if name in visited:
+            return None
+
+        visiting.append(name)
+        for dependency in dependencies.get(name, []):
+            cycle = visit(dependency)
+            if cycle is not None:
+                return cycle
+        visiting.pop()
+        visited.add(name)
+        return None
+
+    for name in dependencies:
+        cycle = visit(name)
+        if cycle is not None:
+            return cycle
+
+    return None
+
+
+def topological_levels(dependencies: Dict[str, List[str]]) -> List[List[str]]:
+    """Returns the images in levels: every image only depends on images of
+    previous levels. Images keep the order of dependencies in each level."""
+    cycle = find_cycle(dependencies)
+    if cycle is not None:
+        raise DependencyCycleError(cycle)
+
+    levels: List[List[str]] = []
+    done = set()
+    pending = list(dependencies)
+    while len(pending) > 0:
+        level = [
+            name
+            for name in pending
+            if all(d in done or d not in dependencies for d in dependencies[name])
+        ]
+        levels.append(level)
+        done.update(level)
+        pending = [name for name in pending if name not in done]
+
+    return levels
+
+
+def critical_paths(dependencies: Dict[str, List[str]], costs: Dict[str, float]) -> Dict[str, float]:
+    """Returns, for every image, the cost of the most expensive path from
+    the image to one that nothing depends on, including both."""
+    dependents: Dict[str, List[str]] = {name: [] for name in dependencies}
+    for name, needed in dependencies.items():
+        for dependency in needed:
+            if dependency in dependents:
+                dependents[dependency].append(name)
+
+    paths: Dict[str, float] = {}
+    for level in reversed(topological_levels(dependencies)):
+        for name in level:
+            downstream = [paths[d] for d in dependents[name]]
+            paths[name] = costs.get(name, 0) + max(downstream, default=0)
+
+    return paths
+
+
+def critical_path(dependencies: Dict[str, List[str]], costs: Dict[str, float]) -> List[str]:
+    """Returns the most expensive chain of images, from the first to run."""
+    paths = critical_paths(dependencies, costs)
+    dependents = {
+        name: [d for d, needed in dependencies.items() if name in needed] for name in dependencies
+    }
+
+    roots = [n for n in dependencies if all(d not in dependencies for d in dependencies[n])]
+    chain: List[str] = []
+    candidates = roots
+    while len(candidates) > 0:
+        name = max(candidates, key=lambda n: paths[n])
+        chain.append(name)
+        candidates = dependents[name]
+
+    return chain
+
+
+def makespan(
+    dependencies: Dict[str, List[str]],
+    costs: Dict[str, float],
+    max_workers: int = MAX_CONCURRENT_IMAGES,
+) -> float:
+    """Returns how long running every image would take, scheduling them
+    like run_graph does."""
+    paths = critical_paths(dependencies, costs)
+    finished: Dict[str, float] = {}
+    running: Dict[str, float] = {}
+    now = 0.0
+    while len(finished) < len(dependencies):
+        ready = [
+            n
+            for n in dependencies
+            if n not in finished
+            and n not in running
+            and all(d in finished or d not in dependencies for d in dependencies[n])
+        ]
+        for name in sorted(ready, key=lambda n: -paths[n])[: max_workers - len(running)]:
+            running[name] = now + costs.get(name, 0)
+
+        name = min(running, key=lambda n: running[n])
+        now = running.pop(name)
+        finished[name] = now
+
+    return now
+
+
+@dataclass
+class ImageResult:
+    name: str
+    result: Any = None
+    error: Optional[Exception] = None
+
+    # Set when the image did not run because a dependency failed.
+    skipped: bool = False
+
+
+def run_graph(
+    dependencies: Dict[str, List[str]],
+    run: Callable[[str, Dict[str, ImageResult]], Any],
+    max_workers: int = MAX_CONCURRENT_IMAGES,
+    costs: Optional[Dict[str, float]] = None,
+) -> Dict[str, ImageResult]:
+    """Calls `run(name, results)` for every image once its dependencies have
+    finished; results holds the result of every dependency. Errors are
+    returned with the result of the image, instead of being raised.
+
+    costs are the expected durations of the images; ready images on the
+    longest path are started first. Without them, images start in order."""
+    priorities = critical_paths(dependencies, costs or {})
+
+    results: Dict[str, ImageResult] = {}
+    lock = threading.Lock()
+
+    def run_one(name: str) -> ImageResult:
+        with lock:
+            upstream = {d: results[d] for d in dependencies[name] if d in results}
+        try:
+            return ImageResult(name, result=run(name, upstream))
+        except Exception as e:  # pylint: disable=W0703
+            return ImageResult(name, error=e)
+
+    # Stable, so images with the same priority start in order.
+    pending = sorted(dependencies, key=lambda n: -priorities[n])
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for name in list(pending):
+                needed = [d for d in dependencies[name] if d in dependencies]
+                if any(d not in results for d in needed):
+                    continue
+
+                failed = [d for d in needed if results[d].error is not None]
+                if len(failed) > 0:
+                    pending.remove(name)
+                    error = RuntimeError("dependency {} failed".format(failed[0]))
+                    with lock:
+                        results[name] = ImageResult(name, error=error, skipped=True)
+                    continue
+
+                if len(running) >= max_workers:
+                    continue
+
+                pending.remove(name)
+                future = executor.submit(contextvars.copy_context().run, run_one, name)
+                running[future] = name
+
+            if len(running) == 0:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                with lock:
+                    results[name] = future.result()
+
+    return {name: results[name] for name in dependencies}
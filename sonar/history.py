@@ -0,0 +1,145 @@
+"""
+sonar/history.py
+
+Durations of previous runs, kept in a SQLite database in the cache
+directory.
+
+Every stage, and the operations inside it (builds, pushes), are recorded by
+image, stage and the hash of the stage's definition. The duration of a stage
+is estimated from its recent runs with the same definition, or from its
+recent runs with any definition if it changed. Estimates are used to start
+the images on the longest path first, and by `sonar.py plan --estimate`.
+"""
+
+import hashlib
+import json
+import sqlite3
+import statistics
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from sonar import cache
+
+HISTORY_FILE = "history.sqlite"
+
+# Estimates use the median of this many recent runs.
+RECENT_RUNS = 10
+
+# Operation recorded for whole stages and whole images.
+STAGE = "stage"
+IMAGE = "image"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS durations (
+    image TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    duration REAL NOT NULL,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS durations_by_stage
+    ON durations (image, stage, operation, recorded_at);
+"""
+
+
+def input_hash(definition: Any) -> str:
+    """Returns the hash of a stage or image definition."""
+    data = json.dumps(definition, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+class History:
+    """A connection to the history database, shared between threads."""
+
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            path = str(cache.cache_dir() / HISTORY_FILE)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def record(
+        self,
+        image: str,
+        stage: str,
+        operation: str,
+        duration: float,
+        definition_hash: str = "",
+    ):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO durations VALUES (?, ?, ?, ?, ?, ?)",
+                (image, stage, operation, definition_hash, duration, time.time()),
+            )
+
+    def recent(
+        self,
+        image: str,
+        stage: str,
+        operation: str,
+        definition_hash: Optional[str] = None,
+    ) -> List[float]:
+        """Returns the durations of the most recent runs, newest first."""
+        query = "SELECT duration FROM durations WHERE image = ? AND stage = ? AND operation = ?"
+        parameters = [image, stage, operation]
+        if definition_hash is not None:
+            query += " AND input_hash = ?"
+            parameters.append(definition_hash)
+        query += " ORDER BY recorded_at DESC LIMIT ?"
+        parameters.append(RECENT_RUNS)
+
+        with self.lock:
+            return [row[0] for row in self.connection.execute(query, parameters)]
+
+    def estimate(
+        self,
+        image: str,
+        stage: str,
+        operation: str = STAGE,
+        definition_hash: Optional[str] = None,
+    ) -> Optional[float]:
+        """Returns the expected duration of an operation, or None if it has
+        never run."""
+        durations = []
+        if definition_hash is not None:
+            durations = self.recent(image, stage, operation, definition_hash)
+        if len(durations) == 0:
+            durations = self.recent(image, stage, operation)
+        if len(durations) == 0:
+            return None
+
+        return statistics.median(durations)
+
+    def estimate_image(self, image: str) -> Optional[float]:
+        """Returns the expected duration of a whole image."""
+        return self.estimate(image, "", IMAGE)
+
+
+_history: Optional[History] = None
+_history_lock = threading.Lock()
+
+
+def get_history() -> History:
+    """Returns the history of the cache directory, opening it once."""
+    global _history  # pylint: disable=W0603
+    with _history_lock:
+        if _history is None:
+            _history = History()
+        return _history
+
+
+def estimate_stages(image: str, stages: List[Dict]) -> Dict[str, Optional[float]]:
+    """Returns the expected duration of each stage of an image, by name."""
+    history = get_history()
+    return {
+        stage["name"]: history.estimate(image, stage["name"], STAGE, input_hash(stage))
+        for stage in stages
+    }
@@ -0,0 +1,38 @@
+"""
+sonar/lazy.py
+
+Deferred imports for Sonar's heavy dependencies.
+"""
+
+import importlib
+import threading
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stands for a module that is only imported when one of its attributes
+    is used for the first time."""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._sonar_lock = threading.Lock()
+        self._sonar_module = None
+
+    def _sonar_load(self) -> types.ModuleType:
+        with self._sonar_lock:
+            if self._sonar_module is None:
+                self._sonar_module = importlib.import_module(self.__name__)
+
+        return self._sonar_module
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._sonar_load(), attribute)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Returns module name, to be imported on first use.
+
+    Attributes set on the returned object, for instance by `unittest.mock.patch`,
+    take precedence over the ones in the module.
+    """
+    return LazyModule(name)
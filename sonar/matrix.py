@@ -0,0 +1,177 @@
+"""
+sonar/matrix.py
+
+Expansion of `matrix` entries in images and stages.
+
+A matrix is a dictionary of axes, each one of them with a list of values,
+and two optional filters, `include` and `exclude`, which are lists of
+partial combinations:
+
+    matrix:
+      distro: [ubi, ubuntu]
+      arch: [amd64, arm64]
+      exclude:
+      - distro: ubuntu
+        arch: arm64
+
+Each combination produces a concrete image or stage, with the values of the
+combination added as `vars`, as `tags` and as a suffix to its `name`.
+Combinations are generated lazily, and filters are applied to the axes
+before generating them, so selecting a few combinations out of a large
+matrix never builds the full cross-product.
+"""
+
+from itertools import product
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+MATRIX_FILTERS = ("include", "exclude")
+
+
+def matrix_axes(matrix: Dict) -> Dict[str, List[str]]:
+    """Returns the axes of a matrix, with their values as strings."""
+    return {
+        name: [str(v) for v in values]
+        for name, values in matrix.items()
+        if name not in MATRIX_FILTERS
+    }
+
+
+def matches(combination: Dict[str, str], partial: Dict) -> bool:
+    """Checks if a combination contains all the values in partial."""
+    return all(combination.get(k) == str(v) for k, v in partial.items())
+
+
+def restrict_axes(
+    axes: Dict[str, List[str]], partial: Dict
+) -> Dict[str, List[str]]:
+    """Returns a copy of axes only containing the values in partial."""
+    restricted = {}
+    for name, values in axes.items():
+        if name in partial:
+            values = [v for v in values if v == str(partial[name])]
+        restricted[name] = values
+
+    return restricted
+
+
+def tagged_products(
+    axes: Dict[str, List[str]], include_tags: List[str]
+) -> Iterator[Tuple[str, ...]]:
+    """Yields the combinations of axes that have at least one value in
+    include_tags, without visiting any other combination.
+
+    To yield each combination only once, the combinations are partitioned by
+    the first axis with a value in include_tags.
+    """
+    values = list(axes.values())
+    for i, axis in enumerate(values):
+        included = [v for v in axis if v in include_tags]
+        if len(included) == 0:
+            continue
+
+        before = [[v for v in vals if v not in include_tags] for vals in values[:i]]
+        yield from product(*before, included, *values[i + 1:])
+
+
+def combinations(
+    matrix: Dict,
+    tags: Iterable[str] = (),
+    skip_tags: Optional[List[str]] = None,
+    include_tags: Optional[List[str]] = None,
+) -> Iterator[Dict[str, str]]:
+    """Yields every combination of the matrix that passes its filters and the
+    skip and include tags. `tags` are the tags of the item holding the matrix."""
+    skip_tags = skip_tags or []
+    include_tags = include_tags or []
+
+    axes = matrix_axes(matrix)
+    axes = {
+        name: [v for v in values if v not in skip_tags] for name, values in axes.items()
+    }
+    names = list(axes)
+
+    # If the item is selected by its own tags, all of its combinations are.
+    if not set(tags).isdisjoint(include_tags):
+        include_tags = []
+
+    partials = matrix.get("include") or [{}]
+    seen = set()
+    for partial in partials:
+        restricted = restrict_axes(axes, partial)
+        if len(include_tags) == 0:
+            values = product(*restricted.values())
+        else:
+            values = tagged_products(restricted, include_tags)
+
+        for value in values:
+            if len(partials) > 1:
+                if value in seen:
+                    continue
+                seen.add(value)
+
+            combination = dict(zip(names, value))
+            if any(matches(combination, e) for e in matrix.get("exclude", [])):
+                continue
+
+            yield combination
+
+
+def matrix_errors(item: Dict) -> List[str]:
+    """Returns what is wrong with the matrix of an image or stage, which has
+    to be fixed before it can be expanded."""
+    if "matrix" not in item:
+        return []
+
+    errors = []
+    if "name" not in item:
+        errors.append("matrix without a name")
+
+    matrix = item["matrix"]
+    if not isinstance(matrix, dict):
+        return errors + ["matrix has to be a dictionary of axes"]
+
+    axes = {k: v for k, v in matrix.items() if k not in MATRIX_FILTERS}
+    if len(axes) == 0:
+        errors.append("matrix without axes")
+    for name, values in axes.items():
+        if not isinstance(values, list) or len(values) == 0:
+            errors.append("matrix axis {} has no values".format(name))
+
+    return errors
+
+
+def instantiate(item: Dict, combination: Dict[str, str]) -> Dict:
+    """Returns a concrete copy of item for a matrix combination."""
+    concrete = {k: v for k, v in item.items() if k != "matrix"}
+
+    concrete["name"] = "-".join([item["name"]] + list(combination.values()))
+
+    variables = dict(item.get("vars", {}))
+    variables.update(combination)
+    concrete["vars"] = variables
+
+    tags = list(item.get("tags", []))
+    concrete["tags"] = tags + [v for v in combination.values() if v not in tags]
+
+    return concrete
+
+
+def expand(
+    item: Dict,
+    skip_tags: Optional[List[str]] = None,
+    include_tags: Optional[List[str]] = None,
+) -> Iterator[Dict]:
+    """Yields the concrete items described by an image or stage. Items without
+    a `matrix` are yielded as they are."""
+    if "matrix" not in item:
+        yield item
+        return
+
+    errors = matrix_errors(item)
+    if len(errors) > 0:
+        raise ValueError("{}: {}".format(item.get("name", "item"), errors[0]))
+
+    for combination in combinations(
+        item["matrix"], item.get("tags", []), skip_tags, include_tags
+    ):
+        yield instantiate(item, combination)
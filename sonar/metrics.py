@@ -0,0 +1,227 @@
+"""
+sonar/metrics.py
+
+Counters and histograms about what Sonar does, in the Prometheus text
+exposition format.
+
+Metrics are registered in REGISTRY when this module is imported. They can be
+written to a file for the node_exporter's textfile collector at the end of a
+run (sonar.py --metrics-file), or scraped from `GET /metrics` in serve mode.
+"""
+
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, math.inf)
+
+LabelValues = Tuple[str, ...]
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ""
+
+    pairs = ['{}="{}"'.format(n, escape(str(v))) for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labels):
+            raise ValueError(
+                "{} expects labels {}, got {}".format(self.name, self.labels, sorted(labels))
+            )
+
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self.label_values(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [
+                "{}{} {}".format(self.name, format_labels(self.labels, k), format_value(v))
+                for k, v in sorted(self.values.items())
+            ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels) -> int:
+        return self.values.get(self.label_values(labels), (None, 0.0, 0))[2]
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observes the time spent in the block."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            self.name,
+                            format_labels(self.labels + ("le",), key + (format_value(bound),)),
+                            bucket_count,
+                        )
+                    )
+                labels = format_labels(self.labels, key)
+                lines.append("{}_sum{} {}".format(self.name, labels, format_value(total)))
+                lines.append("{}_count{} {}".format(self.name, labels, count))
+
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(
+        self, name: str, documentation: str, labels: Sequence[str] = ()
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labels))
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        return "\n".join(m.render() for m in self.metrics.values()) + "\n"
+
+    def write_textfile(self, path: str):
+        """Writes the metrics to path, replacing it atomically, so the textfile
+        collector never reads a partial file."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".sonar-metrics-")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.render())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+
+REGISTRY = Registry()
+
+BUILDS = REGISTRY.counter(
+    "sonar_builds_total", "Docker images built, by result.", ["status"]
+)
+BUILD_DURATION = REGISTRY.histogram(
+    "sonar_build_duration_seconds", "Time spent building Docker images."
+)
+BUILD_CACHE_HITS = REGISTRY.counter(
+    "sonar_build_cache_hits_total", "Build steps that were reused from the build cache."
+)
+PUSHES = REGISTRY.counter("sonar_pushes_total", "Images pushed, by result.", ["status"])
+PUSH_RETRIES = REGISTRY.counter("sonar_push_retries_total", "Retried image pushes.")
+PUSH_DURATION = REGISTRY.histogram(
+    "sonar_push_duration_seconds", "Time spent pushing images, including retries."
+)
+PUSHED_LAYERS = REGISTRY.counter(
+    "sonar_push_layers_total",
+    "Layers of pushed images, by whether they were uploaded or already in the registry.",
+    ["result"],
+)
+PULLS = REGISTRY.counter("sonar_pulls_total", "Images pulled, by result.", ["status"])
+PULL_DURATION = REGISTRY.histogram(
+    "sonar_pull_duration_seconds", "Time spent pulling images."
+)
+AWS_API_CALLS = REGISTRY.counter(
+    "sonar_aws_api_calls_total", "Calls to AWS APIs.", ["service", "operation"]
+)
+AWS_API_DURATION = REGISTRY.histogram(
+    "sonar_aws_api_duration_seconds",
+    "Time spent in calls to AWS APIs.",
+    ["service", "operation"],
+)
+STAGE_DURATION = REGISTRY.histogram(
+    "sonar_stage_duration_seconds", "Time spent running stages.", ["task_type"]
+)
@@ -0,0 +1,338 @@
+"""
+sonar/oci.py
+
+Assembles OCI images from files, without a Docker daemon.
+
+Images built this way have a single layer, on top of nothing (`FROM
+scratch`), holding the files of a `context_image` stage. The layer is a
+deterministic tar: entries are sorted, and have fixed owners, modes and
+modification times, so the same files always produce the same digests. The
+layer is written, compressed and hashed in a single pass.
+
+Images can be written into an OCI image layout directory, or pushed to a
+registry with sonar/registry.py.
+
+Images pushed by Docker can also get metadata after being built: manifests
+are rewritten as OCI manifests of the same layers, with annotations added,
+and labels added to a new config, so values that change every run do not
+change what is built.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+CONFIG_MEDIA_TYPE = "application/vnd.oci.image.config.v1+json"
+LAYER_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar+gzip"
+
+REF_NAME_ANNOTATION = "org.opencontainers.image.ref.name"
+
+# The id of the image a manifest was made from, before adding metadata.
+BUILD_ID_ANNOTATION = "org.mongodb.sonar.build-id"
+
+# The OCI media types of what Docker pushes. The contents are the same.
+OCI_MEDIA_TYPES = {
+    "application/vnd.docker.distribution.manifest.v2+json": MANIFEST_MEDIA_TYPE,
+    "application/vnd.docker.container.image.v1+json": CONFIG_MEDIA_TYPE,
+    "application/vnd.docker.image.rootfs.diff.tar.gzip": LAYER_MEDIA_TYPE,
+}
+
+
+def source_date_epoch() -> int:
+    """Returns the modification time of every file in a layer: the value
+    of $SOURCE_DATE_EPOCH, or 0."""
+    return int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+
+
+def canonical_json(document) -> bytes:
+    return json.dumps(document, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def sha256_digest(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+@dataclass
+class Blob:
+    media_type: str
+    digest: str
+    size: int
+
+    # Where the contents of the blob are: a file, or bytes in memory.
+    path: Optional[str] = None
+    data: Optional[bytes] = None
+
+    def open(self) -> BinaryIO:
+        if self.path is not None:
+            return open(self.path, "rb")
+
+        return io.BytesIO(self.data)
+
+    def descriptor(self) -> Dict:
+        return {"mediaType": self.media_type, "digest": self.digest, "size": self.size}
+
+
+@dataclass
+class Image:
+    config: Blob
+    layers: List[Blob] = field(default_factory=list)
+
+    @property
+    def manifest(self) -> bytes:
+        return canonical_json(
+            {
+                "schemaVersion": 2,
+                "mediaType": MANIFEST_MEDIA_TYPE,
+                "config": self.config.descriptor(),
+                "layers": [layer.descriptor() for layer in self.layers],
+            }
+        )
+
+    @property
+    def digest(self) -> str:
+        return sha256_digest(self.manifest)
+
+    @property
+    def blobs(self) -> List[Blob]:
+        return self.layers + [self.config]
+
+    def cleanup(self):
+        """Removes the temporary files holding the layers."""
+        for layer in self.layers:
+            if layer.path is not None and os.path.exists(layer.path):
+                os.remove(layer.path)
+
+
+def collect_files(context: str, static_files: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """Returns the files to add to an image, as (path in the image, path on
+    disk), sorted by their path in the image. Sources are relative to the
+    context; as with ADD, a source directory copies its contents into the
+    destination, and a destination ending in `/` is a directory."""
+    files: Dict[str, str] = {}
+    for src, dst in static_files:
+        source = os.path.join(context, src)
+        if not os.path.exists(source):
+            raise ValueError("{} does not exist in context {}".format(src, context))
+
+        dst = "/" + dst.lstrip("/")
+        if os.path.isdir(source):
+            for root, dirs, names in os.walk(source):
+                dirs.sort()
+                for name in names + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+                    full = os.path.join(root, name)
+                    relative = os.path.relpath(full, source).replace(os.sep, "/")
+                    files[os.path.normpath(os.path.join(dst, relative))] = full
+        elif dst.endswith("/"):
+            files[dst + os.path.basename(source)] = source
+        else:
+            files[os.path.normpath(dst)] = source
+
+    return sorted(files.items())
+
+
+class HashingWriter:
+    """Writes to a file object, hashing and counting what is written."""
+
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.sha.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    @property
+    def digest(self) -> str:
+        return "sha256:" + self.sha.hexdigest()
+
+
+def tar_info(name: str, st: os.stat_result, mtime: int) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    # Permissions depend on the umask of the checkout; only the executable
+    # bit is kept.
+    info.mode = 0o755 if st.st_mode & 0o111 else 0o644
+    return info
+
+
+def write_layer(files: List[Tuple[str, str]], fileobj: BinaryIO) -> Tuple[str, str, int]:
+    """Writes the files as a gzipped tar into fileobj. Returns the digest of
+    the uncompressed tar (its diff_id), and the digest and size of the
+    compressed layer."""
+    mtime = source_date_epoch()
+    compressed = HashingWriter(fileobj)
+    with gzip.GzipFile(filename="", mode="wb", fileobj=compressed, mtime=0) as gz:
+        uncompressed = HashingWriter(gz)
+        with tarfile.open(fileobj=uncompressed, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            directories = set()
+            for name, source in files:
+                parts = name.strip("/").split("/")
+                # Parent directories are added before the files inside them.
+                for i in range(1, len(parts)):
+                    directory = "/".join(parts[:i])
+                    if directory not in directories:
+                        directories.add(directory)
+                        info = tarfile.TarInfo(directory)
+                        info.type = tarfile.DIRTYPE
+                        info.mode = 0o755
+                        info.mtime = mtime
+                        tar.addfile(info)
+
+                st = os.lstat(source)
+                info = tar_info("/".join(parts), st, mtime)
+                if os.path.islink(source):
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = os.readlink(source)
+                    info.mode = 0o777
+                    tar.addfile(info)
+                else:
+                    info.size = st.st_size
+                    with open(source, "rb") as f:
+                        tar.addfile(info, f)
+
+    return uncompressed.digest, compressed.digest, compressed.size
+
+
+def parse_platform(platform: Optional[str]) -> Dict[str, str]:
+    os_name, _, architecture = (platform or "linux/amd64").partition("/")
+    architecture, _, variant = architecture.partition("/")
+    result = {"os": os_name, "architecture": architecture or "amd64"}
+    if variant:
+        result["variant"] = variant
+    return result
+
+
+def build_image(
+    files: List[Tuple[str, str]],
+    labels: Optional[Dict[str, str]] = None,
+    platform: Optional[str] = None,
+    directory: Optional[str] = None,
+) -> Image:
+    """Builds an image with the files in a single layer. The layer is kept in
+    a temporary file in directory, until Image.cleanup is called."""
+    fd, path = tempfile.mkstemp(dir=directory, prefix="sonar-layer-")
+    with os.fdopen(fd, "wb") as f:
+        diff_id, digest, size = write_layer(files, f)
+    layer = Blob(LAYER_MEDIA_TYPE, digest, size, path=path)
+
+    config = dict(parse_platform(platform))
+    config["config"] = {"Labels": dict(labels)} if labels else {}
+    config["rootfs"] = {"type": "layers", "diff_ids": [diff_id]}
+    config["history"] = [{"created_by": "sonar context_image"}]
+    config_data = canonical_json(config)
+
+    return Image(
+        config=Blob(CONFIG_MEDIA_TYPE, sha256_digest(config_data), len(config_data), data=config_data),
+        layers=[layer],
+    )
+
+
+def add_metadata(
+    manifest: Dict,
+    config: bytes,
+    build_id: str,
+    labels: Optional[Dict[str, str]] = None,
+    annotations: Optional[Dict[str, str]] = None,
+) -> Tuple[bytes, Optional[Blob]]:
+    """Returns an OCI manifest of the same layers as manifest, with the
+    annotations and build_id, and the new config holding the labels (None if
+    there are no labels, and the config is kept)."""
+    if manifest.get("mediaType", MANIFEST_MEDIA_TYPE) not in (
+        MANIFEST_MEDIA_TYPE,
+        "application/vnd.docker.distribution.manifest.v2+json",
+    ):
+        raise ValueError("Can not add metadata to a {}".format(manifest.get("mediaType")))
+
+    def oci_descriptor(descriptor: Dict) -> Dict:
+        descriptor = dict(descriptor)
+        media_type = descriptor["mediaType"]
+        descriptor["mediaType"] = OCI_MEDIA_TYPES.get(media_type, media_type)
+        return descriptor
+
+    config_blob = None
+    config_descriptor = oci_descriptor(manifest["config"])
+    if labels:
+        document = json.loads(config)
+        document.setdefault("config", {})
+        document["config"]["Labels"] = dict(document["config"].get("Labels") or {}, **labels)
+        data = canonical_json(document)
+        config_blob = Blob(CONFIG_MEDIA_TYPE, sha256_digest(data), len(data), data=data)
+        config_descriptor = config_blob.descriptor()
+
+    result = {
+        "schemaVersion": 2,
+        "mediaType": MANIFEST_MEDIA_TYPE,
+        "config": config_descriptor,
+        "layers": [oci_descriptor(layer) for layer in manifest["layers"]],
+        "annotations": dict(manifest.get("annotations", {}), **(annotations or {})),
+    }
+    result["annotations"][BUILD_ID_ANNOTATION] = build_id
+
+    return canonical_json(result), config_blob
+
+
+def write_blob(directory: str, blob: Blob):
+    algorithm, _, hexdigest = blob.digest.partition(":")
+    path = os.path.join(directory, "blobs", algorithm, hexdigest)
+    if os.path.exists(path):
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with blob.open() as src, open(tmp, "wb") as dst:
+        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+            dst.write(chunk)
+    os.replace(tmp, path)
+
+
+def write_layout(image: Image, directory: str, tag: str):
+    """Writes the image into an OCI image layout, as tag. Blobs already in the
+    layout are not written again, and other images of the layout are kept."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "oci-layout"), "w") as f:
+        json.dump({"imageLayoutVersion": "1.0.0"}, f)
+
+    for blob in image.blobs:
+        write_blob(directory, blob)
+
+    manifest = image.manifest
+    write_blob(
+        directory, Blob(MANIFEST_MEDIA_TYPE, image.digest, len(manifest), data=manifest)
+    )
+
+    index_path = os.path.join(directory, "index.json")
+    index = {"schemaVersion": 2, "mediaType": INDEX_MEDIA_TYPE, "manifests": []}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    index["manifests"] = [
+        m
+        for m in index.get("manifests", [])
+        if m.get("annotations", {}).get(REF_NAME_ANNOTATION) != tag
+    ]
+    descriptor = {
+        "mediaType": MANIFEST_MEDIA_TYPE,
+        "digest": image.digest,
+        "size": len(manifest),
+        "annotations": {REF_NAME_ANNOTATION: tag},
+    }
+    index["manifests"].append(descriptor)
+
+    with open(index_path, "w") as f:
+        json.dump(index, f, indent=2)
@@ -0,0 +1,407 @@
+"""
+sonar/plan.py
+
+Validates an image from the inventory and compiles it into a Plan.
+
+A Plan holds the concrete stages that a run would execute, with every
+variable interpolation that does not depend on the run already resolved,
+the dependencies between stages and the targets each stage produces.
+Compiling a Plan finds every error in the inventory without running any
+stage, and a serialized Plan can be run later without parsing the inventory
+or resolving its variables again.
+"""
+
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from sonar import graph, history, workspace
+from sonar.matrix import expand, matrix_errors
+
+from sonar.sonar import (
+    Context,
+    apply_build_options,
+    apply_inventory_settings,
+    build_context,
+    expand_template_variants,
+    find_docker_context,
+    find_template_context,
+    find_functions_to_interpolate,
+    find_variable_replacement,
+    find_variables_to_interpolate,
+    find_variables_to_interpolate_from_stage,
+    run_image,
+    should_include_stage,
+    should_skip_stage,
+    volatile_buildarg_errors,
+    volatile_metadata_errors,
+)
+from sonar.tasks import get_task, is_supported
+
+SUPPORTED_FUNCTIONS = tuple(workspace.FUNCTIONS)
+
+# These values are only known when the run starts.
+RUNTIME_VARIABLES = ("version_id",)
+
+# Top-level keys of the inventory, other than vars, that a run reads.
+INVENTORY_SETTINGS = ("builders", "rate_limits", "max_size_increase", "largest_files")
+
+class InventoryValidationError(ValueError):
+    """Raised when an image in the inventory has errors."""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+@dataclass
+class PlannedStage:
+    name: str
+    task_type: str
+
+    # Names of the stages whose outputs are consumed by this one.
+    depends_on: List[str] = field(default_factory=list)
+
+    # Values of the variables interpolated in this stage.
+    variables: Dict[str, str] = field(default_factory=dict)
+
+    # What this stage produces: images (registry:tag) or Dockerfiles.
+    targets: List[str] = field(default_factory=list)
+
+    # The stage, as it will be run.
+    stage: Dict[str, Any] = field(default_factory=dict)
+
+    # Resources the stage holds while it runs, from its task type.
+    resources: Dict[str, int] = field(default_factory=dict)
+
+    # Hash of the stage in the inventory, which its durations are recorded by.
+    input_hash: str = ""
+
+
+@dataclass
+class Plan:
+    image: Dict[str, Any]
+    parameters: Dict[str, str]
+    inventory_vars: Dict[str, Any] = field(default_factory=dict)
+    stages: List[PlannedStage] = field(default_factory=list)
+    # The INVENTORY_SETTINGS of the inventory.
+    inventory_settings: Dict[str, Any] = field(default_factory=dict)
+
+    def dag(self) -> Dict[str, List[str]]:
+        """Returns the dependencies of each stage."""
+        return {s.name: s.depends_on for s in self.stages}
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), indent=2)
+
+    @classmethod
+    def from_json(cls, data: str) -> "Plan":
+        plan = json.loads(data)
+        plan["stages"] = [PlannedStage(**s) for s in plan["stages"]]
+        return cls(**plan)
+
+
+class Resolver:
+    """Interpolates the variables of a stage that are known before the run,
+    collecting every error instead of stopping at the first one."""
+
+    def __init__(self, ctx: Context, stage: Dict, previous_stages: List[str]):
+        self.ctx = ctx
+        self.stage = stage
+        self.previous_stages = previous_stages
+        self.errors: List[str] = []
+        self.variables: Dict[str, str] = {}
+        self.depends_on: List[str] = []
+
+    def error(self, message: str):
+        self.errors.append("stage {}: {}".format(self.stage["name"], message))
+
+    def resolve(self, value: Any, stage: Optional[Dict] = None) -> Any:
+        if isinstance(value, dict):
+            return {k: self.resolve(v, stage) for k, v in value.items()}
+
+        if isinstance(value, list):
+            return [self.resolve(v, stage) for v in value]
+
+        if not isinstance(value, str):
+            return value
+
+        return self.resolve_string(value, stage or self.stage)
+
+    def resolve_string(self, string: str, stage: Dict) -> str:
+        for variable in find_variables_to_interpolate(string):
+            if variable in RUNTIME_VARIABLES:
+                continue
+
+            try:
+                replacement = find_variable_replacement(self.ctx, variable, stage)
+            except KeyError:
+                self.error("input {} has not been provided".format(variable))
+                continue
+
+            if replacement is None:
+                self.error("no value for variable {}".format(variable))
+                continue
+
+            if not isinstance(replacement, str):
+                self.error("variable {} is not a string".format(variable))
+                continue
+
+            self.variables[variable] = replacement
+            string = string.replace("$(inputs.params.{})".format(variable), replacement)
+
+        for stage_name, _, _ in find_variables_to_interpolate_from_stage(string):
+            if stage_name not in self.previous_stages:
+                self.error(
+                    "reference to stage {} which does not run before".format(stage_name)
+                )
+            elif stage_name not in self.depends_on:
+                self.depends_on.append(stage_name)
+
+        for name in find_functions_to_interpolate(string):
+            if name not in SUPPORTED_FUNCTIONS:
+                self.error("unknown function {}".format(name))
+
+        return string
+
+
+def find_targets(stage: Dict) -> List[str]:
+    """Returns what a resolved stage produces."""
+    if stage["task_type"] == "tag_image":
+        return ["{}:{}".format(o["registry"], o["tag"]) for o in stage["destination"]]
+
+    targets = []
+    for output in stage.get("output", []):
+        if "registry" in output and "tag" in output:
+            targets.append("{}:{}".format(output["registry"], output["tag"]))
+        elif "dockerfile" in output:
+            targets.append(output["dockerfile"])
+        elif "oci_layout" in output:
+            targets.append("{}:{}".format(output["oci_layout"], output.get("tag", "latest")))
+
+    return targets
+
+
+def plan_stage(ctx: Context, resolver: Resolver) -> Optional[Dict]:
+    """Validates the stage in the resolver and returns it resolved."""
+    stage = resolver.stage
+    task_type = stage.get("task_type")
+    if not is_supported(task_type):
+        resolver.error("task_type {} not supported".format(task_type))
+        return None
+
+    for key in get_task(task_type).required_keys:
+        if key not in stage:
+            resolver.error("missing {}".format(key))
+    if len(resolver.errors) > 0:
+        return None
+
+    if task_type == "docker_build":
+        try:
+            find_docker_context(ctx)
+        except ValueError as e:
+            resolver.error(str(e))
+        for error in volatile_metadata_errors(stage):
+            resolver.error(error)
+    elif task_type == "dockerfile_template":
+        try:
+            find_template_context(ctx)
+        except ValueError as e:
+            resolver.error(str(e))
+
+    resolved = {}
+    for key, value in stage.items():
+        if key == "vars":
+            resolved[key] = value
+        elif key == "output" and task_type == "dockerfile_template":
+            # Outputs of template variants depend on each variant's values.
+            for variant in expand_template_variants(stage):
+                resolver.resolve(value, variant)
+            resolved[key] = value
+        else:
+            resolved[key] = resolver.resolve(value)
+
+    # Dockerfiles known before running are checked for volatile buildargs.
+    dockerfile = resolved.get("dockerfile")
+    if task_type == "docker_build" and isinstance(dockerfile, str) and os.path.isfile(dockerfile):
+        with open(dockerfile) as f:
+            for error in volatile_buildarg_errors(stage, f.read()):
+                resolver.error(error)
+
+    return resolved
+
+
+def iter_valid_stages(ctx: Context, errors: List[str]) -> Iterator[Dict]:
+    """Yields the concrete stages of the image, like iter_stages, adding the
+    stages that can not be expanded to errors instead."""
+    for stage in ctx.image.get("stages", []):
+        if "name" not in stage:
+            errors.append("stage without a name in image {}".format(ctx.image_name))
+            continue
+
+        stage_errors = matrix_errors(stage)
+        if len(stage_errors) > 0:
+            errors.extend("stage {}: {}".format(stage["name"], e) for e in stage_errors)
+            continue
+
+        yield from expand(stage, ctx.skip_tags, ctx.include_tags)
+
+
+def compile_plan(
+    image_name: str,
+    skip_tags: Union[str, List[str]],
+    include_tags: Union[str, List[str]],
+    build_args: Optional[Dict[str, str]] = None,
+    inventory: Optional[str] = None,
+) -> Plan:
+    """
+    Validates an image and returns the Plan to build it. Raises an
+    InventoryValidationError with every error found.
+    """
+    ctx = build_context(image_name, skip_tags, include_tags, build_args, inventory)
+
+    errors = []
+    planned = []
+    previous_stages = []
+    for stage in iter_valid_stages(ctx, errors):
+        ctx.stage = stage
+
+        if should_skip_stage(stage, ctx.skip_tags) or not should_include_stage(
+            stage, ctx.include_tags
+        ):
+            continue
+
+        resolver = Resolver(ctx, stage, previous_stages)
+        resolved = plan_stage(ctx, resolver)
+        errors.extend(resolver.errors)
+        if len(resolver.errors) == 0:
+            planned.append(
+                PlannedStage(
+                    name=stage["name"],
+                    task_type=stage["task_type"],
+                    depends_on=resolver.depends_on,
+                    variables=resolver.variables,
+                    targets=find_targets(resolved),
+                    stage=resolved,
+                    resources=dict(get_task(stage["task_type"]).resources),
+                    input_hash=history.input_hash(stage),
+                )
+            )
+
+        previous_stages.append(stage["name"])
+
+    if len(errors) > 0:
+        raise InventoryValidationError(errors)
+
+    image = {k: v for k, v in ctx.image.items() if k != "stages"}
+    image["stages"] = [s.stage for s in planned]
+
+    return Plan(
+        image=image,
+        parameters=ctx.parameters,
+        inventory_vars=ctx.inventory.get("vars", {}),
+        stages=planned,
+        inventory_settings={k: v for k, v in ctx.inventory.items() if k in INVENTORY_SETTINGS},
+    )
+
+
+def run_plan(plan: Plan, build_options: Optional[Dict[str, str]] = None):
+    """
+    Runs a compiled Plan. The result is the same as `process_image`.
+    """
+    ctx = Context(
+        inventory=dict(plan.inventory_settings, vars=plan.inventory_vars),
+        image=plan.image,
+        parameters=dict(plan.parameters),
+        skip_tags=[],
+        include_tags=[],
+    )
+
+    apply_build_options(ctx, build_options)
+    apply_inventory_settings(ctx)
+
+    return run_image(ctx)
+
+
+@dataclass
+class Estimate:
+    # Expected wall-clock time of the run, in seconds.
+    duration: float
+
+    # The chain of images that takes the longest.
+    critical_path: List[str]
+
+    # Expected duration of every stage, as (image, stage, seconds), longest
+    # first; stages that never ran are not included.
+    stages: List[Tuple[str, str, float]] = field(default_factory=list)
+
+    # Stages that never ran, as image/stage.
+    unknown: List[str] = field(default_factory=list)
+
+    def bottlenecks(self, count: int = 5) -> List[Tuple[str, str, float]]:
+        """Returns the longest stages of the images in the critical path."""
+        return [s for s in self.stages if s[0] in self.critical_path][:count]
+
+
+def estimate_plans(
+    plans: Dict[str, Plan],
+    dependencies: Dict[str, List[str]],
+    max_workers: int = graph.MAX_CONCURRENT_IMAGES,
+) -> Estimate:
+    """
+    Estimates how long running the plans would take, from the durations of
+    their stages in previous runs. Stages that never ran count as taking no
+    time.
+    """
+    durations = history.get_history()
+    costs = {}
+    stages = []
+    unknown = []
+    for name, plan in plans.items():
+        costs[name] = 0.0
+        for stage in plan.stages:
+            estimate = durations.estimate(name, stage.name, history.STAGE, stage.input_hash)
+            if estimate is None:
+                unknown.append("{}/{}".format(name, stage.name))
+                continue
+
+            costs[name] += estimate
+            stages.append((name, stage.name, estimate))
+
+    return Estimate(
+        duration=graph.makespan(dependencies, costs, max_workers),
+        critical_path=graph.critical_path(dependencies, costs),
+        stages=sorted(stages, key=lambda s: -s[2]),
+        unknown=unknown,
+    )
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return "{}h{:02d}m{:02d}s".format(hours, minutes, seconds)
+    if minutes > 0:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+
+def format_estimate(estimate: Estimate) -> str:
+    lines = [
+        "Expected duration: {}".format(format_duration(estimate.duration)),
+        "Critical path: {}".format(" -> ".join(estimate.critical_path)),
+    ]
+
+    bottlenecks = estimate.bottlenecks()
+    if len(bottlenecks) > 0:
+        lines.append("Bottleneck stages:")
+        width = max(len("{}/{}".format(i, s)) for i, s, _ in bottlenecks)
+        for image, stage, duration in bottlenecks:
+            name = "{}/{}".format(image, stage)
+            lines.append("  {}  {}".format(name.ljust(width), format_duration(duration)))
+
+    if len(estimate.unknown) > 0:
+        lines.append("No history for: {}".format(", ".join(estimate.unknown)))
+
+    return "\n".join(lines)
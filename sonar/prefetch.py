@@ -0,0 +1,151 @@
+"""
+sonar/prefetch.py
+
+Finds the base images of Dockerfiles, and pulls images concurrently.
+
+Pulling the images every stage needs before the stages start lets stages
+sharing a base image pull it only once, instead of each build pulling it
+on its own.
+"""
+
+import contextvars
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+MAX_CONCURRENT_PULLS = 4
+
+ARG_REFERENCE = re.compile(r"\$(?:\{(\w+)(?::?-([^}]*))?\}|(\w+))")
+
+
+def substitute_args(value: str, args: Dict[str, str]) -> str:
+    """Replaces `$VAR`, `${VAR}` and `${VAR:-default}` with their values in
+    args. Unknown variables are left as they are."""
+
+    def replace(match):
+        name = match.group(1) or match.group(3)
+        if name in args:
+            return args[name]
+        if match.group(2) is not None:
+            return match.group(2)
+        return match.group(0)
+
+    return ARG_REFERENCE.sub(replace, value)
+
+
+def numbered_instructions(dockerfile: str) -> Iterable[Tuple[int, str, str]]:
+    """Yields the instructions of a Dockerfile, with the line they start at
+    (from 1) and their arguments, with continuation lines joined."""
+    current = ""
+    start = 0
+    for number, line in enumerate(dockerfile.splitlines(), 1):
+        stripped = line.strip()
+        if stripped.startswith("#") and current == "":
+            continue
+        if current == "":
+            start = number
+
+        if stripped.endswith("\\"):
+            current += stripped[:-1] + " "
+            continue
+
+        current += stripped
+        if current != "":
+            instruction, _, arguments = current.partition(" ")
+            yield start, instruction.upper(), arguments.strip()
+        current = ""
+
+
+def dockerfile_instructions(dockerfile: str) -> Iterable[Tuple[str, str]]:
+    """Yields the instructions of a Dockerfile and their arguments, with
+    continuation lines joined."""
+    for _, instruction, arguments in numbered_instructions(dockerfile):
+        yield instruction, arguments
+
+
+def find_base_images(dockerfile: str, buildargs: Optional[Dict[str, str]] = None) -> List[str]:
+    """Returns the images a Dockerfile builds from, in order. Build stages
+    built from a previous stage, `scratch` and images that depend on unknown
+    build args are not included."""
+    args = {}
+    images = []
+    stages = set()
+    seen_from = False
+
+    for instruction, arguments in dockerfile_instructions(dockerfile):
+        if instruction == "ARG" and not seen_from:
+            # Only the ARGs before the first FROM apply to FROM lines.
+            name, _, default = arguments.partition("=")
+            name = name.strip()
+            if buildargs and name in buildargs:
+                args[name] = buildargs[name]
+            elif default != "":
+                args[name] = substitute_args(default.strip().strip('"'), args)
+        elif instruction == "FROM":
+            seen_from = True
+            words = [w for w in arguments.split() if not w.startswith("--")]
+            if len(words) == 0:
+                continue
+
+            image = substitute_args(words[0], args)
+            if len(words) >= 3 and words[1].upper() == "AS":
+                stages.add(words[2].lower())
+
+            if image.lower() in stages or image == "scratch" or "$" in image:
+                continue
+            if image not in images:
+                images.append(image)
+
+    return images
+
+
+def split_image(image: str) -> Tuple[str, str]:
+    """Splits an image reference into its repository and its tag (or digest)."""
+    if "@" in image:
+        repository, digest = image.split("@", 1)
+        return repository, digest
+
+    repository, _, tag = image.rpartition(":")
+    if repository == "" or "/" in tag:
+        # There is no tag, the last `:` belonged to the registry's port.
+        return image, "latest"
+
+    return repository, tag
+
+
+@dataclass
+class PullResult:
+    image: str
+    duration: float
+    pulled: Any = None
+    error: Optional[Exception] = None
+
+
+def pull_images(
+    images: List[str],
+    pull: Callable[[str, str], Any],
+    max_workers: int = MAX_CONCURRENT_PULLS,
+) -> List[PullResult]:
+    """Pulls every image with `pull(repository, tag)`, concurrently. Errors
+    are returned with the result of the image, instead of being raised."""
+
+    def pull_one(image: str) -> PullResult:
+        start = time.monotonic()
+        try:
+            pulled = pull(*split_image(image))
+        except Exception as e:  # pylint: disable=W0703
+            return PullResult(image, time.monotonic() - start, error=e)
+
+        return PullResult(image, time.monotonic() - start, pulled=pulled)
+
+    if len(images) == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, pull_one, image)
+            for image in images
+        ]
+        return [f.result() for f in futures]
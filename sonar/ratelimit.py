@@ -0,0 +1,246 @@
+"""
+sonar/ratelimit.py
+
+Limits the rate and concurrency of the calls Sonar makes to each registry
+and AWS endpoint.
+
+Every host has a token bucket, allowing `rate` calls per second with bursts
+of up to `burst`, and an adaptive concurrency limit. The concurrency limit
+grows by one for every `limit` calls that succeed, and halves when a call
+is throttled (a 429, a 5xx, or an AWS throttling error), never going below
+`min_concurrency` or above `max_concurrency` (additive increase,
+multiplicative decrease). Limits are configured by host in the inventory:
+
+    rate_limits:
+      registry-1.docker.io:
+        rate: 2
+        burst: 10
+        max_concurrency: 4
+      quay.io:
+        max_concurrency: 16
+"""
+
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from sonar import metrics
+
+DEFAULT_LIMITS = {
+    # Calls per second, and the most calls allowed at once. No rate means
+    # calls are not rate limited.
+    "rate": None,
+    "burst": None,
+    "min_concurrency": 1,
+    "max_concurrency": 16,
+}
+
+# Throttled calls halve the limit at most once in this many seconds, as the
+# calls that were already running when the first one was throttled fail too.
+DECREASE_INTERVAL = 1.0
+
+# Status codes only count when they are reported as one, so numbers like
+# sizes, line numbers or ids in an error do not lower the limit.
+THROTTLED = re.compile(
+    r"\b(?:status(?: code)?|HTTP(?:/[\d.]+)?)[: ]+(?:429|50[0-4])\b"
+    r"|\b(?:429|50[0-4]) (?:internal server error|bad gateway|gateway time-?out)"
+    r"|too ?many ?requests|throttl|rate exceeded|slow ?down"
+    r"|requestlimitexceeded|service unavailable",
+    re.IGNORECASE,
+)
+
+CONCURRENCY_LIMIT = metrics.REGISTRY.gauge(
+    "sonar_rate_limit_concurrency",
+    "Calls allowed to run at the same time, by host.",
+    ["host"],
+)
+IN_FLIGHT = metrics.REGISTRY.gauge(
+    "sonar_rate_limit_in_flight", "Calls running, by host.", ["host"]
+)
+THROTTLED_CALLS = metrics.REGISTRY.counter(
+    "sonar_rate_limit_throttled_total",
+    "Calls throttled by the host, by host and operation.",
+    ["host", "operation"],
+)
+WAIT_DURATION = metrics.REGISTRY.histogram(
+    "sonar_rate_limit_wait_seconds",
+    "Time calls waited for the rate and concurrency limits, by host.",
+    ["host"],
+)
+
+
+def is_throttled(error: object) -> bool:
+    """Checks if an error, or the message of a failed command, means the
+    host is throttling calls or overloaded."""
+    return THROTTLED.search(str(error)) is not None
+
+
+class TokenBucket:
+    """Allows rate operations per second on average, and bursts of up to
+    burst operations."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        """Takes a token, if there is one."""
+        return self.reserve() == 0
+
+    def reserve(self, wait: bool = False) -> float:
+        """Returns how long to wait until there is a token, or 0 after taking
+        one. With wait, the token is taken anyway, and is paid for by
+        waiting the time returned."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+
+            delay = (1 - self.tokens) / self.rate
+            if wait:
+                self.tokens -= 1
+            return delay
+
+    def wait(self):
+        """Blocks until a token is taken."""
+        delay = self.reserve(wait=True)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AdaptiveLimit:
+    """A concurrency limit that grows while calls succeed and halves when
+    they are throttled."""
+
+    def __init__(self, host: str, min_concurrency: int = 1, max_concurrency: int = 16):
+        if not 1 <= min_concurrency <= max_concurrency:
+            raise ValueError(
+                "{}: concurrency limits need 1 <= min_concurrency <= max_concurrency".format(host)
+            )
+
+        self.host = host
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        CONCURRENCY_LIMIT.set(int(self.limit), host=host)
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            IN_FLIGHT.set(self.in_flight, host=self.host)
+
+    def release(self, throttled: Optional[bool]):
+        """Ends a call: a success if throttled is False, a throttled call if
+        it is True, and neither if it is None (the call failed otherwise)."""
+        with self.condition:
+            self.in_flight -= 1
+            if throttled is False:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            elif throttled:
+                now = time.monotonic()
+                if now - self.last_decrease >= DECREASE_INTERVAL:
+                    self.last_decrease = now
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+
+            CONCURRENCY_LIMIT.set(int(self.limit), host=self.host)
+            IN_FLIGHT.set(self.in_flight, host=self.host)
+            self.condition.notify_all()
+
+
+class HostLimiter:
+    def __init__(self, host: str, limits: Dict):
+        unknown = set(limits) - set(DEFAULT_LIMITS)
+        if len(unknown) > 0:
+            raise ValueError("{}: unknown rate limits {}".format(host, sorted(unknown)))
+
+        limits = dict(DEFAULT_LIMITS, **limits)
+        self.host = host
+        self.bucket = None
+        if limits["rate"] is not None:
+            self.bucket = TokenBucket(float(limits["rate"]), limits["burst"])
+        self.concurrency = AdaptiveLimit(
+            host, int(limits["min_concurrency"]), int(limits["max_concurrency"])
+        )
+
+
+class Call:
+    """A call holding a slot of a host. Calls that do not raise, but fail,
+    report it with `throttled()` or `failed()`."""
+
+    def __init__(self):
+        self.outcome: Optional[bool] = False
+
+    def throttled(self):
+        self.outcome = True
+
+    def failed(self):
+        self.outcome = None
+
+
+_limits: Dict[str, Dict] = {}
+_limiters: Dict[str, HostLimiter] = {}
+_lock = threading.Lock()
+
+
+def configure(limits: Dict[str, Dict]):
+    """Sets the limits of hosts. Hosts whose limits change start again with
+    the new limits."""
+    with _lock:
+        for host, host_limits in limits.items():
+            host_limits = host_limits or {}
+            if _limits.get(host) == host_limits:
+                continue
+
+            HostLimiter(host, host_limits)
+            _limits[host] = host_limits
+            _limiters.pop(host, None)
+
+
+def reset():
+    """Removes every limit and limiter."""
+    with _lock:
+        _limits.clear()
+        _limiters.clear()
+
+
+def limiter(host: str) -> HostLimiter:
+    with _lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(host, _limits.get(host, {}))
+        return _limiters[host]
+
+
+@contextmanager
+def limited(host: str, operation: str) -> Iterator[Call]:
+    """Runs the block as a call to host, once the rate and concurrency limits
+    of the host allow it. Exceptions that mean the call was throttled lower
+    the concurrency limit of the host."""
+    host_limiter = limiter(host)
+    with WAIT_DURATION.time(host=host):
+        if host_limiter.bucket is not None:
+            host_limiter.bucket.wait()
+        host_limiter.concurrency.acquire()
+
+    call = Call()
+    try:
+        yield call
+    except Exception as e:
+        call.outcome = True if is_throttled(e) else None
+        raise
+    finally:
+        if call.outcome:
+            THROTTLED_CALLS.inc(host=host, operation=operation)
+        host_limiter.concurrency.release(call.outcome)
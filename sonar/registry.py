@@ -0,0 +1,402 @@
+"""
+sonar/registry.py
+
+A client for the registry HTTP API (the OCI distribution spec), used to push
+images assembled by sonar/oci.py without a Docker daemon, and to add metadata
+to images pushed by Docker.
+
+Registries asking for a Bearer token get one from their token service, for
+the scope of each request; credentials come from the Docker configuration
+($DOCKER_CONFIG/config.json), or from a function passed to the client.
+Redirects are followed by the client, without the Authorization header when
+they lead to another host, as ECR's redirects of blobs to S3 do.
+"""
+
+import base64
+import json
+import logging
+import os
+import re
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from sonar import ratelimit, tracing
+from sonar.builders import SonarAPIError
+from sonar import oci
+from sonar.oci import MANIFEST_MEDIA_TYPE, Blob, Image
+
+DOCKER_HUB = "registry-1.docker.io"
+
+MANIFEST_ACCEPT = ", ".join(
+    [
+        MANIFEST_MEDIA_TYPE,
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+    ]
+)
+
+CHALLENGE_PARAMETER = re.compile(r'(\w+)="([^"]*)"')
+
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+
+Credentials = Optional[Tuple[str, str]]
+
+
+def split_reference(registry: str) -> Tuple[str, str]:
+    """Splits `host/repository` (what Sonar calls a registry) into the host
+    and the repository. Images without a host are in Docker Hub."""
+    host, _, repository = registry.partition("/")
+    if repository == "" or not ("." in host or ":" in host or host == "localhost"):
+        host, repository = DOCKER_HUB, registry
+        if "/" not in repository:
+            repository = "library/" + repository
+
+    return host, repository
+
+
+def docker_config_credentials(host: str) -> Credentials:
+    """Returns the username and password for host in the Docker config file.
+    Credential helpers are not supported."""
+    config_dir = os.environ.get("DOCKER_CONFIG", str(Path.home() / ".docker"))
+    try:
+        with open(os.path.join(config_dir, "config.json")) as f:
+            auths = json.load(f).get("auths", {})
+    except (OSError, ValueError):
+        return None
+
+    names = [host, "https://" + host]
+    if host == DOCKER_HUB:
+        names.append("https://index.docker.io/v1/")
+
+    for name in names:
+        auth = auths.get(name, {}).get("auth")
+        if auth:
+            username, _, password = base64.b64decode(auth).decode("utf-8").partition(":")
+            return username, password
+
+    return None
+
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+    """Returns redirects as responses, for RegistryClient to follow them."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+OPENER = urllib.request.build_opener(NoRedirects)
+
+
+class Response:
+    def __init__(self, status: int, headers, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class RegistryClient:
+    """Talks to one registry host."""
+
+    def __init__(
+        self,
+        host: str,
+        credentials: Optional[Callable[[str], Credentials]] = None,
+        insecure: Optional[bool] = None,
+    ):
+        self.host = host
+        self.credentials = credentials or docker_config_credentials
+        if insecure is None:
+            insecure = host.split(":")[0] in ("localhost", "127.0.0.1")
+        self.base_url = "{}://{}".format("http" if insecure else "https", host)
+
+        self.lock = threading.Lock()
+        # Authorization headers, by scope.
+        self.authorizations: Dict[str, str] = {}
+
+    def url(self, path: str) -> str:
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return self.base_url + path
+
+    def send(self, method: str, url: str, headers: Dict[str, str], body=None) -> Response:
+        request = urllib.request.Request(url, data=body, method=method, headers=headers)
+        host = urllib.parse.urlsplit(url).netloc
+        with ratelimit.limited(host, method) as call:
+            try:
+                with OPENER.open(request, timeout=300) as response:
+                    return Response(response.status, response.headers, response.read())
+            except urllib.error.HTTPError as e:
+                if e.code == 429 or e.code >= 500:
+                    call.throttled()
+                elif e.code not in (401, 404) and e.code not in REDIRECTS:
+                    call.failed()
+                return Response(e.code, e.headers, e.read())
+            except OSError as e:
+                raise SonarAPIError("{} {}: {}".format(method, url, e)) from e
+
+    def authorize(self, challenge: str, scope: str) -> str:
+        """Returns the Authorization header answering a WWW-Authenticate challenge."""
+        scheme, _, parameters = challenge.partition(" ")
+        credentials = self.credentials(self.host)
+
+        if scheme.lower() == "basic":
+            if credentials is None:
+                raise SonarAPIError("{} requires credentials".format(self.host))
+            token = base64.b64encode("{}:{}".format(*credentials).encode("utf-8"))
+            return "Basic " + token.decode("ascii")
+
+        parameters = dict(CHALLENGE_PARAMETER.findall(parameters))
+        query = {"service": parameters.get("service", ""), "scope": parameters.get("scope", scope)}
+        headers = {}
+        if credentials is not None:
+            token = base64.b64encode("{}:{}".format(*credentials).encode("utf-8"))
+            headers["Authorization"] = "Basic " + token.decode("ascii")
+
+        url = "{}?{}".format(parameters["realm"], urllib.parse.urlencode(query))
+        response = self.send("GET", url, headers)
+        if response.status != 200:
+            raise SonarAPIError(
+                "Could not get a token for {} from {}: {}".format(scope, url, response.status)
+            )
+
+        document = json.loads(response.body)
+        return "Bearer " + (document.get("token") or document["access_token"])
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        scope: str,
+        headers: Optional[Dict[str, str]] = None,
+        body=None,
+    ) -> Response:
+        """Sends a request, authenticating for scope if the registry asks to."""
+        headers = dict(headers or {})
+        with self.lock:
+            authorization = self.authorizations.get(scope)
+        if authorization is not None:
+            headers["Authorization"] = authorization
+
+        response = self.send(method, self.url(path), headers, body)
+        if response.status == 401 and "WWW-Authenticate" in response.headers:
+            authorization = self.authorize(response.headers["WWW-Authenticate"], scope)
+            with self.lock:
+                self.authorizations[scope] = authorization
+            headers["Authorization"] = authorization
+            if hasattr(body, "seek"):
+                body.seek(0)
+            response = self.send(method, self.url(path), headers, body)
+
+        return self.follow_redirects(method, self.url(path), headers, body, response)
+
+    def follow_redirects(
+        self, method: str, url: str, headers: Dict[str, str], body, response: Response
+    ) -> Response:
+        """Follows the redirects of a response. Registries like ECR redirect
+        blobs to presigned URLs of another host, which reject the registry's
+        Authorization header, so it is only sent to the same host."""
+        for _ in range(MAX_REDIRECTS):
+            if response.status not in REDIRECTS or "Location" not in response.headers:
+                return response
+
+            location = urllib.parse.urljoin(url, response.headers["Location"])
+            if urllib.parse.urlsplit(location).netloc != urllib.parse.urlsplit(url).netloc:
+                headers = {k: v for k, v in headers.items() if k.lower() != "authorization"}
+            if response.status == 303 and method != "HEAD":
+                method, body = "GET", None
+                headers = {k: v for k, v in headers.items() if not k.lower().startswith("content-")}
+            if hasattr(body, "seek"):
+                body.seek(0)
+
+            url = location
+            response = self.send(method, url, headers, body)
+
+        raise SonarAPIError("{} {}: too many redirects".format(method, url))
+
+    def blob_exists(self, repository: str, digest: str) -> bool:
+        scope = "repository:{}:pull".format(repository)
+        response = self.request("HEAD", "/v2/{}/blobs/{}".format(repository, digest), scope)
+        return response.status == 200
+
+    def upload_blob(self, repository: str, blob: Blob):
+        """Uploads a blob in a single request."""
+        scope = "repository:{}:pull,push".format(repository)
+        response = self.request("POST", "/v2/{}/blobs/uploads/".format(repository), scope)
+        if response.status != 202:
+            raise SonarAPIError(
+                "Could not start upload to {}/{}: {} {}".format(
+                    self.host, repository, response.status, response.body[:200]
+                )
+            )
+
+        location = response.headers["Location"]
+        separator = "&" if "?" in location else "?"
+        url = "{}{}digest={}".format(location, separator, urllib.parse.quote(blob.digest))
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(blob.size),
+        }
+        with blob.open() as f:
+            response = self.request("PUT", url, scope, headers, f)
+        if response.status != 201:
+            raise SonarAPIError(
+                "Could not upload {} to {}/{}: {} {}".format(
+                    blob.digest, self.host, repository, response.status, response.body[:200]
+                )
+            )
+
+    def manifest_digest(self, repository: str, reference: str) -> Optional[str]:
+        """Returns the digest of a manifest, or None if it does not exist."""
+        scope = "repository:{}:pull".format(repository)
+        response = self.request(
+            "HEAD",
+            "/v2/{}/manifests/{}".format(repository, reference),
+            scope,
+            {"Accept": MANIFEST_ACCEPT},
+        )
+        if response.status != 200:
+            return None
+
+        return response.headers.get("Docker-Content-Digest")
+
+    def get_manifest(self, repository: str, reference: str) -> Optional[Tuple[Dict, str]]:
+        """Returns a manifest and its digest, or None if it does not exist."""
+        scope = "repository:{}:pull".format(repository)
+        response = self.request(
+            "GET",
+            "/v2/{}/manifests/{}".format(repository, reference),
+            scope,
+            {"Accept": MANIFEST_ACCEPT},
+        )
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise SonarAPIError(
+                "Could not get manifest {}/{}:{}: {} {}".format(
+                    self.host, repository, reference, response.status, response.body[:200]
+                )
+            )
+
+        digest = response.headers.get("Docker-Content-Digest") or oci.sha256_digest(response.body)
+        return json.loads(response.body), digest
+
+    def get_blob(self, repository: str, digest: str) -> bytes:
+        scope = "repository:{}:pull".format(repository)
+        response = self.request("GET", "/v2/{}/blobs/{}".format(repository, digest), scope)
+        if response.status != 200:
+            raise SonarAPIError(
+                "Could not get {} from {}/{}: {}".format(
+                    digest, self.host, repository, response.status
+                )
+            )
+
+        return response.body
+
+    def put_manifest(self, repository: str, reference: str, manifest: bytes, media_type: str):
+        scope = "repository:{}:pull,push".format(repository)
+        response = self.request(
+            "PUT",
+            "/v2/{}/manifests/{}".format(repository, reference),
+            scope,
+            {"Content-Type": media_type},
+            manifest,
+        )
+        if response.status != 201:
+            raise SonarAPIError(
+                "Could not push manifest {}/{}:{}: {} {}".format(
+                    self.host, repository, reference, response.status, response.body[:200]
+                )
+            )
+
+
+def push_image(
+    image: Image,
+    registry: str,
+    tag: str,
+    credentials: Optional[Callable[[str], Credentials]] = None,
+) -> bool:
+    """Pushes an image as registry:tag. Blobs already in the repository are
+    not uploaded again, and the manifest is not pushed if the tag already
+    points to it. Returns False if there was nothing to push."""
+    logger = logging.getLogger(__name__)
+    host, repository = split_reference(registry)
+    client = RegistryClient(host, credentials)
+
+    with tracing.span("registry push", registry=registry, tag=tag):
+        if client.manifest_digest(repository, tag) == image.digest:
+            logger.info("%s:%s is already %s", registry, tag, image.digest)
+            return False
+
+        for blob in image.blobs:
+            if client.blob_exists(repository, blob.digest):
+                logger.debug("%s exists in %s", blob.digest, registry)
+                continue
+            client.upload_blob(repository, blob)
+
+        client.put_manifest(repository, tag, image.manifest, MANIFEST_MEDIA_TYPE)
+
+    return True
+
+
+def find_build_id(
+    registry: str,
+    tag: str,
+    credentials: Optional[Callable[[str], Credentials]] = None,
+) -> Optional[Tuple[str, str]]:
+    """Returns the id of the image registry:tag was made from by
+    add_metadata, and the digest of registry:tag. None if the tag does not
+    exist, or has no metadata added by Sonar."""
+    host, repository = split_reference(registry)
+    found = RegistryClient(host, credentials).get_manifest(repository, tag)
+    if found is None:
+        return None
+
+    manifest, digest = found
+    build_id = manifest.get("annotations", {}).get(oci.BUILD_ID_ANNOTATION)
+    if build_id is None:
+        return None
+
+    return build_id, digest
+
+
+def add_metadata(
+    registry: str,
+    tag: str,
+    build_id: str,
+    labels: Optional[Dict[str, str]] = None,
+    annotations: Optional[Dict[str, str]] = None,
+    credentials: Optional[Callable[[str], Credentials]] = None,
+) -> str:
+    """Adds labels and annotations to the image pushed as registry:tag, which
+    was built as build_id, and pushes it again as registry:tag. Only the
+    config (if there are labels) and the manifest are uploaded. Returns the
+    new digest of registry:tag."""
+    host, repository = split_reference(registry)
+    client = RegistryClient(host, credentials)
+
+    with tracing.span("registry add metadata", registry=registry, tag=tag):
+        found = client.get_manifest(repository, tag)
+        if found is None:
+            raise SonarAPIError("{}:{} was not pushed".format(registry, tag))
+
+        manifest, _ = found
+        config = b""
+        if labels:
+            config = client.get_blob(repository, manifest["config"]["digest"])
+
+        try:
+            data, config_blob = oci.add_metadata(manifest, config, build_id, labels, annotations)
+        except ValueError as e:
+            raise SonarAPIError("{}:{}: {}".format(registry, tag, e)) from e
+
+        if config_blob is not None:
+            client.upload_blob(repository, config_blob)
+        client.put_manifest(repository, tag, data, MANIFEST_MEDIA_TYPE)
+
+    return oci.sha256_digest(data)
@@ -0,0 +1,270 @@
+"""
+sonar/server.py
+
+Runs Sonar as a long-running process that accepts build requests.
+
+    sonar.py serve --port 8080
+    sonar.py serve --socket /run/sonar.sock
+
+Inventories are parsed once (and parsed again when they change on disk), Docker and AWS clients are reused between builds and
+Dockerfile templates are compiled only once. Metrics are served in the
+Prometheus format by `GET /metrics`.
+
+Builds are requested with a `POST /build` with a JSON body:
+
+    {
+        "image": "image-name",
+        "inventory": "inventory.yaml",
+        "skip_tags": "tag0,tag1",
+        "include_tags": "",
+        "parameters": {"key": "value"},
+        "options": {"pipeline": true}
+    }
+
+Only the boolean options in REQUEST_OPTIONS can be set by a request; a request
+with any other option is rejected with a 400.
+
+The response is a stream of JSON documents, one per line: one for each
+event of the build (see sonar/events.py), and a last one with the result.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+from sonar import events, metrics
+from sonar.events import Event
+from sonar.lazy import lazy_import
+from sonar.sonar import (
+    Context,
+    build_context,
+    enable_client_pool,
+    find_inventory,
+    run_image,
+)
+
+yaml = lazy_import("yaml")
+
+# Build options that clients can set, and their types. Every other attribute
+# of the Context belongs to the server.
+REQUEST_OPTIONS = {
+    "pipeline": bool,
+    "continue_on_errors": bool,
+    "fail_on_errors": bool,
+    "gc": bool,
+    "prefetch": bool,
+    "snapshot_contexts": bool,
+    "image_analytics": bool,
+    "history": bool,
+    "ecr_login": bool,
+}
+
+
+def request_options(options: Any) -> Dict[str, Any]:
+    """Returns the build options of a request, raising a ValueError if any
+    of them can not be set by clients or has the wrong type."""
+    if options is None:
+        return {}
+    if not isinstance(options, dict):
+        raise ValueError("options has to be an object")
+
+    for name, value in options.items():
+        if name not in REQUEST_OPTIONS:
+            raise ValueError(
+                "option {} can not be set, the options are {}".format(
+                    name, ", ".join(REQUEST_OPTIONS)
+                )
+            )
+        if not isinstance(value, REQUEST_OPTIONS[name]):
+            raise ValueError(
+                "option {} has to be a {}".format(name, REQUEST_OPTIONS[name].__name__)
+            )
+
+    return dict(options)
+
+
+class InventoryCache:
+    """Keeps parsed inventories in memory."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inventories: Dict[str, Tuple[int, Dict]] = {}
+
+    def get(self, path: str) -> Dict:
+        """Returns the inventory in path."""
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+
+        with self.lock:
+            cached = self.inventories.get(path)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, find_inventory(path))
+                self.inventories[path] = cached
+
+        return cached[1]
+
+
+class Server:
+    """Holds the warm state shared by every build."""
+
+    def __init__(self, max_concurrency: int = 4):
+        self.inventories = InventoryCache()
+        self.builds = threading.BoundedSemaphore(max_concurrency)
+        enable_client_pool()
+
+    def build_context(self, request: Dict[str, Any]) -> Context:
+        options = request_options(request.get("options"))
+        inventory = self.inventories.get(request.get("inventory", "inventory.yaml"))
+
+        return build_context(
+            request["image"],
+            request.get("skip_tags"),
+            request.get("include_tags"),
+            dict(request.get("parameters", {})),
+            inventory,
+            options,
+        )
+
+    def build(self, request: Dict[str, Any], ctx: Optional[Context] = None) -> Any:
+        """Runs a build, waiting for a free slot if too many are running."""
+        if ctx is None:
+            ctx = self.build_context(request)
+
+        with self.builds:
+            return run_image(ctx)
+
+
+def to_json_line(document: Dict[str, Any]) -> bytes:
+    return (json.dumps(document, default=str) + "\n").encode("utf-8")
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = "sonar"
+
+    @property
+    def sonar(self) -> Server:
+        return self.server.sonar
+
+    def address_string(self) -> str:
+        # Unix sockets have no client address.
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+
+        return "unix"
+
+    def send_json(self, status: int, document: Dict[str, Any]):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(to_json_line(document))
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            body = metrics.REGISTRY.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/build":
+            self.send_json(404, {"error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            ctx = self.sonar.build_context(request)
+        except (ValueError, KeyError, OSError, yaml.YAMLError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+        def stream(event: Event):
+            try:
+                self.wfile.write((event.to_json() + "\n").encode("utf-8"))
+                self.wfile.flush()
+            except OSError:
+                # The client went away; the build finishes without streaming.
+                events.detach(ctx, stream)
+
+        ctx.event_listeners.append(stream)
+
+        try:
+            output = self.sonar.build(request, ctx)
+            result = {"result": "success", "output": output}
+        except Exception as e:  # pylint: disable=W0703
+            logging.getLogger(__name__).exception("build failed")
+            result = {"result": "failure", "error": str(e)}
+
+        result["errors"] = [str(e) for e in ctx.captured_errors]
+        try:
+            self.wfile.write(to_json_line(result))
+        except OSError:
+            logging.getLogger(__name__).warning("client disconnected before the result")
+
+
+class HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, sonar: Server):
+        super().__init__(address, RequestHandler)
+        self.sonar = sonar
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, sonar: Server):
+        if os.path.exists(path):
+            os.remove(path)
+
+        super().__init__(path, RequestHandler)
+        self.sonar = sonar
+
+
+def make_server(
+    sonar: Server, port: Optional[int] = None, socket_path: Optional[str] = None
+) -> socketserver.BaseServer:
+    if socket_path is not None:
+        return UnixHTTPServer(socket_path, sonar)
+
+    return HTTPServer(("127.0.0.1", port or 0), sonar)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="sonar.py serve")
+    listen = parser.add_mutually_exclusive_group(required=True)
+    listen.add_argument("--port", type=int, help="Listens on 127.0.0.1:port.")
+    listen.add_argument("--socket", type=str, help="Listens on this Unix socket.")
+    parser.add_argument(
+        "--max-concurrency",
+        default=4,
+        type=int,
+        help="Number of builds that can run at the same time.",
+    )
+
+    args = parser.parse_args(argv)
+
+    server = make_server(Server(args.max_concurrency), args.port, args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
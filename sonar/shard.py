@@ -0,0 +1,196 @@
+"""
+sonar/shard.py
+
+Splits the images of a run across independent runners, and merges what
+each one of them produces.
+
+With `--shard i/n`, the selected images are split into n shards, and only
+the images of shard i (from 1 to n) are built. Images depending on each
+other always go to the same shard, so a shard never needs an image built by
+another one. Shards are balanced by the cost of their images, and every
+runner computes the same split, as long as they see the same inventory and
+costs.
+
+Each shard can write its partial pipeline output, with the images selected
+for the run and their split, which `sonar.py merge` combines into the output
+of the whole run. Merging fails if the shards split the images differently,
+or if an image was left out of every shard.
+"""
+
+import argparse
+import json
+import sys
+from typing import Dict, List, Optional, Tuple
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parses `i/n` into (i, n)."""
+    index, _, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError("shards are i/n, like 1/4, not {}".format(value)) from None
+
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError("shard {} out of range, it has to be between 1 and n".format(value))
+
+    return index, count
+
+
+def connected_images(dependencies: Dict[str, List[str]]) -> List[List[str]]:
+    """Returns the groups of images connected by their dependencies, in
+    either direction. Images keep the order of dependencies."""
+    neighbours: Dict[str, set] = {name: set() for name in dependencies}
+    for name, needed in dependencies.items():
+        for dependency in needed:
+            if dependency in neighbours:
+                neighbours[name].add(dependency)
+                neighbours[dependency].add(name)
+
+    groups = []
+    seen = set()
+    for name in dependencies:
+        if name in seen:
+            continue
+
+        group = set()
+        pending = [name]
+        while len(pending) > 0:
+            current = pending.pop()
+            if current in group:
+                continue
+            group.add(current)
+            pending.extend(neighbours[current] - group)
+
+        seen.update(group)
+        groups.append([n for n in dependencies if n in group])
+
+    return groups
+
+
+def split_shards(
+    dependencies: Dict[str, List[str]], costs: Dict[str, float], count: int
+) -> List[List[str]]:
+    """Splits the images into count shards. The most expensive groups of
+    connected images go first, each one to the shard with the lowest cost
+    so far (the first one, on ties)."""
+    groups = connected_images(dependencies)
+    group_costs = [sum(costs.get(name, 1) for name in group) for group in groups]
+    order = sorted(range(len(groups)), key=lambda i: (-group_costs[i], groups[i][0]))
+
+    shards: List[List[str]] = [[] for _ in range(count)]
+    loads = [0.0] * count
+    for i in order:
+        shard = min(range(count), key=lambda s: (loads[s], s))
+        shards[shard].extend(groups[i])
+        loads[shard] += group_costs[i]
+
+    # Images are built in the order they were selected.
+    positions = {name: i for i, name in enumerate(dependencies)}
+    return [sorted(shard, key=positions.get) for shard in shards]
+
+
+def write_partial_output(
+    path: str,
+    shard: Tuple[int, int],
+    images: List[str],
+    output: Optional[Dict],
+    selected: List[str],
+    shards: List[List[str]],
+):
+    """Writes the output of a shard, with every image selected for the run
+    and how they were split, so merge can check every shard saw the same."""
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "shard": "{}/{}".format(*shard),
+                "images": images,
+                "selected": selected,
+                "shards": shards,
+                "output": output or {},
+            },
+            f,
+            indent=2,
+            default=str,
+        )
+
+
+def check_splits(partials: List[Dict]):
+    """Fails if the shards did not select the same images, split them the
+    same way, or did not build every selected image between them."""
+    selections = {json.dumps(sorted(p.get("selected", []))) for p in partials}
+    if len(selections) > 1:
+        raise ValueError("shards selected different images")
+
+    splits = {json.dumps(p.get("shards", [])) for p in partials}
+    if len(splits) > 1:
+        raise ValueError(
+            "shards split the images differently, like with --shard-by-history and "
+            "different histories"
+        )
+
+    for partial in partials:
+        shards = partial.get("shards")
+        index = parse_shard(partial["shard"])[0]
+        if shards is not None and partial.get("images") != shards[index - 1]:
+            raise ValueError("shard {} built other images than its split".format(partial["shard"]))
+
+    built = {image for p in partials for image in p.get("images", [])}
+    missing = [image for image in partials[0].get("selected", []) if image not in built]
+    if len(missing) > 0:
+        raise ValueError("images {} are in no shard".format(missing))
+
+
+def merge_outputs(partials: List[Dict]) -> Dict:
+    """Returns the pipeline output of a run from the partial outputs of its
+    shards. Fails if shards are missing, repeated or from different splits."""
+    counts = {parse_shard(p["shard"])[1] for p in partials}
+    if len(counts) > 1:
+        raise ValueError("partial outputs are from different numbers of shards: {}".format(sorted(counts)))
+
+    indexes = [parse_shard(p["shard"])[0] for p in partials]
+    count = counts.pop() if len(counts) > 0 else 0
+    missing = sorted(set(range(1, count + 1)) - set(indexes))
+    if len(missing) > 0:
+        raise ValueError("missing the outputs of shards {}".format(missing))
+    repeated = sorted({i for i in indexes if indexes.count(i) > 1})
+    if len(repeated) > 0:
+        raise ValueError("shards {} appear more than once".format(repeated))
+    if len(partials) > 0:
+        check_splits(partials)
+
+    merged: Dict = {}
+    for partial in sorted(partials, key=lambda p: parse_shard(p["shard"])[0]):
+        for image, output in partial["output"].items():
+            if image in merged:
+                raise ValueError("image {} was built by more than one shard".format(image))
+            merged[image] = output
+
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="sonar.py merge")
+    parser.add_argument("partials", nargs="+", help="Partial outputs written by each shard.")
+    parser.add_argument("--output", "-o", help="Writes the merged output here, instead of stdout.")
+
+    args = parser.parse_args(argv)
+
+    partials = []
+    for path in args.partials:
+        with open(path) as f:
+            partials.append(json.load(f))
+
+    try:
+        merged = merge_outputs(partials)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    if args.output is None:
+        print(json.dumps(merged, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(merged, f, indent=2)
+
+    return 0
@@ -4,35 +4,53 @@ sonar/sonar.py
 Implements Sonar's main functionality.
 """
 
+import contextlib
+import contextvars
 import json
 import logging
 import os
 import re
 import subprocess
-import tempfile
+import threading
+import time
 import uuid
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
 from shutil import copyfile
-from typing import Dict, List, Optional, Tuple, Union, Any
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union, Any
+from urllib.parse import urlsplit
 from urllib.request import urlretrieve
 
-import boto3
-import click
-import yaml
-
+from sonar.builders import Backend
+from sonar.builders.pool import BuilderPool
 from sonar.builders.docker import (
     SonarAPIError,
+    SonarBuildError,
     docker_build,
     docker_pull,
     docker_push,
     docker_tag,
+    reload_docker_config,
 )
+from sonar import analytics, cleanup, credentials
+from sonar import docker_context as contexts
+from sonar import events, graph, history, metrics, oci, prefetch, ratelimit, shard, tracing
+from sonar import registry as registry_api
+from sonar.lazy import lazy_import
+from sonar.matrix import expand
+from sonar.tasks import get_task
 from sonar.template import render
+from sonar.workspace import Workspace, default_workspace
 
 from . import DCT_ENV_VARIABLE, DCT_PASSPHRASE
 
+# These are only imported by the tasks that use them.
+boto3 = lazy_import("boto3")
+click = lazy_import("click")
+yaml = lazy_import("yaml")
+
 LOGLEVEL = os.environ.get("LOGLEVEL", "WARNING").upper()
 logging.basicConfig(level=LOGLEVEL)
 
@@ -77,8 +95,9 @@ class Context:
     pipeline: bool = False
     output: dict = field(default_factory=dict)
 
-    # Generates a version_id to use if one is not present
-    stored_version_id: str = str(uuid.uuid4())
+    # Generates a version_id to use if one is not present. Images built in
+    # the same run are given the same one, so they can refer to each other.
+    stored_version_id: str = field(default_factory=lambda: str(uuid.uuid4()))
 
     # stage_outputs is a dictionary of dictionaries. First dict
     # has a key corresponding to the name of the stage, the dict
@@ -86,6 +105,65 @@ class Context:
     # stored by given stage.
     stage_outputs: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
 
+    # If set, built images are inspected for their size and layers. Stages
+    # with a `max_size_increase` are always inspected.
+    image_analytics: bool = False
+
+    # Identifies this run. Images built locally are tagged with it, so runs
+    # sharing a Docker daemon never overwrite each other's images.
+    run_id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+
+    # Local tags created by this run. If gc is set, they are removed at the
+    # end of the run, together with dangling images.
+    gc: bool = False
+    created_images: List[str] = field(default_factory=list)
+
+    # Runs the builds, pushes and cloud operations of the run.
+    backend: Backend = field(default_factory=lambda: DefaultBackend())
+
+    # Builders that docker_build stages are spread across, from the
+    # `builders` of the inventory. Without them, images are built in the
+    # default builder.
+    builders: Optional[BuilderPool] = None
+
+    # Functions called with every Event of the run, as it happens.
+    event_listeners: List[Callable[[events.Event], None]] = field(
+        default_factory=list
+    )
+
+    # If set, the Docker contexts are hashed before being built, and the
+    # manifests of the run are kept by path, so stages sharing a context
+    # hash it only once.
+    snapshot_contexts: bool = False
+    context_manifests: Dict[Tuple[str, Optional[str]], Any] = field(
+        default_factory=dict
+    )
+
+    # If set, the base images of the Dockerfiles and the tag_image sources
+    # are pulled, concurrently, before the stages run. Pulled images are
+    # kept by reference, so tag_image stages do not pull them again.
+    prefetch: bool = False
+    prefetched_images: Dict[str, Any] = field(default_factory=dict)
+
+    # Digests of the images pushed by the images this one depends on, by
+    # registry:tag. Buildargs referencing them are pinned to their digests,
+    # and they are never prefetched.
+    upstream_images: Dict[str, str] = field(default_factory=dict)
+
+    # If set, Sonar gets the authorization tokens of the ECR registries the
+    # run uses, instead of relying on `docker login`.
+    ecr_login: bool = False
+
+    # Where the temporary files of the run are written, and the results of
+    # its functions are memoized. It is created in workspace_dir when first
+    # needed, and removed when the run ends, unless it was passed in.
+    workspace: Optional[Workspace] = None
+    workspace_dir: Optional[str] = None
+
+    # If set, the durations of the stages, builds and pushes of the run are
+    # recorded in the history, to estimate the duration of future runs.
+    history: bool = False
+
     # pylint: disable=C0103
     def I(self, string):
         """
@@ -118,10 +196,14 @@ def append_output_in_context(ctx: Context, stage_name: str, values: Dict) -> Non
     ctx.stage_outputs[stage_name].append(values)
 
 
-def find_inventory(inventory: Optional[str] = None):
+def find_inventory(inventory: Union[None, str, Dict] = None):
     """
-    Finds the inventory file, and return it as a yaml object.
+    Finds the inventory file, and return it as a yaml object. An inventory
+    that has already been loaded is returned as it is.
     """
+    if isinstance(inventory, dict):
+        return inventory
+
     if inventory is None:
         inventory = "inventory.yaml"
 
@@ -130,14 +212,30 @@ def find_inventory(inventory: Optional[str] = None):
         return yaml.safe_load(f)
 
 
-def find_image(image_name: str, inventory: str):
+def find_image_names(inventory: Union[None, str, Dict]) -> List[str]:
+    """Returns the names of every image in the inventory, with the images
+    with a `matrix` expanded into their combinations."""
+    return [
+        concrete["name"]
+        for image in find_inventory(inventory)["images"]
+        for concrete in expand(image)
+    ]
+
+
+def find_image(image_name: str, inventory: Union[None, str, Dict]):
     """
-    Looks for an image of the given name in the inventory.
+    Looks for an image of the given name in the inventory. Images with a
+    `matrix` are matched against the names of each one of their combinations.
     """
     for image in find_inventory(inventory)["images"]:
         if image["name"] == image_name:
             return image
 
+        if "matrix" in image and image_name.startswith(image["name"] + "-"):
+            for concrete in expand(image):
+                if concrete["name"] == image_name:
+                    return concrete
+
     raise ValueError("Image {} not found".format(image_name))
 
 
@@ -196,14 +294,21 @@ def find_variable_replacements(
     return replacements
 
 
-def execute_interpolatable_function(name: str) -> str:
-    if name == "tempfile":
-        tmp = tempfile.mkstemp()
-        # mkstemp returns a tuple, with the second element of it being
-        # the absolute path to the file.
-        return tmp[1]
+WORKSPACE_LOCK = threading.Lock()
+
+
+def run_workspace(ctx: Context) -> Workspace:
+    """Returns the workspace of the run, creating it the first time."""
+    with WORKSPACE_LOCK:
+        if ctx.workspace is None:
+            ctx.workspace = Workspace(ctx.workspace_dir)
+        return ctx.workspace
+
 
-    raise ValueError("Only supported function is 'tempfile'")
+def execute_interpolatable_function(
+    ctx: Context, name: str, argument: Optional[str] = None
+) -> str:
+    return run_workspace(ctx).call(name, argument)
 
 
 def find_variables_to_interpolate_from_stage(string: str) -> List[Any]:
@@ -221,11 +326,18 @@ def find_variables_to_interpolate(string) -> List[str]:
     return re.findall(var_finder_re, string, re.UNICODE)
 
 
+FUNCTION_CALL = re.compile(r"\$\(functions\.(?P<name>\w+)(?:\((?P<argument>[^()]*)\))?\)")
+
+
 def find_functions_to_interpolate(string: str) -> List[Any]:
     """Find functions to be interpolated."""
-    var_finder_re = r"\$\(functions\.(?P<var>\w+)\)"
+    return [m.group("name") for m in FUNCTION_CALL.finditer(string)]
 
-    return re.findall(var_finder_re, string, re.UNICODE)
+
+def function_argument(match) -> Optional[str]:
+    """Returns the argument of a function call, without quotes, or None."""
+    argument = (match.group("argument") or "").strip().strip("'\"")
+    return argument or None
 
 
 def interpolate_vars(ctx: Context, string: str, stage=None) -> str:
@@ -249,15 +361,11 @@ def interpolate_vars(ctx: Context, string: str, stage=None) -> str:
             value
         )
 
-    functions = find_functions_to_interpolate(string)
-    for name in functions:
-        value = execute_interpolatable_function(name)
-        string = string.replace(
-            "$(functions.{})".format(name),
-            value
-        )
-
-    return string
+    # Every call is run, as tempfile returns a new file each time.
+    return FUNCTION_CALL.sub(
+        lambda m: execute_interpolatable_function(ctx, m.group("name"), function_argument(m)),
+        string,
+    )
 
 def build_add_statement(ctx, block) -> str:
     """
@@ -291,6 +399,35 @@ def find_docker_context(ctx: Context):
     raise ValueError("No context defined for image or stage")
 
 
+def snapshot_docker_context(ctx: Context, path: str, dockerfile: str):
+    """
+    Returns the manifest of a Docker context, computed once per run.
+    """
+    ignore_file = contexts.find_dockerignore(path, dockerfile)
+    key = (os.path.abspath(path), ignore_file)
+    if key in ctx.context_manifests:
+        return ctx.context_manifests[key]
+
+    with tracing.span("snapshot_context", context=path):
+        manifest = contexts.snapshot(path, dockerfile)
+    ctx.context_manifests[key] = manifest
+
+    echo(ctx, "docker-context-digest", manifest.digest)
+    if manifest.unchanged:
+        echo(ctx, "docker-context-unchanged", path)
+    if manifest.size > contexts.SIZE_WARNING:
+        echo(
+            ctx,
+            "docker-context/warning",
+            "{} has {} files and {} bytes, consider adding a .dockerignore".format(
+                path, len(manifest.files), manifest.size
+            ),
+            foreground="yellow",
+        )
+
+    return manifest
+
+
 def should_skip_stage(stage: Dict[str, str], skip_tags: List[str]) -> bool:
     """
     Checks if this stage should be skipped.
@@ -320,7 +457,8 @@ def task_dockerfile_create(ctx: Context):
     is intended to build a 'context' Dockerfile, this is, a Dockerfile that's
     not runnable but contains data.
 
-    DEPRECATED: Use dockerfile_template or docker_build instead.
+    DEPRECATED: Use dockerfile_template or docker_build instead, or
+    context_image to build the image without a Dockerfile.
     """
     output_dockerfile = ctx.I(ctx.stage["output"][0]["dockerfile"])
     fro = ctx.stage.get("from", "scratch")
@@ -334,9 +472,157 @@ def task_dockerfile_create(ctx: Context):
     echo(ctx, "dockerfile-save-location", output_dockerfile)
 
 
+def task_context_image(ctx: Context):
+    """
+    Builds a 'context' image, an image FROM scratch holding the stage's
+    `static_files`, without Docker. The image is assembled in Sonar and
+    pushed through the registry API, or written to an OCI layout directory
+    for outputs with an `oci_layout`.
+    """
+    if ctx.stage.get("from", "scratch") != "scratch":
+        raise ValueError("context_image stages can only build images FROM scratch")
+
+    try:
+        context = find_docker_context(ctx)
+    except ValueError:
+        context = "."
+
+    static_files = []
+    for block in ctx.stage["static_files"]:
+        if "from" in block:
+            raise ValueError("context_image stages can not ADD --from other images")
+        static_files.append((ctx.I(block["src"]), ctx.I(block["dst"])))
+
+    platform = ctx.image.get("platform")
+    if platform:
+        platform = ctx.I(platform)
+
+    with tracing.span("assemble_image", image=ctx.image_name, stage=ctx.stage["name"]):
+        image = oci.build_image(
+            oci.collect_files(context, static_files),
+            labels=interpolate_dict(ctx, ctx.stage.get("labels", {})),
+            platform=platform,
+        )
+
+    try:
+        echo(ctx, "image-digest", image.digest)
+        for output in ctx.stage["output"]:
+            tag = ctx.I(output.get("tag", "latest"))
+            values = {"tag": tag, "digest": image.digest}
+
+            if "oci_layout" in output:
+                layout = ctx.I(output["oci_layout"])
+                oci.write_layout(image, layout, tag)
+                echo(ctx, "oci-layout-save-location", "{}:{}".format(layout, tag))
+                values["oci_layout"] = layout
+            else:
+                output_registry = ctx.I(output["registry"])
+                echo(ctx, "docker-image-push", "{}:{}".format(output_registry, tag))
+                ctx.backend.create_repository(output_registry)
+                if not ctx.backend.push_oci_image(image, output_registry, tag):
+                    echo(ctx, "docker-image-push/unchanged", "{}:{}".format(output_registry, tag))
+                values["registry"] = output_registry
+
+            append_output_in_context(ctx, ctx.stage["name"], values)
+    finally:
+        image.cleanup()
+
+
+def registry_credentials(host: str) -> Optional[Tuple[str, str]]:
+    """
+    Returns the credentials for a registry: an authorization token for ECR
+    registries, or the ones in the Docker config file.
+    """
+    if credentials.ecr_account_region(host) is None:
+        return registry_api.docker_config_credentials(host)
+
+    return CREDENTIALS.credentials(host)
+
+
+# When set to a dictionary, AWS clients are created once and reused, for
+# long-running processes. See `enable_client_pool`.
+CLIENT_POOL: Optional[Dict[Tuple[str, Optional[str]], Any]] = None
+CLIENT_POOL_LOCK = threading.Lock()
+
+
+def enable_client_pool():
+    """Makes `aws_client` reuse clients, instead of creating new ones."""
+    global CLIENT_POOL  # pylint: disable=W0603
+    if CLIENT_POOL is None:
+        CLIENT_POOL = {}
+
+
+def aws_client(service: str, region: Optional[str] = None):
+    """Returns a boto3 client for service in region."""
+    if CLIENT_POOL is None:
+        return instrument_aws_client(boto3.client(service, region_name=region), service)
+
+    with CLIENT_POOL_LOCK:
+        if (service, region) not in CLIENT_POOL:
+            CLIENT_POOL[(service, region)] = instrument_aws_client(
+                boto3.client(service, region_name=region), service
+            )
+
+        return CLIENT_POOL[(service, region)]
+
+
+# ECR tokens, and the Docker config they are written into.
+CREDENTIALS = credentials.CredentialStore(lambda region: aws_client("ecr", region))
+
+
+def instrument_aws_client(client, service: str):
+    """Counts and times every API call made by client."""
+
+    # Calls are rate limited by the endpoint of the client.
+    endpoint = client.meta.endpoint_url
+    host = urlsplit(endpoint).netloc if isinstance(endpoint, str) else service
+
+    # pylint: disable=W0613
+    def before_call(model, context, **kwargs):
+        limited = ratelimit.limited(host, model.name)
+        context["sonar_call"] = (limited, limited.__enter__())
+        context["sonar_operation"] = model.name
+        context["sonar_start"] = time.monotonic()
+        context["sonar_span"] = tracing.start_span(
+            "aws {}.{}".format(service, model.name), service=service, operation=model.name
+        )
+
+    def finish_call(context, operation, exception=None, status=200, error=""):
+        duration = time.monotonic() - context.get("sonar_start", time.monotonic())
+        metrics.AWS_API_CALLS.inc(service=service, operation=operation)
+        metrics.AWS_API_DURATION.observe(duration, service=service, operation=operation)
+
+        if "sonar_call" in context:
+            limited, call = context.pop("sonar_call")
+            if exception is not None or status >= 400:
+                call.failed()
+            if status == 429 or status >= 500 or ratelimit.is_throttled(error or exception or ""):
+                call.throttled()
+            limited.__exit__(None, None, None)
+
+        span = context.pop("sonar_span", None)
+        if span is not None:
+            span.end(exception)
+
+    # pylint: disable=W0613
+    def after_call(model, context, http_response=None, parsed=None, **kwargs):
+        status = getattr(http_response, "status_code", 200)
+        error = (parsed or {}).get("Error", {}).get("Code", "")
+        finish_call(context, model.name, status=status, error=error)
+
+    # Connection errors and timeouts are emitted without a model or a response.
+    def after_call_error(context=None, exception=None, **kwargs):
+        context = context if context is not None else {}
+        finish_call(context, context.get("sonar_operation", "unknown"), exception=exception)
+
+    client.meta.events.register("before-call", before_call)
+    client.meta.events.register("after-call", after_call)
+    client.meta.events.register("after-call-error", after_call_error)
+    return client
+
+
 def get_secret(secret_name: str, region: str) -> str:
-    session = boto3.session.Session()
-    client = session.client(service_name="secretsmanager", region_name=region)
+    client = aws_client("secretsmanager", region)
 
     get_secret_value_response = client.get_secret_value(SecretId=secret_name)
 
@@ -344,11 +630,12 @@ def get_secret(secret_name: str, region: str) -> str:
 
 
 def get_private_key_id(registry: str, signer_name: str) -> str:
-    cp = subprocess.run(
-        ["docker", "trust", "inspect", registry],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
+    with tracing.span("docker trust inspect", registry=registry):
+        cp = subprocess.run(
+            ["docker", "trust", "inspect", registry],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
 
     if cp.returncode != 0:
         return SonarAPIError(cp.stderr)
@@ -361,6 +648,94 @@ def get_private_key_id(registry: str, signer_name: str) -> str:
             return signer["Keys"][0]["ID"] + ".key"
 
 
+# Throttled pushes are retried this many times, waiting PUSH_RETRY_DELAY
+# seconds, doubled every time, and taking a new slot of the registry's limit,
+# which the throttled push lowered.
+THROTTLED_PUSH_RETRIES = 3
+PUSH_RETRY_DELAY = 1.0
+
+
+def push_limited(ctx: Context, host: str, registry: str, tag: str) -> Any:
+    """Pushes registry:tag within the rate limits of host."""
+    for attempt in range(THROTTLED_PUSH_RETRIES + 1):
+        try:
+            with ratelimit.limited(host, "push"):
+                return ctx.backend.push(registry, tag)
+        except SonarAPIError as e:
+            if attempt == THROTTLED_PUSH_RETRIES or not ratelimit.is_throttled(e):
+                raise
+            metrics.PUSH_RETRIES.inc()
+            time.sleep(PUSH_RETRY_DELAY * 2 ** attempt)
+
+
+def push_image(
+    ctx: Context,
+    registry: str,
+    tag: str,
+    build_id: Optional[str] = None,
+    metadata: Optional[Dict[str, str]] = None,
+) -> Optional[str]:
+    """
+    Pushes an image, capturing the error if the run continues on errors.
+    Returns the digest of the pushed image, if it is known.
+
+    With build_id, the id of an image built without its volatile metadata,
+    the metadata is added to the pushed image. If registry:tag was already
+    built as the same image, it is not pushed again, and keeps the metadata
+    it was pushed with.
+    """
+    host = registry_api.split_reference(registry)[0]
+    unchanged = False
+    try:
+        if build_id is not None:
+            pushed = ctx.backend.find_build_id(registry, tag)
+            unchanged = pushed is not None and pushed[0] == build_id
+            if unchanged:
+                echo(ctx, "docker-image-push/unchanged", "{}:{}".format(registry, tag))
+                digest = pushed[1]
+
+        if not unchanged:
+            if ctx.ecr_login:
+                CREDENTIALS.refresh(host)
+            digest = push_limited(ctx, host, registry, tag)
+            if build_id is not None:
+                digest = add_volatile_metadata(ctx, registry, tag, build_id, metadata or {})
+    except SonarAPIError as e:
+        ctx.captured_errors.append(e)
+        events.emit(ctx, events.PUSH_RESULT, registry=registry, tag=tag, error=str(e))
+        if ctx.continue_on_errors:
+            echo(ctx, "docker-image-push/error", e)
+        else:
+            raise
+        return None
+
+    events.emit(ctx, events.PUSH_RESULT, registry=registry, tag=tag, unchanged=unchanged)
+    if isinstance(digest, str):
+        return digest
+    return None
+
+
+def add_volatile_metadata(
+    ctx: Context, registry: str, tag: str, build_id: str, metadata: Dict[str, str]
+) -> str:
+    """
+    Adds the volatile metadata of the stage to the pushed image, as OCI
+    annotations or, with `volatile_as: labels`, as labels of its config.
+    """
+    if ctx.stage.get("volatile_as", "annotations") == "labels":
+        return ctx.backend.add_metadata(registry, tag, build_id, labels=metadata)
+
+    return ctx.backend.add_metadata(registry, tag, build_id, annotations=metadata)
+
+
+def pull_image(ctx: Context, registry: str, tag: str):
+    """
+    Pulls an image, within the rate limits of its registry.
+    """
+    with ratelimit.limited(registry_api.split_reference(registry)[0], "pull"):
+        return ctx.backend.pull(registry, tag)
+
+
 def task_tag_image(ctx: Context):
     """
     Pulls an image from source and pushes into destination.
@@ -368,7 +743,9 @@ def task_tag_image(ctx: Context):
     registry = ctx.I(ctx.stage["source"]["registry"])
     tag = ctx.I(ctx.stage["source"]["tag"])
 
-    image = docker_pull(registry, tag)
+    image = ctx.prefetched_images.get("{}:{}".format(registry, tag))
+    if image is None:
+        image = pull_image(ctx, registry, tag)
 
     for output in ctx.stage["destination"]:
         registry = ctx.I(output["registry"])
@@ -379,51 +756,51 @@ def task_tag_image(ctx: Context):
             "{}:{}".format(registry, tag),
         )
 
-        docker_tag(image, registry, tag)
-        create_ecr_repository(registry)
-        try:
-            docker_push(registry, tag)
-        except SonarAPIError as e:
-            ctx.captured_errors.append(e)
-            if ctx.continue_on_errors:
-                echo(ctx, "docker-image-push/error", e)
-            else:
-                raise
+        ctx.backend.tag(image, registry, tag)
+        ctx.created_images.append("{}:{}".format(registry, tag))
+        ctx.backend.create_repository(registry)
+        digest = push_image(ctx, registry, tag)
 
-        append_output_in_context(ctx, ctx.stage["name"], {
-            "registry": registry,
-            "tag": tag
-        })
+        stage_output = {"registry": registry, "tag": tag}
+        if digest is not None:
+            stage_output["digest"] = digest
+        append_output_in_context(ctx, ctx.stage["name"], stage_output)
 
 
-def get_rendering_params(ctx: Context) -> Dict[str, str]:
+def get_rendering_params(ctx: Context, stage: Optional[Dict] = None) -> Dict[str, str]:
     """
     Finds rendering parameters for a template, based on the `inputs` section
     of the stage.
     """
+    if stage is None:
+        stage = ctx.stage
+
     params = {}
-    for param in ctx.stage.get("inputs", {}):
-        params[param] = find_variable_replacement(ctx, param, ctx.stage)
+    for param in stage.get("inputs", {}):
+        params[param] = find_variable_replacement(ctx, param, stage)
 
     return params
 
 
-def run_dockerfile_template(ctx: Context, dockerfile_context: str, distro: str) -> str:
+def run_dockerfile_template(
+    ctx: Context, dockerfile_context: str, distro: str, stage: Optional[Dict] = None
+) -> str:
     """
     Renders a template and returns a file name pointing at the render.
     """
     logger = logging.getLogger(__name__)
     path = dockerfile_context
-    params = get_rendering_params(ctx)
+    params = get_rendering_params(ctx, stage)
 
     logger.debug("rendering params are:")
     logger.debug(params)
 
     rendered = render(path, distro, params)
-    tmp = tempfile.NamedTemporaryFile(delete=False)
-    tmp.write(rendered.encode("utf-8"))
+    dockerfile = run_workspace(ctx).mkstemp(prefix="Dockerfile-")
+    with open(dockerfile, "w") as f:
+        f.write(rendered)
 
-    return tmp.name
+    return dockerfile
 
 
 def interpolate_dict(ctx: Context, args: Dict[str, str]) -> Dict[str,str]:
@@ -465,7 +842,7 @@ def create_ecr_repository(tag: str):
 
     logger.debug("Creating repository in %s with name %s", region, repository_name)
 
-    client = boto3.client("ecr", region_name=region)
+    client = aws_client("ecr", region)
 
     try:
         client.create_repository(
@@ -505,6 +882,8 @@ def echo(ctx: Context, entry_name: str, message: str, foreground: str = "white")
         stage_name = ctx.stage["name"]
         stage_title = "[{}/{}] ".format(stage_name, stage_type)
 
+    events.emit(ctx, events.MESSAGE, entry=entry_name, message=message)
+
     # If --pipeline, these messages go to stderr
 
     click.secho(
@@ -512,15 +891,13 @@ def echo(ctx: Context, entry_name: str, message: str, foreground: str = "white")
     )
 
 
-def find_dockerfile(dockerfile: str):
+def find_dockerfile(dockerfile: str, workspace: Optional[Workspace] = None):
     """Returns a Dockerfile file location that can be local or remote. If remote it
-    will be downloaded into a temporary location first."""
+    will be downloaded into the workspace first, once per run."""
 
     if dockerfile.startswith("https://"):
-        tmpfile = tempfile.NamedTemporaryFile(delete=False)
-        urlretrieve(dockerfile, tmpfile.name)
-
-        return tmpfile.name
+        workspace = workspace or default_workspace()
+        return workspace.download(dockerfile, urlretrieve)
 
     return dockerfile
 
@@ -537,9 +914,12 @@ def is_signing_enabled(output: Dict) -> bool:
     )
 
 
+SIGNING_LOCK = threading.Lock()
+
+
 def setup_signing_environment(ctx: Context, output: Dict) -> str:
     os.environ[DCT_ENV_VARIABLE] = "1"
-    os.environ[DCT_PASSPHRASE] = get_secret(
+    os.environ[DCT_PASSPHRASE] = ctx.backend.get_secret(
         ctx.I(output["passphrase_secret_name"]), ctx.I(output["region"])
     )
     # Asks docker trust inspect for the name the private key for the specified signer
@@ -549,7 +929,9 @@ def setup_signing_environment(ctx: Context, output: Dict) -> str:
     )
 
     # And writes the private key stored in the secret to the appropriate path
-    private_key = get_secret(ctx.I(output["key_secret_name"]), ctx.I(output["region"]))
+    private_key = ctx.backend.get_secret(
+        ctx.I(output["key_secret_name"]), ctx.I(output["region"])
+    )
     docker_trust_path = f"{Path.home()}/.docker/trust/private"
     Path(docker_trust_path).mkdir(parents=True, exist_ok=True)
     with open(f"{docker_trust_path}/{signing_key_name}", "w+") as f:
@@ -558,6 +940,152 @@ def setup_signing_environment(ctx: Context, output: Dict) -> str:
     return signing_key_name
 
 
+def find_setting(ctx: Context, name: str, default: Any = None) -> Any:
+    """
+    Returns a setting from the current stage, the image or the inventory, in
+    that order.
+    """
+    for section in (ctx.stage or {}, ctx.image, ctx.inventory):
+        if name in section:
+            return section[name]
+
+    return default
+
+
+def analyze_image(ctx: Context, image) -> analytics.ImageReport:
+    """
+    Reports the size and layers of an image built by the current stage, and
+    compares its size with the previous build of the stage. If the image grew
+    by more than `max_size_increase` percent, the stage fails before the
+    image is pushed.
+    """
+    key = "{}/{}".format(ctx.image_name, ctx.stage["name"])
+
+    with tracing.span("analyze_image", image=ctx.image_name, stage=ctx.stage["name"]):
+        report = analytics.inspect_image(image, int(find_setting(ctx, "largest_files", 0)))
+    analytics.compare_with_previous(key, report)
+
+    echo(ctx, "image-analytics", report.to_dict())
+
+    max_increase = find_setting(ctx, "max_size_increase")
+    if (
+        max_increase is not None
+        and report.size_increase is not None
+        and report.size_increase > float(max_increase)
+    ):
+        raise SonarBuildError(
+            "Image {} grew {:.1f}% since its previous build ({} to {} bytes), "
+            "more than the {}% allowed".format(
+                key, report.size_increase, report.previous_size, report.size, max_increase
+            )
+        )
+
+    # Only images within the threshold become the reference for the next build.
+    analytics.save_size(key, report)
+
+    return report
+
+
+def record_duration(ctx: Context, operation: str, duration: float):
+    """Records the duration of an operation of the current stage, or of
+    the whole image if there is no current stage."""
+    if not ctx.history:
+        return
+
+    stage = ctx.stage
+    if stage is None:
+        history.get_history().record(ctx.image_name, "", operation, duration)
+    else:
+        history.get_history().record(
+            ctx.image_name, stage["name"], operation, duration, history.input_hash(stage)
+        )
+
+
+VOLATILE_AS = ("annotations", "labels")
+
+
+def volatile_metadata_errors(stage: Dict) -> List[str]:
+    """Returns what is wrong with the volatile metadata of a stage."""
+    errors = []
+    for key, inputs in (("volatile_labels", "labels"), ("volatile_buildargs", "buildargs")):
+        for name in stage.get(key, []):
+            if name not in stage.get(inputs, {}):
+                errors.append("{} {} is not one of the {} of the stage".format(key, name, inputs))
+
+    if stage.get("volatile_as", "annotations") not in VOLATILE_AS:
+        errors.append("volatile_as has to be one of {}".format(", ".join(VOLATILE_AS)))
+
+    volatile = len(stage.get("volatile_labels", [])) + len(stage.get("volatile_buildargs", []))
+    if volatile > 0 and any(is_signing_enabled(o) for o in stage.get("output", [])):
+        errors.append("volatile metadata can not be added to signed images")
+
+    return errors
+
+
+def references_arg(arguments: str, name: str) -> bool:
+    """Returns whether the arguments of a Dockerfile instruction use the ARG name."""
+    return re.search(r"\$(?:{0}\b|{{{0}\b)".format(re.escape(name)), arguments) is not None
+
+
+def volatile_buildarg_errors(stage: Dict, dockerfile: str) -> List[str]:
+    """
+    Returns an error for every volatile buildarg of a stage that its
+    Dockerfile uses outside of ARG instructions. Volatile buildargs are not
+    passed to the build, so those instructions would see them empty.
+    """
+    errors = []
+    for name in stage.get("volatile_buildargs", []):
+        for line, instruction, arguments in prefetch.numbered_instructions(dockerfile):
+            if instruction != "ARG" and references_arg(arguments, name):
+                errors.append(
+                    "volatile_buildargs {} is used by {} at line {} of the Dockerfile, "
+                    "but volatile buildargs are only added as metadata".format(
+                        name, instruction, line
+                    )
+                )
+                break
+
+    return errors
+
+
+def split_volatile_metadata(
+    stage: Dict, buildargs: Dict[str, str], labels: Dict[str, str]
+) -> Optional[Dict[str, str]]:
+    """
+    Takes the `volatile_labels` and `volatile_buildargs` of a stage out of its
+    labels and buildargs, so values that change every run, like a version id,
+    do not change the image that is built. Returns the values taken out, to
+    add to the pushed image, or None if the stage has none.
+    """
+    errors = volatile_metadata_errors(stage)
+    if len(errors) > 0:
+        raise ValueError("{}: {}".format(stage["name"], errors[0]))
+
+    metadata = {}
+    for name in stage.get("volatile_labels", []):
+        metadata[name] = labels.pop(name)
+    for name in stage.get("volatile_buildargs", []):
+        metadata[name] = buildargs.pop(name)
+
+    return metadata if len(metadata) > 0 else None
+
+
+def pin_upstream_images(ctx: Context, buildargs: Dict[str, str]) -> Dict[str, str]:
+    """
+    Adds the digest to the buildargs that are references to images pushed
+    upstream, so builds use the image that was just pushed and not whatever
+    the tag points to when it is pulled.
+    """
+    pinned = {}
+    for key, value in buildargs.items():
+        digest = ctx.upstream_images.get(value)
+        if digest is not None:
+            value = "{}@{}".format(value, digest)
+        pinned[key] = value
+
+    return pinned
+
+
 def task_docker_build(ctx: Context):
     """
     Builds a container image.
@@ -568,42 +1096,89 @@ def task_docker_build(ctx: Context):
     if platform:
         platform = ctx.I(platform)
 
-    dockerfile = find_dockerfile(ctx.I(ctx.stage["dockerfile"]))
+    dockerfile = find_dockerfile(ctx.I(ctx.stage["dockerfile"]), run_workspace(ctx))
 
-    buildargs = interpolate_dict(ctx, ctx.stage.get("buildargs", {}))
+    buildargs = pin_upstream_images(ctx, interpolate_dict(ctx, ctx.stage.get("buildargs", {})))
 
     labels = interpolate_dict(ctx, ctx.stage.get("labels", {}))
 
-    image = docker_build(docker_context, dockerfile, buildargs=buildargs, labels=labels, platform=platform)
+    metadata = split_volatile_metadata(ctx.stage, buildargs, labels)
+    if len(ctx.stage.get("volatile_buildargs", [])) > 0:
+        with open(dockerfile) as f:
+            errors = volatile_buildarg_errors(ctx.stage, f.read())
+        if len(errors) > 0:
+            raise ValueError("{}: {}".format(ctx.stage["name"], errors[0]))
+
+    context_digest = None
+    if ctx.snapshot_contexts:
+        context_digest = snapshot_docker_context(ctx, docker_context, dockerfile).digest
+
+    def progress(line: str):
+        events.emit(ctx, events.BUILD_PROGRESS, line=line)
+
+    local_tag = cleanup.local_image_tag(ctx.run_id, ctx.image_name, ctx.stage["name"])
+    ctx.created_images.append(local_tag)
+
+    build_kwargs = dict(
+        buildargs=buildargs,
+        labels=labels,
+        platform=platform,
+        progress=progress if len(ctx.event_listeners) > 0 else None,
+        tag=local_tag,
+    )
+    if ctx.builders is None:
+        build_start = time.monotonic()
+        image = ctx.backend.build(docker_context, dockerfile, **build_kwargs)
+    else:
+        key = "{}/{}".format(ctx.image_name, ctx.stage["name"])
+        with ctx.builders.acquire(key) as builder:
+            echo(ctx, "docker-builder", builder.id)
+            build_start = time.monotonic()
+            image = ctx.backend.build(docker_context, dockerfile, builder=builder, **build_kwargs)
+    record_duration(ctx, "build", time.monotonic() - build_start)
+
+    report = None
+    if ctx.image_analytics or find_setting(ctx, "max_size_increase") is not None:
+        report = analyze_image(ctx, image)
 
     for output in ctx.stage["output"]:
         registry = ctx.I(output["registry"])
         tag = ctx.I(output["tag"])
         sign = is_signing_enabled(output)
         signing_key_name = ""
-        if sign:
-            signing_key_name = setup_signing_environment(ctx, output)
-
-        echo(ctx, "docker-image-push", "{}:{}".format(registry, tag))
-        docker_tag(image, registry, tag)
-
-        create_ecr_repository(registry)
-        try:
-            docker_push(registry, tag)
-        except SonarAPIError as e:
-            ctx.captured_errors.append(e)
-            if ctx.continue_on_errors:
-                echo(ctx, "docker-image-push/error", e)
+        # The signing configuration lives in the process environment, so
+        # concurrent runs have to sign one image at a time.
+        with SIGNING_LOCK if sign else contextlib.nullcontext():
+            if sign:
+                signing_key_name = setup_signing_environment(ctx, output)
+
+            echo(ctx, "docker-image-push", "{}:{}".format(registry, tag))
+            ctx.backend.tag(image, registry, tag)
+            ctx.created_images.append("{}:{}".format(registry, tag))
+
+            ctx.backend.create_repository(registry)
+            push_start = time.monotonic()
+            if metadata is None:
+                digest = push_image(ctx, registry, tag)
             else:
-                raise
-
-        append_output_in_context(ctx, ctx.stage["name"], {
-            "registry": registry,
-            "tag": tag,
-        })
-
-        if sign:
-            clear_signing_environment(signing_key_name)
+                digest = push_image(ctx, registry, tag, image.id, metadata)
+            record_duration(ctx, "push", time.monotonic() - push_start)
+
+            stage_output = {
+                "registry": registry,
+                "tag": tag,
+            }
+            if digest is not None:
+                stage_output["digest"] = digest
+            if context_digest is not None:
+                stage_output["context_digest"] = context_digest
+            if report is not None:
+                stage_output["image_size"] = report.size
+                stage_output["image_layers"] = report.layers
+            append_output_in_context(ctx, ctx.stage["name"], stage_output)
+
+            if sign:
+                clear_signing_environment(signing_key_name)
 
 
 def split_s3_location(s3loc: str) -> Tuple[str, str]:
@@ -617,7 +1192,7 @@ def split_s3_location(s3loc: str) -> Tuple[str, str]:
 
 def save_dockerfile(dockerfile: str, destination: str):
     if destination.startswith("s3://"):
-        client = boto3.client("s3")
+        client = aws_client("s3")
         bucket, location = split_s3_location(destination)
         client.upload_file(
             dockerfile, bucket, location, ExtraArgs={"ACL": "public-read"}
@@ -626,36 +1201,175 @@ def save_dockerfile(dockerfile: str, destination: str):
         copyfile(dockerfile, destination)
 
 
-def task_dockerfile_template(ctx: Context):
+class DefaultBackend(Backend):
     """
-    Templates a dockerfile.
+    Builds with Docker, and uses ECR, S3 and Secrets Manager. Calls go through
+    the functions of this module, so they can be patched.
     """
-    docker_context = find_docker_context(ctx)
-    template_context = docker_context
 
+    def __init__(self):
+        # Daemons holding the images built by builders with a docker_host,
+        # by image id and by the references they are tagged as.
+        self.docker_hosts: Dict[Any, str] = {}
+
+    def build(self, path, dockerfile, **kwargs):
+        image = docker_build(path, dockerfile, **kwargs)
+
+        builder = kwargs.get("builder")
+        if builder is not None and builder.docker_host is not None:
+            self.docker_hosts[image.id] = builder.docker_host
+        return image
+
+    def pull(self, registry, tag):
+        return docker_pull(registry, tag)
+
+    def tag(self, image, registry, tag):
+        docker_host = self.docker_hosts.get(getattr(image, "id", None))
+        if docker_host is not None:
+            self.docker_hosts["{}:{}".format(registry, tag)] = docker_host
+        return docker_tag(image, registry, tag)
+
+    def push(self, registry, tag):
+        docker_host = self.docker_hosts.get("{}:{}".format(registry, tag))
+        if docker_host is not None:
+            return docker_push(registry, tag, docker_host=docker_host)
+        return docker_push(registry, tag)
+
+    def create_repository(self, registry):
+        create_ecr_repository(registry)
+
+    def get_secret(self, name, region):
+        return get_secret(name, region)
+
+    def find_build_id(self, registry, tag):
+        return registry_api.find_build_id(registry, tag, registry_credentials)
+
+    def add_metadata(self, registry, tag, build_id, labels=None, annotations=None):
+        return registry_api.add_metadata(
+            registry, tag, build_id, labels, annotations, registry_credentials
+        )
+
+    def push_oci_image(self, image, registry_name, tag):
+        return registry_api.push_image(image, registry_name, tag, registry_credentials)
+
+    def save_file(self, path, destination):
+        save_dockerfile(path, destination)
+
+    def remove_images(self, references):
+        return cleanup.remove_images(references)
+
+    def prune(self):
+        return cleanup.prune_dangling()
+
+
+def find_template_context(ctx: Context) -> str:
+    """
+    Returns the directory holding the Dockerfile templates for this stage.
+    """
     try:
-        template_context = ctx.image["vars"]["template_context"]
+        return ctx.image["vars"]["template_context"]
     except KeyError:
-        pass
+        return find_docker_context(ctx)
 
 
-    template_file_extension = ctx.stage.get("template_file_extension")
+def find_template_file_extension(stage: Dict) -> Optional[str]:
+    template_file_extension = stage.get("template_file_extension")
     if template_file_extension is None:
         # Use distro as compatibility with pre 0.11
-        template_file_extension = ctx.stage.get("distro")
+        template_file_extension = stage.get("distro")
 
-    dockerfile = run_dockerfile_template(ctx, template_context, template_file_extension)
+    return template_file_extension
 
-    for output in ctx.stage["output"]:
+
+def expand_template_variants(stage: Dict) -> List[Dict]:
+    """
+    Returns one stage per combination of `template_file_extensions` and
+    `template_parameters`. Each variant gets the combination values as stage
+    `vars`, so they can be used to render the template and to interpolate
+    the `output` section, together with its index in `template_index`.
+    """
+    extensions = stage.get("template_file_extensions")
+    if extensions is None:
+        extensions = [find_template_file_extension(stage)]
+
+    parameter_sets = stage.get("template_parameters") or [{}]
+
+    variants = []
+    for extension in extensions:
+        for parameters in parameter_sets:
+            variables = dict(stage.get("vars", {}))
+            variables.update({k: str(v) for k, v in parameters.items()})
+            variables["template_index"] = str(len(variants))
+            if extension is not None:
+                variables["template_file_extension"] = extension
+
+            variant = dict(stage)
+            variant["vars"] = variables
+            # Parameters of the set are rendered with the template, in
+            # addition to the stage's declared `inputs`.
+            variant["inputs"] = list(stage.get("inputs", [])) + [
+                p for p in parameters if p not in stage.get("inputs", [])
+            ]
+            variant["template_file_extension"] = extension
+            variants.append(variant)
+
+    return variants
+
+
+def task_dockerfile_template(ctx: Context):
+    """
+    Templates a dockerfile.
+
+    If the stage defines `template_file_extensions` or `template_parameters`,
+    every combination of them is rendered in parallel, and each output is
+    stored in order, so they can be referenced by index.
+    """
+    template_context = find_template_context(ctx)
+
+    if "template_file_extensions" not in ctx.stage and "template_parameters" not in ctx.stage:
+        dockerfile = run_dockerfile_template(
+            ctx, template_context, find_template_file_extension(ctx.stage)
+        )
+        save_dockerfile_outputs(ctx, ctx.stage, dockerfile)
+        return
+
+    variants = expand_template_variants(ctx.stage)
+    with ThreadPoolExecutor() as executor:
+        # Renders run in the current context, so their spans belong to this stage.
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                run_dockerfile_template,
+                ctx,
+                template_context,
+                variant["template_file_extension"],
+                variant,
+            )
+            for variant in variants
+        ]
+        dockerfiles = [f.result() for f in futures]
+
+    for variant, dockerfile in zip(variants, dockerfiles):
+        save_dockerfile_outputs(ctx, variant, dockerfile)
+
+
+def save_dockerfile_outputs(ctx: Context, stage: Dict, dockerfile: str):
+    """
+    Saves a rendered dockerfile into each one of the stage's outputs.
+    """
+    for output in stage["output"]:
         if "dockerfile" in output:
-            output_dockerfile = ctx.I(output["dockerfile"])
-            save_dockerfile(dockerfile, output_dockerfile)
+            output_dockerfile = interpolate_vars(ctx, output["dockerfile"], stage=stage)
+            ctx.backend.save_file(dockerfile, output_dockerfile)
 
             echo(ctx, "dockerfile-save-location", output_dockerfile)
 
-            append_output_in_context(ctx, ctx.stage["name"], {
-                "dockerfile": output_dockerfile
-            })
+            values = {"dockerfile": output_dockerfile}
+            if "template_index" in stage.get("vars", {}):
+                values["template_file_extension"] = stage["template_file_extension"]
+                values["template_index"] = stage["vars"]["template_index"]
+
+            append_output_in_context(ctx, ctx.stage["name"], values)
 
 
 def find_skip_tags(params: Optional[Dict[str, str]] = None) -> List[str]:
@@ -691,6 +1405,16 @@ def clear_signing_environment(key_to_remove: str):
     os.remove(f"{Path.home()}/.docker/trust/private/{key_to_remove}")
 
 
+def iter_stages(ctx: Context) -> Iterator[Tuple[int, Dict]]:
+    """
+    Yields the concrete stages of the image, with the index of the inventory
+    stage they come from. Stages with a `matrix` are expanded lazily.
+    """
+    for idx, stage in enumerate(ctx.image.get("stages", [])):
+        for concrete in expand(stage, ctx.skip_tags, ctx.include_tags):
+            yield idx, concrete
+
+
 # pylint: disable=R0913, disable=R1710
 def process_image(
     image_name: str,
@@ -710,44 +1434,436 @@ def process_image(
         image_name, skip_tags, include_tags, build_args, inventory, build_options
     )
 
-    echo(ctx, "image_build_start", image_name, foreground="yellow")
+    return run_image(ctx)
+
+
+def find_produced_repositories(ctx: Context) -> List[str]:
+    """
+    Returns the repositories the selected stages of the image push to.
+    Outputs that can only be known while running are left out.
+    """
+    logger = logging.getLogger(__name__)
+    repositories = []
+
+    last_stage = ctx.stage
+    for _, stage in iter_stages(ctx):
+        if should_skip_stage(stage, ctx.skip_tags) or not should_include_stage(
+            stage, ctx.include_tags
+        ):
+            continue
+
+        outputs = stage.get("output", [])
+        if stage["task_type"] == "tag_image":
+            outputs = stage.get("destination", [])
 
-    for idx, stage in enumerate(ctx.image.get("stages", [])):
         ctx.stage = stage
-        name = ctx.stage["name"]
-        if should_skip_stage(stage, ctx.skip_tags):
-            echo(ctx, "skipping-stage", name, foreground="green")
+        try:
+            for output in outputs:
+                if "registry" in output and ctx.I(output["registry"]) not in repositories:
+                    repositories.append(ctx.I(output["registry"]))
+        except (ValueError, KeyError, IndexError) as e:
+            logger.debug("Not finding the outputs of stage %s: %s", stage["name"], e)
+        finally:
+            ctx.stage = last_stage
+
+    return repositories
+
+
+def find_image_dependencies(
+    image_names: List[str],
+    skip_tags: Union[str, List[str]],
+    include_tags: Union[str, List[str]],
+    build_args: Optional[Dict[str, str]] = None,
+    inventory: Optional[str] = None,
+) -> Dict[str, List[str]]:
+    """
+    Returns the images each one of image_names depends on: the images in its
+    `depends_on`, and the images among image_names that push the base images
+    of its Dockerfiles or the sources of its tag_image stages.
+    """
+    contexts_by_name = {
+        name: build_context(name, skip_tags, include_tags, build_args, inventory)
+        for name in image_names
+    }
+    produced = {
+        name: set(find_produced_repositories(ctx)) for name, ctx in contexts_by_name.items()
+    }
+
+    dependencies = {}
+    for name, ctx in contexts_by_name.items():
+        depends_on = list(make_list_of_str(ctx.image.get("depends_on")))
+        for dependency in depends_on:
+            find_image(dependency, ctx.inventory)
+
+        pulled = {prefetch.split_image(i)[0] for i in find_prefetch_images(ctx)}
+        for other in image_names:
+            if other != name and other not in depends_on and pulled & produced[other]:
+                depends_on.append(other)
+
+        dependencies[name] = depends_on
+
+    return dependencies
+
+
+def find_shards(
+    image_names: List[str],
+    shard_count: int,
+    skip_tags: Union[str, List[str]],
+    include_tags: Union[str, List[str]],
+    build_args: Optional[Dict[str, str]] = None,
+    inventory: Optional[str] = None,
+    use_history: bool = False,
+) -> List[List[str]]:
+    """
+    Splits image_names into shard_count shards. Images are weighted by their
+    `weight` in the inventory (1 by default) or, with use_history, by their
+    recorded durations, if every image has any: seconds and weights are not
+    comparable, so they are never mixed.
+    """
+    logger = logging.getLogger(__name__)
+    inventory = find_inventory(inventory)
+    dependencies = find_image_dependencies(
+        image_names, skip_tags, include_tags, build_args, inventory
+    )
+
+    costs = None
+    if use_history:
+        estimates = {name: history.get_history().estimate_image(name) for name in image_names}
+        unknown = [name for name, estimate in estimates.items() if estimate is None]
+        if len(unknown) == 0:
+            costs = estimates
+        else:
+            logger.warning(
+                "Splitting shards by weight, images without history: %s", ", ".join(unknown)
+            )
+    if costs is None:
+        costs = {name: float(find_image(name, inventory).get("weight", 1)) for name in image_names}
+
+    return shard.split_shards(dependencies, costs, shard_count)
+
+
+def pushed_images(ctx: Context) -> Dict[str, str]:
+    """
+    Returns the digests of the images pushed by the run and its upstream
+    images, by registry:tag.
+    """
+    images = dict(ctx.upstream_images)
+    for outputs in ctx.stage_outputs.values():
+        for output in outputs:
+            if "registry" in output and "digest" in output:
+                images["{}:{}".format(output["registry"], output["tag"])] = output["digest"]
+
+    return images
+
+
+# pylint: disable=R0913
+def process_images(
+    image_names: List[str],
+    skip_tags: Union[str, List[str]],
+    include_tags: Union[str, List[str]],
+    build_args: Optional[Dict[str, str]] = None,
+    inventory: Optional[str] = None,
+    build_options: Optional[Dict[str, str]] = None,
+    max_workers: int = graph.MAX_CONCURRENT_IMAGES,
+):
+    """
+    Runs the Sonar process over several images. Every image runs once the
+    images it depends on have been pushed, and as many images as possible
+    run at the same time. If an image fails, the images depending on it do
+    not run, and the first error is raised when every other image is done.
+
+    With the `history` build option, the images on the path expected to
+    take the longest, from the durations of previous runs, start first.
+    """
+    logger = logging.getLogger(__name__)
+    inventory = find_inventory(inventory)
+
+    # Images built at the same time share the builders, the workspace and
+    # the version_id of the run, so images pull the tags their upstream pushed.
+    build_options = dict(build_options or {})
+    build_options.setdefault("stored_version_id", str(uuid.uuid4()))
+    if build_options.get("builders") is None and "builders" in inventory:
+        build_options["builders"] = BuilderPool.from_config(inventory["builders"])
+    shared_workspace = build_options.get("workspace") is not None
+    if not shared_workspace:
+        build_options["workspace"] = Workspace(build_options.get("workspace_dir"))
+
+    dependencies = find_image_dependencies(
+        image_names, skip_tags, include_tags, build_args, inventory
+    )
+    for level, names in enumerate(graph.topological_levels(dependencies)):
+        logger.info("Images at level %d: %s", level, ", ".join(names))
+
+    def run(name: str, upstream: Dict[str, graph.ImageResult]) -> Context:
+        ctx = build_context(name, skip_tags, include_tags, build_args, inventory, build_options)
+        for result in upstream.values():
+            ctx.upstream_images.update(pushed_images(result.result))
+
+        run_image(ctx)
+        return ctx
+
+    costs = None
+    if build_options.get("history"):
+        estimates = {name: history.get_history().estimate_image(name) for name in dependencies}
+        costs = {name: estimate or 0 for name, estimate in estimates.items()}
+
+    try:
+        results = graph.run_graph(dependencies, run, max_workers, costs)
+    finally:
+        if not shared_workspace:
+            build_options["workspace"].close()
+
+    output = {}
+    errors = []
+    for name, result in results.items():
+        if result.skipped:
+            logger.error("Image %s did not run: %s", name, result.error)
+        elif result.error is not None:
+            errors.append(result.error)
+        elif result.result.pipeline:
+            output.update(result.result.output)
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    if build_options.get("pipeline"):
+        return output
+
+
+def find_stage_images(ctx: Context) -> List[str]:
+    """
+    Returns the images the current stage pulls: the base images of the
+    Dockerfiles it builds or renders, or the source of a tag_image stage.
+    """
+    stage = ctx.stage
+    if stage["task_type"] == "tag_image":
+        return [
+            "{}:{}".format(
+                ctx.I(stage["source"]["registry"]), ctx.I(stage["source"]["tag"])
+            )
+        ]
+
+    if stage["task_type"] == "docker_build":
+        with open(find_dockerfile(ctx.I(stage["dockerfile"]), run_workspace(ctx))) as f:
+            dockerfile = f.read()
+        buildargs = interpolate_dict(ctx, stage.get("buildargs", {}))
+        return prefetch.find_base_images(dockerfile, buildargs)
+
+    if stage["task_type"] == "dockerfile_template":
+        images = []
+        template_context = find_template_context(ctx)
+        for variant in expand_template_variants(stage):
+            rendered = render(
+                template_context,
+                variant["template_file_extension"],
+                get_rendering_params(ctx, variant),
+            )
+            images.extend(prefetch.find_base_images(rendered))
+        return images
+
+    return []
+
+
+def find_prefetch_images(ctx: Context) -> List[str]:
+    """
+    Returns the distinct images pulled by the stages that will run. Stages
+    whose images can only be known while running, like a Dockerfile that is
+    the output of a previous stage, are left to pull their images themselves.
+    """
+    logger = logging.getLogger(__name__)
+    images = []
+
+    last_stage = ctx.stage
+    for _, stage in iter_stages(ctx):
+        if should_skip_stage(stage, ctx.skip_tags) or not should_include_stage(
+            stage, ctx.include_tags
+        ):
+            continue
+
+        ctx.stage = stage
+        try:
+            stage_images = find_stage_images(ctx)
+        except (ValueError, KeyError, IndexError, OSError) as e:
+            logger.debug("Not prefetching images of stage %s: %s", stage["name"], e)
             continue
+        finally:
+            ctx.stage = last_stage
+
+        images.extend(i for i in stage_images if i not in images)
+
+    # Images built upstream in this run do not exist yet, or are stale.
+    upstream = {prefetch.split_image(i)[0] for i in ctx.upstream_images}
+    return [i for i in images if prefetch.split_image(i)[0] not in upstream]
+
+
+def prefetch_images(ctx: Context):
+    """
+    Pulls the images the stages will need, concurrently and once each, and
+    reports the time spent pulling every one of them. Images that fail to
+    be pulled are reported, and left to the stages that need them.
+    """
+    with tracing.span("prefetch", image=ctx.image_name):
+        images = find_prefetch_images(ctx)
+        pull = lambda registry, tag: pull_image(ctx, registry, tag)
+        for result in prefetch.pull_images(images, pull):
+            if result.error is not None:
+                echo(
+                    ctx,
+                    "prefetch/error {}".format(result.image),
+                    result.error,
+                    foreground="yellow",
+                )
+                continue
+
+            ctx.prefetched_images[result.image] = result.pulled
+            echo(ctx, "prefetch {}".format(result.image), "{:.2f}s".format(result.duration))
+
+
+def login_registries(ctx: Context):
+    """
+    Gets the tokens of the ECR registries the image pushes to and pulls from,
+    concurrently, and makes Docker use them.
+    """
+    with tracing.span("login", image=ctx.image_name):
+        hosts = find_produced_repositories(ctx) + find_prefetch_images(ctx)
+        hosts = [registry_api.split_reference(prefetch.split_image(h)[0])[0] for h in hosts]
+        config_dir = CREDENTIALS.login(hosts)
+
+    if config_dir is not None:
+        reload_docker_config()
+        echo(ctx, "docker-config", config_dir)
 
-        if not should_include_stage(stage, ctx.include_tags):
+
+def remove_created_images(ctx: Context):
+    """
+    Removes the local tags created by the run, and the dangling images left
+    behind. Failing to remove them does not fail the run.
+    """
+    with tracing.span("gc", image=ctx.image_name):
+        removed = ctx.backend.remove_images(reversed(ctx.created_images))
+        try:
+            reclaimed = ctx.backend.prune()
+        except SonarAPIError as e:
+            logging.getLogger(__name__).warning("Could not prune dangling images: %s", e)
+            reclaimed = 0
+
+    last_stage, ctx.stage = ctx.stage, None
+    echo(ctx, "gc", "removed {} tags, reclaimed {} bytes".format(len(removed), reclaimed))
+    ctx.stage = last_stage
+
+
+def run_image(ctx: Context):
+    """
+    Runs every stage of the image in the context.
+    """
+    shared_workspace = ctx.workspace is not None
+    with tracing.span("process_image", image=ctx.image_name):
+        try:
+            run_stages(ctx)
+        finally:
+            if ctx.gc:
+                remove_created_images(ctx)
+            if not shared_workspace and ctx.workspace is not None:
+                ctx.workspace.close()
+
+        if len(ctx.captured_errors) > 0 and ctx.fail_on_errors:
+            echo(ctx, "docker-image-push/captured-errors", ctx.captured_errors)
+            raise SonarAPIError(ctx.captured_errors[0])
+
+    if ctx.pipeline:
+        return ctx.output
+
+
+def run_stages(ctx: Context):
+    """
+    Runs the selected stages of the image, emitting their events.
+    """
+    events.emit(ctx, events.IMAGE_START)
+    echo(ctx, "image_build_start", ctx.image_name, foreground="yellow")
+
+    image_start = time.monotonic()
+
+    if ctx.ecr_login:
+        login_registries(ctx)
+
+    if ctx.prefetch:
+        prefetch_images(ctx)
+
+    stages = ctx.image.get("stages", [])
+    for idx, stage in iter_stages(ctx):
+        ctx.stage = stage
+        name = ctx.stage["name"]
+        if should_skip_stage(stage, ctx.skip_tags) or not should_include_stage(
+            stage, ctx.include_tags
+        ):
             echo(ctx, "skipping-stage", name, foreground="green")
+            events.emit(ctx, events.STAGE_SKIPPED)
             continue
 
         echo(
             ctx,
             "stage-started {}".format(stage["name"]),
-            "{}/{}".format(idx + 1, len(ctx.image["stages"])),
+            "{}/{}".format(idx + 1, len(stages)),
         )
+        events.emit(
+            ctx,
+            events.STAGE_START,
+            task_type=stage["task_type"],
+            index=idx + 1,
+            total=len(stages),
+        )
+        stage_start = time.monotonic()
+        captured_errors = len(ctx.captured_errors)
 
-        if stage["task_type"] == "dockerfile_create":
-            task_dockerfile_create(ctx)
-        elif stage["task_type"] == "dockerfile_template":
-            task_dockerfile_template(ctx)
-        elif stage["task_type"] == "docker_build":
-            task_docker_build(ctx)
-        elif stage["task_type"] == "tag_image":
-            task_tag_image(ctx)
-        else:
-            raise NotImplementedError(
-                "task_type {} not supported".format(stage["task_type"])
+        try:
+            run_stage(ctx)
+        except Exception as e:
+            events.emit(ctx, events.ERROR, error=str(e))
+            events.emit(
+                ctx,
+                events.STAGE_END,
+                status="failure",
+                duration=time.monotonic() - stage_start,
+            )
+            raise
+        finally:
+            metrics.STAGE_DURATION.observe(
+                time.monotonic() - stage_start, task_type=stage["task_type"]
             )
 
-    if len(ctx.captured_errors) > 0 and ctx.fail_on_errors:
-        echo(ctx, "docker-image-push/captured-errors", ctx.captured_errors)
-        raise SonarAPIError(ctx.captured_errors[0])
+        succeeded = len(ctx.captured_errors) == captured_errors
+        events.emit(
+            ctx,
+            events.STAGE_END,
+            status="success" if succeeded else "error",
+            duration=time.monotonic() - stage_start,
+        )
+        if succeeded:
+            record_duration(ctx, history.STAGE, time.monotonic() - stage_start)
+
+    # The image events do not belong to any stage.
+    last_stage, ctx.stage = ctx.stage, None
+    events.emit(
+        ctx,
+        events.IMAGE_END,
+        errors=len(ctx.captured_errors),
+        duration=time.monotonic() - image_start,
+    )
+    if len(ctx.captured_errors) == 0:
+        record_duration(ctx, history.IMAGE, time.monotonic() - image_start)
+    ctx.stage = last_stage
+
 
-    if ctx.pipeline:
-        return ctx.output
+def run_stage(ctx: Context):
+    """
+    Runs the task of the current stage.
+    """
+    stage = ctx.stage
+    task = get_task(stage["task_type"])
+    with tracing.span(
+        "task_{}".format(stage["task_type"]), image=ctx.image_name, stage=stage["name"]
+    ):
+        task.run(ctx)
 
 
 def make_list_of_str(value: Union[None, str, List[str]]) -> List[str]:
@@ -784,9 +1900,6 @@ def build_context(
     build_args = build_args.copy()
     logger.debug("Should skip tags %s", skip_tags)
 
-    if build_options is None:
-        build_options = {}
-
     context = Context(
         inventory=find_inventory(inventory),
         image=image,
@@ -795,8 +1908,22 @@ def build_context(
         include_tags=make_list_of_str(include_tags),
     )
 
-    for k, v in build_options.items():
-        if hasattr(context, k):
-            setattr(context, k, v)
+    apply_build_options(context, build_options)
+    apply_inventory_settings(context)
 
     return context
+
+
+def apply_inventory_settings(ctx: Context):
+    """Sets up the builders and rate limits of the inventory of the context."""
+    if ctx.builders is None and "builders" in ctx.inventory:
+        ctx.builders = BuilderPool.from_config(ctx.inventory["builders"])
+
+    ratelimit.configure(ctx.inventory.get("rate_limits", {}))
+
+
+def apply_build_options(ctx: Context, build_options: Optional[Dict[str, str]]):
+    """Sets the options passed to sonar as attributes of the context."""
+    for k, v in (build_options or {}).items():
+        if hasattr(ctx, k):
+            setattr(ctx, k, v)
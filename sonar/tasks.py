@@ -0,0 +1,148 @@
+"""
+sonar/tasks.py
+
+The registry of task types.
+
+Each `task_type` of a stage is described by a TaskSpec: the function that
+runs it, the keys a stage of that type requires and the resources it would
+hold while it runs. Resources are declared for a future scheduler running
+stages that use different resources at the same time; for now they are only
+reported in the JSON plan, and stages run one at a time.
+
+Task types can be added by other packages with an entry point in the
+`sonar.tasks` group, named after the task type:
+
+    entry_points={
+        "sonar.tasks": ["registry_copy = sonar_copy.tasks:REGISTRY_COPY"],
+    }
+
+The entry point refers to a TaskSpec, or to a function taking the Context.
+Plugins are only imported when a stage with their task type is run or
+planned.
+"""
+
+import importlib
+import threading
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable, Dict, List, Mapping, Tuple
+
+ENTRY_POINT_GROUP = "sonar.tasks"
+
+
+@dataclass(frozen=True)
+class TaskSpec:
+    task_type: str
+
+    # The function running the task, as `module:function`. It is imported
+    # when the task runs.
+    target: str
+
+    # Keys every stage of this type has to define.
+    required_keys: Tuple[str, ...] = ()
+
+    # Units of each resource (like "docker" or "network") a stage of this
+    # type holds while it runs. Not enforced yet, see above.
+    resources: Mapping[str, int] = field(default_factory=dict)
+
+    def load(self) -> Callable[[Any], None]:
+        module, _, name = self.target.partition(":")
+        return getattr(importlib.import_module(module), name)
+
+    def run(self, ctx):
+        self.load()(ctx)
+
+
+BUILTIN_TASKS = (
+    TaskSpec(
+        "dockerfile_create",
+        "sonar.sonar:task_dockerfile_create",
+        required_keys=("static_files", "output"),
+        resources={"cpu": 1},
+    ),
+    TaskSpec(
+        "dockerfile_template",
+        "sonar.sonar:task_dockerfile_template",
+        required_keys=("output",),
+        resources={"cpu": 1},
+    ),
+    TaskSpec(
+        "docker_build",
+        "sonar.sonar:task_docker_build",
+        required_keys=("dockerfile", "output"),
+        resources={"docker": 1, "network": 1},
+    ),
+    TaskSpec(
+        "context_image",
+        "sonar.sonar:task_context_image",
+        required_keys=("static_files", "output"),
+        resources={"cpu": 1, "network": 1},
+    ),
+    TaskSpec(
+        "tag_image",
+        "sonar.sonar:task_tag_image",
+        required_keys=("source", "destination"),
+        resources={"network": 1},
+    ),
+)
+
+TASKS: Dict[str, TaskSpec] = {spec.task_type: spec for spec in BUILTIN_TASKS}
+TASKS_LOCK = threading.Lock()
+
+
+def register_task(spec: TaskSpec):
+    """Adds a task type, or replaces an existing one."""
+    with TASKS_LOCK:
+        TASKS[spec.task_type] = spec
+
+
+def find_entry_points(name: str) -> List[Any]:
+    """Returns the entry points of the `sonar.tasks` group with this name."""
+    # Imported here, as most runs only use the built-in tasks.
+    from importlib import metadata
+
+    try:
+        entry_points = metadata.entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:
+        # Python < 3.10
+        entry_points = metadata.entry_points().get(ENTRY_POINT_GROUP, [])
+
+    return [ep for ep in entry_points if ep.name == name]
+
+
+def load_plugin(task_type: str) -> TaskSpec:
+    entry_points = find_entry_points(task_type)
+    if len(entry_points) == 0:
+        raise NotImplementedError("task_type {} not supported".format(task_type))
+
+    entry_point = entry_points[0]
+    loaded = entry_point.load()
+    if isinstance(loaded, TaskSpec):
+        return replace(loaded, task_type=task_type)
+
+    if callable(loaded):
+        return TaskSpec(task_type, entry_point.value)
+
+    raise TypeError(
+        "entry point {} is not a TaskSpec or a function".format(entry_point.value)
+    )
+
+
+def get_task(task_type: str) -> TaskSpec:
+    """Returns the spec of a task type, loading its plugin the first time.
+    Raises NotImplementedError for unknown task types."""
+    spec = TASKS.get(task_type)
+    if spec is not None:
+        return spec
+
+    spec = load_plugin(task_type)
+    register_task(spec)
+    return spec
+
+
+def is_supported(task_type: str) -> bool:
+    try:
+        get_task(task_type)
+    except NotImplementedError:
+        return False
+
+    return True
@@ -1,8 +1,24 @@
 # -*- coding: utf-8 -*-
 
+from functools import lru_cache
 from typing import Dict
 
-import jinja2
+from sonar import tracing
+from sonar.lazy import lazy_import
+
+jinja2 = lazy_import("jinja2")
+
+
+@lru_cache(maxsize=None)
+def get_environment(path: str) -> "jinja2.Environment":
+    """Returns the Jinja2 environment for templates under path.
+
+    Environments are shared, so each template is compiled once per run and
+    reused by every render that targets it.
+    """
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(path), undefined=jinja2.StrictUndefined
+    )
 
 
 def render(path: str, template_name: str, parameters: Dict[str, str]) -> str:
@@ -11,12 +27,11 @@ def render(path: str, template_name: str, parameters: Dict[str, str]) -> str:
     path indicates where in the filesystem the Dockerfiles are.
     template_name references a Dockerfile.<template_name> to render.
     """
-    env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(path), undefined=jinja2.StrictUndefined
-    )
+    env = get_environment(path)
 
     template = "Dockerfile"
     if template_name is not None:
         template = "Dockerfile.{}".format(template_name)
 
-    return env.get_template(template).render(parameters)
+    with tracing.span("render", template=template, path=path):
+        return env.get_template(template).render(parameters)
@@ -0,0 +1,225 @@
+"""
+sonar/tracing.py
+
+Trace spans around Sonar's runs, stages and external calls.
+
+Tracing is enabled by the environment:
+
+* SONAR_TRACE_FILE: appends each finished span, as a JSON line, to this file.
+* OTEL_EXPORTER_OTLP_TRACES_ENDPOINT or OTEL_EXPORTER_OTLP_ENDPOINT: sends
+  spans to an OpenTelemetry collector with OTLP/HTTP, using JSON encoding.
+* TRACEPARENT: a W3C trace context; spans without a parent become its
+  children, so a Sonar run is part of the trace of the CI job running it.
+
+When no exporter is configured, spans are not recorded at all.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+SERVICE_NAME = "sonar"
+
+current_span: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar(
+    "sonar_current_span", default=None
+)
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start_time_ns: int = field(default_factory=time.time_ns)
+    end_time_ns: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set_attributes(self, **attributes):
+        self.attributes.update({k: v for k, v in attributes.items() if v is not None})
+
+    def end(self, error: Optional[BaseException] = None):
+        self.end_time_ns = time.time_ns()
+        if error is not None:
+            self.error = "{}: {}".format(type(error).__name__, error)
+
+        for exporter in EXPORTERS:
+            exporter.export(self)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_time_ns),
+            "endTimeUnixNano": str(self.end_time_ns),
+            "attributes": [
+                {"key": k, "value": {"stringValue": str(v)}}
+                for k, v in self.attributes.items()
+            ],
+            "status": {"code": 1},
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            span["status"] = {"code": 2, "message": self.error}
+
+        return span
+
+
+class JSONFileExporter:
+    """Appends spans to a file, one JSON document per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(asdict(span), default=str) + "\n")
+
+    def flush(self):
+        pass
+
+
+class OTLPExporter:
+    """Sends spans to an OTLP/HTTP endpoint, in batches."""
+
+    def __init__(self, endpoint: str, batch_size: int = 512):
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.spans: List[Span] = []
+
+    def export(self, span: Span):
+        with self.lock:
+            self.spans.append(span)
+            if len(self.spans) < self.batch_size:
+                return
+            spans, self.spans = self.spans, []
+
+        self.send(spans)
+
+    def flush(self):
+        with self.lock:
+            spans, self.spans = self.spans, []
+
+        if len(spans) > 0:
+            self.send(spans)
+
+    def send(self, spans: List[Span]):
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": "service.name", "value": {"stringValue": SERVICE_NAME}}
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": SERVICE_NAME},
+                            "spans": [s.to_otlp() for s in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10):
+                pass
+        except OSError as e:
+            # Losing traces must never fail a build.
+            logging.getLogger(__name__).warning("Could not export spans: %s", e)
+
+
+def exporters_from_environment() -> List[Any]:
+    exporters = []
+    if "SONAR_TRACE_FILE" in os.environ:
+        exporters.append(JSONFileExporter(os.environ["SONAR_TRACE_FILE"]))
+
+    endpoint = os.environ.get("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+    if endpoint is None and "OTEL_EXPORTER_OTLP_ENDPOINT" in os.environ:
+        endpoint = os.environ["OTEL_EXPORTER_OTLP_ENDPOINT"].rstrip("/") + "/v1/traces"
+    if endpoint is not None:
+        exporters.append(OTLPExporter(endpoint))
+
+    return exporters
+
+
+EXPORTERS = exporters_from_environment()
+
+
+@atexit.register
+def flush():
+    """Sends every span that has not been exported yet."""
+    for exporter in EXPORTERS:
+        exporter.flush()
+
+
+def parse_traceparent(traceparent: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Returns the trace and span ids of a W3C traceparent header."""
+    if traceparent is None:
+        return None
+
+    parts = traceparent.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+
+    return parts[1], parts[2]
+
+
+def start_span(name: str, **attributes) -> Optional[Span]:
+    """Starts a span, child of the current one. The caller has to end it.
+    Returns None when tracing is disabled."""
+    if len(EXPORTERS) == 0:
+        return None
+
+    parent = current_span.get()
+    if parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    else:
+        remote = parse_traceparent(os.environ.get("TRACEPARENT"))
+        trace_id, parent_id = remote if remote else (secrets.token_hex(16), None)
+
+    span = Span(name=name, trace_id=trace_id, span_id=secrets.token_hex(8), parent_id=parent_id)
+    span.set_attributes(**attributes)
+    return span
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """Runs the block in a new span, which is the current span until the
+    block finishes."""
+    started = start_span(name, **attributes)
+    if started is None:
+        yield None
+        return
+
+    token = current_span.set(started)
+    try:
+        yield started
+    except BaseException as e:
+        started.end(e)
+        raise
+    else:
+        started.end()
+    finally:
+        current_span.reset(token)
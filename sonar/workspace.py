@@ -0,0 +1,166 @@
+"""
+sonar/workspace.py
+
+A directory for the temporary files of a run, removed when the run ends.
+
+Rendered and downloaded Dockerfiles, and the files of `$(functions.tempfile)`,
+are written into the workspace of the run instead of the system's temporary
+directory, so runners do not collect them. Workspaces are created in
+$SONAR_WORKSPACE_DIR, or in the directory passed with `--workspace-dir`, which
+can be a tmpfs like /dev/shm, and in the system's temporary directory
+otherwise. Workspaces left by a run that did not end are removed at exit.
+
+The workspace also runs the functions inventories interpolate with
+`$(functions.name)` or `$(functions.name(argument))`. Their results are
+memoized for the run, so every stage sees the same value:
+
+* tempfile: a new empty file every time; with an argument, the same file
+  for that argument.
+* file_hash(path): the sha256 of the contents of a file.
+* git_sha(path): the commit checked out in a git repository, `.` by default.
+* timestamp(format): the time the run first asked for it, in UTC, as
+  `20240101T000000Z` or with a strftime format.
+"""
+
+import atexit
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+WORKSPACE_DIR_ENV = "SONAR_WORKSPACE_DIR"
+
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+
+
+class Workspace:
+    def __init__(self, parent: Optional[str] = None):
+        parent = parent or os.environ.get(WORKSPACE_DIR_ENV) or None
+        if parent is not None:
+            os.makedirs(parent, exist_ok=True)
+
+        self.directory = tempfile.mkdtemp(prefix="sonar-run-", dir=parent)
+        self.lock = threading.Lock()
+        self.results: Dict[Tuple, Any] = {}
+        atexit.register(self.close)
+
+    def mkstemp(self, prefix: str = "tmp-", suffix: str = "") -> str:
+        """Creates an empty file in the workspace, and returns its path."""
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix=prefix, suffix=suffix)
+        os.close(fd)
+        return path
+
+    def memoize(self, key: Tuple, compute: Callable[[], Any]) -> Any:
+        """Returns the result of compute, computed once per key in the run."""
+        with self.lock:
+            if key in self.results:
+                return self.results[key]
+
+        result = compute()
+        with self.lock:
+            # Calls racing for the same key get the first result.
+            return self.results.setdefault(key, result)
+
+    def call(self, name: str, argument: Optional[str] = None) -> str:
+        """Runs the function name, of the ones in FUNCTIONS."""
+        function = FUNCTIONS.get(name)
+        if function is None:
+            raise ValueError(
+                "Unknown function {}, the supported functions are {}".format(
+                    name, ", ".join(FUNCTIONS)
+                )
+            )
+
+        return function(self, argument)
+
+    def download(self, url: str, retrieve: Callable[[str, str], Any]) -> str:
+        """Downloads url into the workspace once per run, with retrieve(url,
+        path), and returns the path of the file."""
+
+        def fetch():
+            path = self.mkstemp(prefix="download-")
+            retrieve(url, path)
+            return path
+
+        return self.memoize(("download", url), fetch)
+
+    def close(self):
+        """Removes the workspace and everything in it."""
+        atexit.unregister(self.close)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def make_tempfile(workspace: Workspace, argument: Optional[str]) -> str:
+    if argument is None:
+        return workspace.mkstemp()
+
+    prefix = re.sub(r"[^A-Za-z0-9_.-]", "_", argument) + "-"
+    return workspace.memoize(("tempfile", argument), lambda: workspace.mkstemp(prefix=prefix))
+
+
+def file_hash(workspace: Workspace, argument: Optional[str]) -> str:
+    if argument is None:
+        raise ValueError("file_hash needs the path of a file, like file_hash(requirements.txt)")
+
+    path = os.path.abspath(argument)
+
+    def compute():
+        digest = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        except OSError as e:
+            raise ValueError("file_hash({}): {}".format(argument, e)) from e
+        return digest.hexdigest()
+
+    return workspace.memoize(("file_hash", path), compute)
+
+
+def git_sha(workspace: Workspace, argument: Optional[str]) -> str:
+    path = os.path.abspath(argument or ".")
+
+    def compute():
+        try:
+            result = subprocess.run(
+                ["git", "-C", path, "rev-parse", "HEAD"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise ValueError("git_sha({}): {}".format(path, getattr(e, "stderr", e))) from e
+        return result.stdout.decode("utf-8").strip()
+
+    return workspace.memoize(("git_sha", path), compute)
+
+
+def timestamp(workspace: Workspace, argument: Optional[str]) -> str:
+    instant = workspace.memoize(("timestamp",), time.time)
+    return time.strftime(argument or TIMESTAMP_FORMAT, time.gmtime(instant))
+
+
+FUNCTIONS: Dict[str, Callable[[Workspace, Optional[str]], str]] = {
+    "tempfile": make_tempfile,
+    "file_hash": file_hash,
+    "git_sha": git_sha,
+    "timestamp": timestamp,
+}
+
+_default: Optional[Workspace] = None
+_lock = threading.Lock()
+
+
+def default_workspace() -> Workspace:
+    """Returns the workspace for what runs outside of a run, like analyzing
+    an image. It is removed at exit."""
+    global _default
+    with _lock:
+        if _default is None:
+            _default = Workspace()
+        return _default
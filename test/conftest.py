@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Every test gets its own SONAR_CACHE_DIR, so tests never share, or
+    leave behind, cached hashes, histories, builders or tokens."""
+    cache = tmp_path / "cache"
+    monkeypatch.setenv("SONAR_CACHE_DIR", str(cache))
+    return cache
@@ -0,0 +1,118 @@
+import io
+import tarfile
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from sonar.analytics import inspect_image
+from sonar.builders import SonarBuildError
+from sonar.sonar import process_image
+
+
+def make_tar(files) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def fake_image(size, files=None):
+    image = MagicMock()
+    image.attrs = {"Size": size, "RootFS": {"Layers": ["sha256:a", "sha256:b"]}}
+    image.history.return_value = [
+        {"CreatedBy": "/bin/sh -c pip install   -r requirements.txt", "Size": size - 100},
+        {"CreatedBy": "/bin/sh -c #(nop)  CMD [\"bash\"]", "Size": 0},
+        {"CreatedBy": "/bin/sh -c #(nop) ADD file:abc in /", "Size": 100},
+    ]
+    if files is not None:
+        saved = make_tar(
+            {
+                "abc/layer.tar": make_tar(files[0]),
+                "def/layer.tar": make_tar(files[1]),
+                "manifest.json": b"[]",
+            }
+        )
+        # docker save streams the image in chunks.
+        image.save.return_value = iter([saved[i : i + 1000] for i in range(0, len(saved), 1000)])
+    return image
+
+
+def test_inspect_image():
+    image = fake_image(
+        1000,
+        files=[
+            {"bin/sh": b"x" * 300, "etc/passwd": b"x" * 10},
+            {"usr/lib/big.so": b"x" * 500, "app/.wh.removed": b"", "app/main.py": b"x" * 20},
+        ],
+    )
+
+    report = inspect_image(image, files=2)
+
+    assert report.size == 1000
+    assert report.layers == 2
+    assert report.layer_sizes == [
+        {"size": 100, "command": "/bin/sh -c #(nop) ADD file:abc in /"},
+        {"size": 900, "command": "/bin/sh -c pip install -r requirements.txt"},
+    ]
+    assert report.largest_files == [
+        {"path": "/usr/lib/big.so", "size": 500},
+        {"path": "/bin/sh", "size": 300},
+    ]
+
+
+INVENTORY = {
+    "images": [
+        {
+            "name": "image0",
+            "vars": {"context": "."},
+            "max_size_increase": 10,
+            "stages": [
+                {
+                    "name": "build",
+                    "task_type": "docker_build",
+                    "dockerfile": "Dockerfile",
+                    "output": [{"registry": "registry", "tag": "tag"}],
+                }
+            ],
+        }
+    ]
+}
+
+
+@patch("sonar.sonar.create_ecr_repository")
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build")
+def test_images_that_grow_too_much_fail_the_stage(
+    patched_docker_build, _docker_tag, patched_docker_push, _create_ecr_repository
+):
+    def run():
+        return process_image(
+            "image0",
+            skip_tags=[],
+            include_tags=[],
+            inventory=INVENTORY,
+            build_options={"pipeline": True},
+        )
+
+    patched_docker_build.return_value = fake_image(1000)
+    pipeline = run()
+    assert pipeline["image0"]["build"]["image-analytics"]["size"] == 1000
+    assert pipeline["image0"]["build"]["image-analytics"]["size_increase"] is None
+
+    patched_docker_build.return_value = fake_image(1050)
+    pipeline = run()
+    assert pipeline["image0"]["build"]["image-analytics"]["size_increase"] == 5.0
+
+    patched_docker_push.reset_mock()
+    patched_docker_build.return_value = fake_image(1300)
+    with pytest.raises(SonarBuildError, match="grew 23.8%"):
+        run()
+    patched_docker_push.assert_not_called()
+
+    # The failed build is not the new reference.
+    patched_docker_build.return_value = fake_image(1100)
+    run()
@@ -0,0 +1,129 @@
+import pytest
+
+from sonar import analyze
+from sonar.analyze import analyze_dockerfile, analyze_image, format_reports
+
+DOCKERFILE = """\
+FROM python:3.11
+ARG VERSION_ID
+WORKDIR /app
+COPY . .
+RUN pip install -r requirements.txt
+RUN make
+LABEL version=$VERSION_ID
+"""
+
+FIXED_DOCKERFILE = """\
+FROM python:3.11@sha256:0123
+WORKDIR /app
+COPY requirements.txt .
+RUN pip install -r requirements.txt
+COPY . .
+RUN make
+ARG VERSION_ID
+LABEL version=$VERSION_ID
+"""
+
+VOLATILE = {"VERSION_ID": "$(inputs.params.version_id)"}
+
+
+def rules(report):
+    return [(f.line, f.rule) for f in report.findings]
+
+
+def test_cache_busting_patterns_are_found():
+    buildargs = {"VERSION_ID": "1"}
+    report = analyze_dockerfile("image/build", "Dockerfile", DOCKERFILE, buildargs, VOLATILE)
+    assert rules(report) == [(1, "unpinned-base"), (2, "volatile-arg"), (4, "copy-before-install")]
+    assert "line 5" in report.findings[1].message
+    # The LABEL uses the ARG, so it can not be a volatile buildarg.
+    assert "volatile_buildargs" not in report.findings[1].message
+    assert (report.instructions, report.cached_on_new_run, report.cached_on_changes) == (5, 2, 1)
+
+    fixed = analyze_dockerfile("image/build", "Dockerfile", FIXED_DOCKERFILE, buildargs, VOLATILE)
+    assert fixed.findings == []
+    assert (fixed.instructions, fixed.cached_on_new_run, fixed.cached_on_changes) == (6, 5, 3)
+
+    # The same ARG, with a value that does not change, does not miss the cache.
+    report = analyze_dockerfile("image/build", "Dockerfile", DOCKERFILE, buildargs, {})
+    assert "volatile-arg" not in [f.rule for f in report.findings]
+    assert report.cached_on_new_run == 5
+
+
+def test_stages_missing_the_cache_are_followed():
+    dockerfile = """\
+ARG BASE=ubuntu:22.04
+FROM $BASE AS build
+ARG VERSION_ID
+RUN make
+FROM scratch
+COPY --from=build /app /app
+FROM ${BASE}
+RUN echo unused
+"""
+    report = analyze_dockerfile("image/build", "Dockerfile", dockerfile, {}, VOLATILE)
+    # The last stage only needs its base image.
+    assert (report.instructions, report.cached_on_new_run) == (1, 1)
+
+    dockerfile = dockerfile.rsplit("FROM ${BASE}", 1)[0]
+    report = analyze_dockerfile("image/build", "Dockerfile", dockerfile, {}, VOLATILE)
+    assert (report.instructions, report.cached_on_new_run) == (2, 0)
+    assert rules(report) == [(2, "unpinned-base"), (3, "volatile-arg")]
+
+
+@pytest.fixture
+def inventory(tmp_path):
+    (tmp_path / "Dockerfile").write_text(DOCKERFILE)
+    (tmp_path / "Dockerfile.ubuntu").write_text("FROM ubuntu\nARG BUILD\nRUN apt-get update\n")
+    (tmp_path / "data").write_bytes(b"0" * 2048)
+
+    return {
+        "images": [
+            {
+                "name": "image0",
+                "vars": {"context": str(tmp_path), "template_context": str(tmp_path)},
+                "stages": [
+                    {
+                        "name": "build",
+                        "task_type": "docker_build",
+                        "dockerfile": str(tmp_path / "Dockerfile"),
+                        "buildargs": {"VERSION_ID": "$(inputs.params.version_id)"},
+                        "output": [{"registry": "quay.io/org/image0", "tag": "1.0"}],
+                    },
+                    {
+                        "name": "template",
+                        "task_type": "dockerfile_template",
+                        "distro": "ubuntu",
+                        "output": [{"dockerfile": str(tmp_path / "Dockerfile.rendered")}],
+                    },
+                    {
+                        "name": "build-template",
+                        "task_type": "docker_build",
+                        "dockerfile": "$(stages['template'].outputs[0].dockerfile)",
+                        "buildargs": {"BUILD": "$(inputs.params.build_number)"},
+                        "output": [{"registry": "quay.io/org/image1", "tag": "1.0"}],
+                    },
+                ],
+            }
+        ]
+    }
+
+
+def test_analyze_image(inventory, tmp_path, monkeypatch):
+    monkeypatch.setattr(analyze, "LARGE_CONTEXT", 1024)
+
+    volatile = ["version_id", "build_number"]
+    reports = analyze_image("image0", [], [], {"build_number": "1"}, inventory, volatile)
+    assert [r.name for r in reports] == ["image0/build", "image0/template"]
+    assert rules(reports[0])[0] == (0, "missing-dockerignore")
+    assert rules(reports[1]) == [
+        (0, "missing-dockerignore"),
+        (1, "unpinned-base"),
+        (2, "volatile-arg"),
+    ]
+    assert reports[1].dockerfile == str(tmp_path / "Dockerfile.ubuntu")
+
+    (tmp_path / ".dockerignore").write_text("data\n")
+    reports = analyze_image("image0", [], [], {"build_number": "1"}, inventory)
+    assert rules(reports[1]) == [(1, "unpinned-base")]
+    assert "Cached: 2 of 5 instructions when only the parameters change" in format_reports(reports)
@@ -1,11 +1,12 @@
-from types import SimpleNamespace as sn
-from unittest.mock import patch, mock_open, call
+import os
+from unittest.mock import ANY, patch, mock_open, call
 
 from sonar.builders.docker import get_docker_build_cli_args
 from sonar.sonar import (
     process_image,
     find_dockerfile,
 )
+from sonar.workspace import Workspace
 
 
 @patch("sonar.sonar.docker_push")
@@ -36,26 +37,28 @@ def test_dockerfile_from_url(
     patched_create_ecr_repository.assert_called_once()
 
 
-@patch(
-    "sonar.sonar.tempfile.NamedTemporaryFile", return_value=sn(name="random-filename")
-)
 @patch("sonar.sonar.urlretrieve")
-def test_find_dockerfile_fetches_file_from_url(patched_urlretrieve, patched_tempfile):
+def test_find_dockerfile_fetches_file_from_url(patched_urlretrieve):
     # If passed a dockerfile which starts with https://
-    # make sure urlretrieve and NamedTemporaryFile is called
-    dockerfile = find_dockerfile("https://something")
+    # make sure it is downloaded into the workspace, once per URL.
+    workspace = Workspace()
+    dockerfile = find_dockerfile("https://something", workspace)
 
+    patched_urlretrieve.assert_called_once_with("https://something", dockerfile)
+    assert os.path.dirname(dockerfile) == workspace.directory
+    assert find_dockerfile("https://something", workspace) == dockerfile
     patched_urlretrieve.assert_called_once()
-    patched_tempfile.assert_called_once_with(delete=False)
-    assert dockerfile == "random-filename"
 
     patched_urlretrieve.reset_mock()
 
     # If dockerfile is a localfile, urlretrieve should not be called.
-    dockerfile = find_dockerfile("/localfile/somewhere")
+    dockerfile = find_dockerfile("/localfile/somewhere", workspace)
     patched_urlretrieve.assert_not_called()
     assert dockerfile == "/localfile/somewhere"
 
+    workspace.close()
+    assert not os.path.exists(workspace.directory)
+
 
 @patch("sonar.sonar.docker_tag")
 @patch("sonar.sonar.docker_build")
@@ -71,7 +74,7 @@ def test_labels_are_passed_to_docker_build(_docker_build, _docker_tag):
 
     # the labels have been specified in the test scenario and should be passed to docker_build.
     calls = [
-        call(".", "Dockerfile", buildargs={}, labels={"label-0": "value-0", "label-1": "value-1", "label-2": "value-2"}, platform=None)
+        call(".", "Dockerfile", buildargs={}, labels={"label-0": "value-0", "label-1": "value-1", "label-2": "value-2"}, platform=None, progress=None, tag=ANY)
     ]
 
     _docker_build.assert_has_calls(calls)
@@ -102,8 +105,8 @@ def test_platform_is_passed_to_docker_build(_docker_build, _docker_tag):
     )
 
     calls = [
-        call(".", "Dockerfile", buildargs={}, labels={"label-0": "value-0"}, platform="linux/amd64"),
-        call(".", "Dockerfile", buildargs={}, labels={"label-1": "value-1"}, platform=None)
+        call(".", "Dockerfile", buildargs={}, labels={"label-0": "value-0"}, platform="linux/amd64", progress=None, tag=ANY),
+        call(".", "Dockerfile", buildargs={}, labels={"label-1": "value-1"}, platform=None, progress=None, tag=ANY)
     ]
 
     _docker_build.assert_has_calls(calls)
@@ -114,3 +117,5 @@ def test_get_docker_build_cli_args():
     assert "docker buildx build --load --progress plain . -f dockerfile -t image:latest" == " ".join(get_docker_build_cli_args(".", "dockerfile", "image:latest", None, None, None))
     assert "docker buildx build --load --progress plain . -f dockerfile -t image:latest --build-arg a=1 --build-arg long_arg=long_value --label l1=v1 --label l2=v2 --platform linux/amd64" == " ".join(
         get_docker_build_cli_args(".", "dockerfile", "image:latest", {"a": "1", "long_arg": "long_value"}, {"l1": "v1", "l2": "v2"}, "linux/amd64"))
+    assert "docker buildx build --builder remote --load --progress plain . -f dockerfile -t image:latest" == " ".join(
+        get_docker_build_cli_args(".", "dockerfile", "image:latest", None, None, None, builder="remote"))
@@ -0,0 +1,111 @@
+import datetime
+from types import SimpleNamespace
+from unittest.mock import Mock, call, patch
+
+import pytest
+
+from sonar.cleanup import (
+    collect_garbage,
+    local_image_tag,
+    parse_duration,
+    parse_size,
+)
+from sonar.sonar import process_image
+
+NOW = datetime.datetime(2024, 1, 10, tzinfo=datetime.timezone.utc)
+
+
+def image(tag, created, size):
+    return SimpleNamespace(tags=[tag], attrs={"Created": created, "Size": size})
+
+
+def test_local_image_tags_are_deterministic_and_distinct():
+    assert local_image_tag("run0", "image", "build") == "sonar-local/image:run0-build"
+
+    tag = local_image_tag("run0", "My/Image", "build stage")
+    assert tag.startswith("sonar-local/my-image:run0-build-stage-")
+    assert local_image_tag("run0", "My/Image", "build stage") == tag
+    assert local_image_tag("run1", "My/Image", "build stage") != tag
+
+    long_stages = ["stage-" + "x" * 200 + "-a", "stage-" + "x" * 200 + "-b"]
+    tags = [local_image_tag("run0", "image", stage) for stage in long_stages]
+    assert tags[0] != tags[1]
+    assert all(len(t.split(":")[1]) <= 128 for t in tags)
+
+    # Names that are the same once sanitized still get different tags.
+    colliding = [("a b", "build"), ("a/b", "build"), ("a-b", "build"), ("A-b", "build")]
+    colliding += [("image", "build stage"), ("image", "build/stage"), ("image", "build-stage")]
+    tags = {local_image_tag("run0", image, stage) for image, stage in colliding}
+    assert len(tags) == len(colliding)
+
+
+def test_parse_policies():
+    assert parse_duration("90") == 90
+    assert parse_duration("12h") == 12 * 3600
+    assert parse_duration("7d") == 7 * 86400
+    assert parse_size("500M") == 500 * 1024 ** 2
+    assert parse_size("50GiB") == 50 * 1024 ** 3
+
+    with pytest.raises(ValueError):
+        parse_duration("soon")
+
+
+@patch("sonar.cleanup.docker_client")
+def test_collect_garbage_by_age_and_size(patched_docker_client):
+    client = patched_docker_client.return_value
+    client.images.list.return_value = [
+        image("sonar-local/a:2", "2024-01-09T00:00:00.123456789Z", 300),
+        image("sonar-local/a:0", "2024-01-01T00:00:00Z", 100),
+        image("sonar-local/a:1", "2024-01-08T00:00:00Z", 200),
+        image("sonar-local/a:3", "2024-01-09T12:00:00Z", 400),
+    ]
+    client.images.prune.return_value = {"SpaceReclaimed": 1000}
+
+    removed = collect_garbage(max_age=7 * 86400, max_size=600, now=NOW)
+
+    # a:0 is older than a week, and a:1 and a:2 are the oldest of the rest.
+    assert removed == ["sonar-local/a:0", "sonar-local/a:1", "sonar-local/a:2"]
+    client.images.list.assert_called_once_with(filters={"reference": "sonar-local/*"})
+    client.images.prune.assert_called_once_with(filters={"dangling": True})
+
+
+@patch("sonar.cleanup.docker_client")
+@patch("sonar.sonar.create_ecr_repository")
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build")
+def test_images_created_by_a_run_are_removed(
+    patched_docker_build, _docker_tag, _docker_push, _create_ecr_repository, patched_docker_client
+):
+    client = patched_docker_client.return_value
+    client.images.prune.return_value = {"SpaceReclaimed": 1000}
+
+    inventory = {
+        "images": [
+            {
+                "name": "image0",
+                "vars": {"context": "."},
+                "stages": [
+                    {
+                        "name": "build",
+                        "task_type": "docker_build",
+                        "dockerfile": "Dockerfile",
+                        "output": [{"registry": "registry", "tag": "tag"}],
+                    }
+                ],
+            }
+        ]
+    }
+
+    pipeline = process_image(
+        "image0",
+        skip_tags=[],
+        include_tags=[],
+        inventory=inventory,
+        build_options={"pipeline": True, "gc": True, "run_id": "run0"},
+    )
+
+    local_tag = "sonar-local/image0:run0-build"
+    assert patched_docker_build.call_args.kwargs["tag"] == local_tag
+    client.images.remove.assert_has_calls([call("registry:tag"), call(local_tag)])
+    assert pipeline["image0"]["gc"] == "removed 2 tags, reclaimed 1000 bytes"
@@ -0,0 +1,114 @@
+import base64
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+import pytest
+
+from sonar.credentials import REFRESH_MARGIN, CredentialStore, ecr_account_region
+
+ECR = "268558157000.dkr.ecr.us-east-1.amazonaws.com"
+OTHER_ECR = "123456789012.dkr.ecr.eu-west-1.amazonaws.com"
+
+
+@pytest.fixture(autouse=True)
+def docker_config(tmp_path, monkeypatch):
+    config_dir = tmp_path / "docker"
+    (config_dir / "buildx").mkdir(parents=True)
+    (config_dir / "config.json").write_text(
+        json.dumps(
+            {
+                "auths": {"quay.io": {"auth": "cXVheTpzZWNyZXQ="}},
+                "credHelpers": {ECR: "ecr-login", "gcr.io": "gcloud"},
+            }
+        )
+    )
+    monkeypatch.setenv("DOCKER_CONFIG", str(config_dir))
+    return config_dir
+
+
+def ecr_client(expires_in=12 * 3600):
+    client = MagicMock()
+
+    def get_authorization_token(registryIds):
+        token = base64.b64encode("AWS:token-{}".format(registryIds[0]).encode()).decode()
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+        return {"authorizationData": [{"authorizationToken": token, "expiresAt": expires_at}]}
+
+    client.get_authorization_token.side_effect = get_authorization_token
+    return client
+
+
+def test_ecr_account_region():
+    assert ecr_account_region(ECR) == ("268558157000", "us-east-1")
+    assert ecr_account_region("quay.io") is None
+
+
+def test_tokens_are_requested_once_per_registry():
+    client = ecr_client()
+    store = CredentialStore(lambda region: client)
+
+    assert store.credentials(ECR) == ("AWS", "token-268558157000")
+    assert store.credentials(ECR) == ("AWS", "token-268558157000")
+    assert store.credentials("quay.io") is None
+    assert client.get_authorization_token.call_count == 1
+
+    # Another run finds the token in the cache.
+    assert CredentialStore(lambda region: client).credentials(ECR) == ("AWS", "token-268558157000")
+    assert client.get_authorization_token.call_count == 1
+
+
+def test_cached_tokens_are_only_readable_by_the_user(tmp_path):
+    CredentialStore(lambda region: ecr_client()).credentials(ECR)
+
+    assert os.stat(str(tmp_path / "cache" / "ecr-tokens.json")).st_mode & 0o077 == 0
+
+
+def test_login_writes_a_docker_config_for_the_run(docker_config):
+    store = CredentialStore(lambda region: ecr_client())
+
+    config_dir = store.login([ECR, OTHER_ECR, "quay.io", ECR])
+    assert os.environ["DOCKER_CONFIG"] == config_dir != str(docker_config)
+    assert os.path.islink(os.path.join(config_dir, "buildx"))
+
+    with open(os.path.join(config_dir, "config.json")) as f:
+        config = json.load(f)
+    assert sorted(config["auths"]) == sorted([ECR, OTHER_ECR, "quay.io"])
+    assert base64.b64decode(config["auths"][OTHER_ECR]["auth"]) == b"AWS:token-123456789012"
+    assert config["credHelpers"] == {ECR: "", OTHER_ECR: "", "gcr.io": "gcloud"}
+
+    store.logout()
+    assert os.environ["DOCKER_CONFIG"] == str(docker_config)
+    assert not os.path.exists(config_dir)
+
+
+def test_tokens_are_used_instead_of_the_creds_store(docker_config):
+    (docker_config / "config.json").write_text(json.dumps({"credsStore": "desktop"}))
+    store = CredentialStore(lambda region: ecr_client())
+
+    with open(os.path.join(store.login([ECR]), "config.json")) as f:
+        config = json.load(f)
+    # Other registries keep using the credential store.
+    assert config["credsStore"] == "desktop"
+    assert config["credHelpers"] == {ECR: ""}
+    assert ECR in config["auths"]
+
+    store.logout()
+
+
+def test_tokens_about_to_expire_are_refreshed():
+    client = ecr_client(expires_in=REFRESH_MARGIN - 60)
+    store = CredentialStore(lambda region: client)
+    store.login([ECR])
+    assert client.get_authorization_token.call_count == 1
+
+    client.get_authorization_token.side_effect = ecr_client().get_authorization_token.side_effect
+    store.refresh(ECR)
+    assert client.get_authorization_token.call_count == 2
+    assert store.tokens[ECR].expires_at > time.time() + REFRESH_MARGIN
+
+    store.refresh(ECR)
+    assert client.get_authorization_token.call_count == 2
+    store.logout()
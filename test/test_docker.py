@@ -29,7 +29,7 @@ def test_docker_push_is_retried(mocker: MockerFixture):
 
 def test_docker_push_is_retried_and_works(mocker: MockerFixture):
 
-    ok = SimpleNamespace(returncode=0)
+    ok = SimpleNamespace(returncode=0, stdout=b"")
     sp = mocker.patch("sonar.builders.docker.subprocess")
     sp.PIPE = "|PIPE|"
     sp.run = Mock()
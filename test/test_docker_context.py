@@ -0,0 +1,136 @@
+from unittest.mock import patch
+
+import pytest
+
+from sonar import docker_context
+from sonar.docker_context import build_manifest, is_excluded, parse_dockerignore
+from sonar.sonar import process_image
+
+
+@pytest.fixture(autouse=True)
+def hash_cache(monkeypatch):
+    monkeypatch.setattr(docker_context, "HASH_CACHE", docker_context.HashCache())
+
+
+@pytest.fixture
+def context(tmp_path):
+    path = tmp_path / "context"
+    (path / "src" / "pkg").mkdir(parents=True)
+    (path / "node_modules" / "dep").mkdir(parents=True)
+    (path / "src" / "main.py").write_text("print('hello')\n")
+    (path / "src" / "pkg" / "module.py").write_text("x = 1\n")
+    (path / "src" / "pkg" / "module.pyc").write_text("compiled")
+    (path / "node_modules" / "dep" / "index.js").write_text("module.exports = 1\n")
+    (path / "README.md").write_text("readme\n")
+    (path / ".dockerignore").write_text("# comment\nnode_modules\n**/*.pyc\n*.md\n!README.md\n")
+    return path
+
+
+def test_dockerignore_patterns():
+    patterns = parse_dockerignore("/build\n**/*.log\ndocs/*.md\n!docs/index.md\n")
+
+    assert is_excluded("build", patterns)
+    assert is_excluded("build/output/a.o", patterns)
+    assert is_excluded("a.log", patterns)
+    assert is_excluded("deep/in/tree/a.log", patterns)
+    assert is_excluded("docs/intro.md", patterns)
+    assert not is_excluded("docs/index.md", patterns)
+    assert not is_excluded("docs/nested/intro.md", patterns)
+    assert not is_excluded("src/build", patterns)
+
+
+def test_manifest_respects_dockerignore(context):
+    manifest = build_manifest(str(context))
+
+    assert sorted(manifest.files) == [
+        ".dockerignore",
+        "README.md",
+        "src/main.py",
+        "src/pkg/module.py",
+    ]
+    assert manifest.dockerignore == str(context / ".dockerignore")
+
+
+def test_dockerfile_dockerignore_is_found_relative_to_the_context(context, tmp_path, monkeypatch):
+    (context / "docker").mkdir()
+    (context / "docker" / "Dockerfile.dockerignore").write_text("src\n")
+    monkeypatch.chdir(tmp_path)
+
+    manifest = build_manifest(str(context), "docker/Dockerfile")
+
+    assert manifest.dockerignore == str(context / "docker" / "Dockerfile.dockerignore")
+    assert "src/main.py" not in manifest.files
+    assert docker_context.find_dockerignore("context", "docker/Dockerfile") == "context/docker/Dockerfile.dockerignore"
+
+
+def test_manifest_digest_changes_with_contents(context):
+    first = build_manifest(str(context)).digest
+    assert build_manifest(str(context)).digest == first
+
+    (context / "node_modules" / "dep" / "index.js").write_text("ignored\n")
+    assert build_manifest(str(context)).digest == first
+
+    (context / "src" / "main.py").write_text("print('bye')\n")
+    assert build_manifest(str(context)).digest != first
+
+
+def test_unchanged_files_are_not_hashed_again(context):
+    build_manifest(str(context))
+
+    with patch("sonar.docker_context.hash_file") as patched_hash_file:
+        build_manifest(str(context))
+        patched_hash_file.assert_not_called()
+
+        (context / "src" / "main.py").write_text("print('changed')\n")
+        build_manifest(str(context))
+        patched_hash_file.assert_called_once()
+
+
+def test_snapshot_detects_unchanged_contexts_between_runs(context):
+    assert not docker_context.snapshot(str(context)).unchanged
+
+    # A new process starts with an empty hash cache.
+    docker_context.HASH_CACHE = docker_context.HashCache()
+    assert docker_context.snapshot(str(context)).unchanged
+
+
+@patch("sonar.sonar.create_ecr_repository")
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build")
+def test_stages_sharing_a_context_hash_it_once(
+    _docker_build, _docker_tag, _docker_push, _create_ecr_repository, context
+):
+    stage = {
+        "task_type": "docker_build",
+        "dockerfile": "Dockerfile",
+        "output": [{"registry": "registry", "tag": "tag"}],
+    }
+    inventory = {
+        "images": [
+            {
+                "name": "image0",
+                "vars": {"context": str(context)},
+                "stages": [
+                    dict(stage, name="build-0"),
+                    dict(stage, name="build-1"),
+                ],
+            }
+        ]
+    }
+
+    with patch(
+        "sonar.docker_context.build_manifest", wraps=docker_context.build_manifest
+    ) as patched_build_manifest:
+        pipeline = process_image(
+            "image0",
+            skip_tags=[],
+            include_tags=[],
+            inventory=inventory,
+            build_options={"pipeline": True, "snapshot_contexts": True},
+        )
+
+    patched_build_manifest.assert_called_once()
+    digest = pipeline["image0"]["build-0"]["docker-context-digest"]
+    assert digest.startswith("sha256:")
+    assert "docker-context-digest" not in pipeline["image0"]["build-1"]
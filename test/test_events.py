@@ -0,0 +1,102 @@
+import io
+import json
+from unittest.mock import patch
+
+import pytest
+
+from sonar.events import Event, NDJSONWriter, iter_events
+from sonar.sonar import SonarAPIError, process_image
+
+
+def run_scenario6(listener, **build_options):
+    return process_image(
+        image_name="image1",
+        skip_tags=[],
+        include_tags=["test_continue_on_errors"],
+        build_args={},
+        build_options=dict(event_listeners=[listener], **build_options),
+        inventory="test/yaml_scenario6.yaml",
+    )
+
+
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build")
+def test_events_are_emitted(_docker_build, _docker_tag, mocked_docker_push):
+    mocked_docker_push.side_effect = ["All ok!", SonarAPIError("fake-error"), "All ok!"]
+
+    received = []
+    run_scenario6(received.append)
+
+    types = [e.type for e in received if e.type != "message"]
+    assert types == [
+        "image_start",
+        "stage_start", "push_result", "stage_end",
+        "stage_start", "push_result", "stage_end",
+        "stage_start", "push_result", "stage_end",
+        "image_end",
+    ]
+    assert all(e.image == "image1" for e in received)
+
+    pushes = [e for e in received if e.type == "push_result"]
+    assert [e.stage for e in pushes] == ["stage0", "stage1", "stage2"]
+    assert pushes[1].data == {"registry": "some-registry", "tag": "something", "error": "fake-error"}
+
+    ends = [e for e in received if e.type == "stage_end"]
+    assert [e.data["status"] for e in ends] == ["success", "error", "success"]
+    assert received[-1].stage is None
+    assert received[-1].data["errors"] == 1
+
+    timestamps = [e.timestamp for e in received]
+    assert timestamps == sorted(timestamps)
+
+    # progress is only requested when there are listeners
+    assert _docker_build.call_args.kwargs["progress"] is not None
+
+
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build")
+def test_events_are_written_as_json_lines(_docker_build, _docker_tag, _docker_push):
+    stream = io.StringIO()
+    run_scenario6(NDJSONWriter(stream))
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert lines[0]["type"] == "image_start"
+    assert lines[-1]["type"] == "image_end"
+    assert set(lines[0]) == {"type", "image", "stage", "timestamp", "data"}
+
+
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build")
+def test_iter_events(_docker_build, _docker_tag, mocked_docker_push):
+    events = list(iter_events(run_scenario6))
+    assert events[0].type == "image_start"
+    assert events[-1].type == "image_end"
+
+    mocked_docker_push.side_effect = SonarAPIError("fake-error")
+    events = iter_events(lambda listener: run_scenario6(listener, continue_on_errors=False))
+    with pytest.raises(SonarAPIError):
+        for event in events:
+            pass
+
+    assert event.type == "stage_end"
+    assert event.data["status"] == "failure"
+
+
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build")
+def test_failing_listeners_are_detached(_docker_build, _docker_tag, docker_push):
+    received = []
+
+    def broken(event):
+        received.append(event)
+        raise BrokenPipeError()
+
+    run_scenario6(broken, continue_on_errors=False)
+
+    # The run finished without the listener.
+    assert docker_push.call_count == 3
+    assert len(received) == 1
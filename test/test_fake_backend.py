@@ -0,0 +1,183 @@
+import time
+
+import pytest
+
+import sonar.sonar
+from sonar.builders import SonarAPIError
+from sonar.builders.fake import FakeBackend
+from sonar.sonar import process_image
+
+
+def make_inventory(stages: int = 1):
+    build_stages = [
+        {
+            "name": "build{}".format(i),
+            "task_type": "docker_build",
+            "dockerfile": "Dockerfile",
+            "buildargs": {"index": str(i)},
+            "output": [{"registry": "registry/image", "tag": "$(inputs.params.version)-{}".format(i)}],
+        }
+        for i in range(stages)
+    ]
+
+    return {
+        "vars": {"version": "1.0"},
+        "images": [
+            {
+                "name": "image0",
+                "vars": {"context": "."},
+                "stages": build_stages
+                + [
+                    {
+                        "name": "release",
+                        "task_type": "tag_image",
+                        "source": {
+                            "registry": "$(stages['build0'].outputs[0].registry)",
+                            "tag": "$(stages['build0'].outputs[0].tag)",
+                        },
+                        "destination": [{"registry": "release/image", "tag": "latest"}],
+                    },
+                ],
+            }
+        ],
+    }
+
+
+def run(backend, inventory, **options):
+    return process_image(
+        "image0",
+        skip_tags=[],
+        include_tags=[],
+        build_args={"version": "1.0"},
+        inventory=inventory,
+        build_options=dict(options, backend=backend, pipeline=True),
+    )
+
+
+def test_inventory_runs_end_to_end():
+    backend = FakeBackend(strict_pulls=True)
+
+    pipeline = run(backend, make_inventory())
+
+    assert pipeline["image0"]["release"]["docker-image-push"] == "release/image:latest"
+    assert sorted(backend.registry) == ["registry/image:1.0-0", "release/image:latest"]
+    assert backend.registry["release/image:latest"] is backend.registry["registry/image:1.0-0"]
+    assert backend.repositories == {"registry/image", "release/image"}
+
+
+def test_failures_are_captured():
+    backend = FakeBackend(failure_rate={"push": 1})
+
+    pipeline = run(backend, make_inventory(3))
+
+    assert backend.counts["push"] == 4
+    assert "simulated failure" in str(pipeline["image0"]["build0"]["docker-image-push/error"])
+
+    with pytest.raises(SonarAPIError, match="simulated failure"):
+        run(FakeBackend(failure_rate={"push": 1}), make_inventory(), fail_on_errors=True)
+
+
+def test_throttled_operations_fail(monkeypatch):
+    monkeypatch.setattr(sonar.sonar, "PUSH_RETRY_DELAY", 0)
+    # A single push is allowed, and the bucket takes minutes to refill.
+    backend = FakeBackend(rate_limits={"push": 0.001})
+
+    pipeline = run(backend, make_inventory(2))
+
+    assert "ThrottlingException" in str(pipeline["image0"]["build1"]["docker-image-push/error"])
+    assert list(backend.registry) == ["registry/image:1.0-0"]
+
+
+def test_concurrent_operations_are_limited():
+    backend = FakeBackend(latency={"pull": 0.05}, max_concurrency={"pull": 2})
+    inventory = {
+        "images": [
+            {
+                "name": "image0",
+                "stages": [
+                    {
+                        "name": "tag{}".format(i),
+                        "task_type": "tag_image",
+                        "source": {"registry": "source{}".format(i), "tag": "latest"},
+                        "destination": [{"registry": "dest", "tag": str(i)}],
+                    }
+                    for i in range(4)
+                ],
+            }
+        ]
+    }
+
+    start = time.monotonic()
+    run(backend, inventory, prefetch=True)
+
+    # Four prefetched pulls, two at a time.
+    assert time.monotonic() - start >= 0.1
+    assert backend.counts["pull"] == 4
+
+
+def test_thousands_of_stages():
+    backend = FakeBackend(seed=0)
+
+    run(backend, make_inventory(2000))
+
+    assert backend.counts["build"] == 2000
+    assert len(backend.registry) == 2001
+
+
+def test_unknown_operations_are_rejected():
+    with pytest.raises(ValueError):
+        FakeBackend(latency={"deploy": 1})
+
+
+def test_volatile_metadata_is_added_after_the_build():
+    backend = FakeBackend()
+    inventory = make_inventory()
+    build = inventory["images"][0]["stages"][0]
+    # version_id is new every run.
+    build["labels"] = {"version_id": "$(inputs.params.version_id)", "team": "sonar"}
+    build["volatile_labels"] = ["version_id"]
+
+    run(backend, inventory)
+    pushed = backend.registry["registry/image:1.0-0"]
+    version_id = pushed.annotations["version_id"]
+    assert pushed.labels == {"team": "sonar"}
+
+    # Only the version id changed, so the image is not pushed again.
+    second = run(backend, inventory)["image0"]["build0"]
+    assert "docker-image-push/unchanged" in second
+    assert backend.registry["registry/image:1.0-0"] is pushed
+    assert backend.counts["push"] == 3
+    assert backend.counts["add_metadata"] == 1
+
+    build["volatile_as"] = "labels"
+    build["labels"]["team"] = "build"
+    run(backend, inventory)
+    pushed = backend.registry["registry/image:1.0-0"]
+    assert pushed.labels["team"] == "build"
+    assert pushed.labels["version_id"] != version_id
+    assert backend.counts["add_metadata"] == 2
+
+
+def test_volatile_metadata_has_to_be_an_input():
+    inventory = make_inventory()
+    inventory["images"][0]["stages"][0]["volatile_buildargs"] = ["version_id"]
+
+    with pytest.raises(ValueError, match="volatile_buildargs version_id is not one of the buildargs"):
+        run(FakeBackend(), inventory)
+
+
+def test_volatile_buildargs_can_not_be_used_by_the_dockerfile(tmp_path):
+    inventory = make_inventory()
+    build = inventory["images"][0]["stages"][0]
+    build["buildargs"] = {"VERSION": "$(inputs.params.version_id)"}
+    build["volatile_buildargs"] = ["VERSION"]
+    build["dockerfile"] = str(tmp_path / "Dockerfile")
+
+    (tmp_path / "Dockerfile").write_text("FROM scratch\nARG VERSION\nLABEL a=b\n")
+    backend = FakeBackend()
+    run(backend, inventory)
+    assert "VERSION" in backend.registry["registry/image:1.0-0"].annotations
+
+    (tmp_path / "Dockerfile").write_text("FROM scratch\nARG VERSION\nENV V=${VERSION}\n")
+    with pytest.raises(ValueError, match="VERSION is used by ENV at line 3"):
+        run(FakeBackend(), inventory, continue_on_errors=False)
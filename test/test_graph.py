@@ -0,0 +1,159 @@
+import threading
+
+import pytest
+
+from sonar.builders import SonarAPIError
+from sonar.builders.fake import FakeBackend
+from sonar.graph import DependencyCycleError, run_graph, topological_levels
+from sonar.sonar import find_image_dependencies, process_images
+
+DEPENDENCIES = {
+    "bundle": ["server", "tools"],
+    "server": ["base"],
+    "tools": ["base"],
+    "base": [],
+    "docs": [],
+}
+
+
+def test_topological_levels():
+    assert topological_levels(DEPENDENCIES) == [
+        ["base", "docs"],
+        ["server", "tools"],
+        ["bundle"],
+    ]
+
+    with pytest.raises(DependencyCycleError, match="a -> b -> a"):
+        topological_levels({"a": ["b"], "b": ["a"]})
+
+
+def test_images_run_after_their_dependencies():
+    finished = []
+    both_running = threading.Barrier(2, timeout=5)
+
+    def run(name, upstream):
+        assert set(upstream) == set(DEPENDENCIES[name])
+        assert all(d in finished for d in DEPENDENCIES[name])
+        if name in ("server", "tools"):
+            # Fails unless both run at the same time.
+            both_running.wait()
+        finished.append(name)
+        return name.upper()
+
+    results = run_graph(DEPENDENCIES, run)
+
+    assert {name: r.result for name, r in results.items()} == {
+        name: name.upper() for name in DEPENDENCIES
+    }
+
+
+def test_images_depending_on_failed_images_do_not_run():
+    ran = []
+
+    def run(name, upstream):
+        ran.append(name)
+        if name == "server":
+            raise ValueError("build failed")
+
+    results = run_graph(DEPENDENCIES, run)
+
+    assert "bundle" not in ran
+    assert str(results["server"].error) == "build failed"
+    assert results["bundle"].skipped
+    assert results["tools"].error is None
+
+
+@pytest.fixture
+def inventory(tmp_path):
+    (tmp_path / "Dockerfile.base").write_text("FROM ubuntu:22.04\n")
+    (tmp_path / "Dockerfile.server").write_text("ARG BASE\nFROM $BASE\n")
+    (tmp_path / "Dockerfile.tools").write_text("FROM quay.io/org/base:1.0\n")
+
+    def image(name, buildargs=None, **extra):
+        return dict(
+            name=name,
+            vars={"context": str(tmp_path)},
+            stages=[
+                {
+                    "name": "build",
+                    "task_type": "docker_build",
+                    "dockerfile": str(tmp_path / "Dockerfile.{}".format(name)),
+                    "buildargs": buildargs or {},
+                    "output": [{"registry": "quay.io/org/" + name, "tag": "1.0"}],
+                }
+            ],
+            **extra,
+        )
+
+    return {
+        "images": [
+            image("server", {"BASE": "quay.io/org/base:1.0"}),
+            image("tools"),
+            image("base"),
+            image("docs", depends_on=["tools"]),
+        ]
+    }
+
+
+def test_dependencies_are_found_in_dockerfiles(inventory):
+    dependencies = find_image_dependencies(
+        ["server", "tools", "base", "docs"], [], [], inventory=inventory
+    )
+
+    assert dependencies == {
+        "server": ["base"],
+        "tools": ["base"],
+        "base": [],
+        "docs": ["tools"],
+    }
+
+
+def test_upstream_digests_are_passed_to_downstream_builds(inventory):
+    backend = FakeBackend(strict_pulls=True)
+
+    pipeline = process_images(
+        ["server", "base"],
+        [],
+        [],
+        inventory=inventory,
+        build_options={"backend": backend, "pipeline": True, "prefetch": True},
+    )
+
+    assert set(pipeline) == {"server", "base"}
+    digest = backend.registry["quay.io/org/base:1.0"].id
+    builds = [args for name, args in backend.calls if name == "build"]
+    assert builds[1][2] == {"BASE": "quay.io/org/base:1.0@" + digest}
+    # The base image was built in the run, so it is not prefetched.
+    assert ("pull", ("quay.io/org/base", "1.0")) not in backend.calls
+
+
+def test_failed_images_fail_the_run(inventory):
+    backend = FakeBackend(failure_rate={"push": 1})
+
+    with pytest.raises(SonarAPIError, match="simulated failure"):
+        process_images(
+            ["server", "base"],
+            [],
+            [],
+            inventory=inventory,
+            build_options={"backend": backend, "continue_on_errors": False},
+        )
+
+    assert backend.counts["build"] == 1
+
+
+def test_images_of_a_run_share_the_version_id(inventory, monkeypatch):
+    monkeypatch.delenv("version_id", raising=False)
+    for image in inventory["images"]:
+        image["stages"][0]["output"][0]["tag"] = "$(inputs.params.version_id)"
+    inventory["images"][0]["stages"][0]["buildargs"] = {
+        "BASE": "quay.io/org/base:$(inputs.params.version_id)"
+    }
+    backend = FakeBackend(strict_pulls=True)
+
+    process_images(["server", "base"], [], [], inventory=inventory, build_options={"backend": backend})
+
+    pushed = [tag for tag in backend.registry if tag.startswith("quay.io/org/base:")]
+    assert len(pushed) == 1
+    builds = [args for name, args in backend.calls if name == "build"]
+    assert builds[1][2]["BASE"].startswith(pushed[0] + "@")
@@ -0,0 +1,92 @@
+import pytest
+
+from sonar import history
+from sonar.builders.fake import FakeBackend
+from sonar.graph import critical_path, critical_paths, makespan, run_graph
+from sonar.history import History
+from sonar.plan import compile_plan, estimate_plans, format_estimate
+from sonar.sonar import process_image
+
+DEPENDENCIES = {"base": [], "server": ["base"], "tools": ["base"], "docs": []}
+COSTS = {"base": 10, "server": 30, "tools": 5, "docs": 20}
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setattr(history, "_history", None)
+
+
+def test_estimates_use_the_same_definition_first(tmp_path):
+    durations = History(str(tmp_path / "history.sqlite"))
+    assert durations.estimate("image", "build") is None
+
+    for duration in (10, 12, 50):
+        durations.record("image", "build", history.STAGE, duration, "old")
+    assert durations.estimate("image", "build", definition_hash="new") == 12
+
+    durations.record("image", "build", history.STAGE, 100, "new")
+    assert durations.estimate("image", "build", definition_hash="new") == 100
+    assert durations.estimate("image", "build", "push") is None
+
+
+def test_critical_paths():
+    assert critical_paths(DEPENDENCIES, COSTS) == {"base": 40, "server": 30, "tools": 5, "docs": 20}
+    assert critical_path(DEPENDENCIES, COSTS) == ["base", "server"]
+
+    # base and docs start together, then server and tools.
+    assert makespan(DEPENDENCIES, COSTS, max_workers=2) == 40
+    # docs goes after base, which is on the longest path.
+    assert makespan(DEPENDENCIES, COSTS, max_workers=1) == 65
+
+
+def test_longest_paths_start_first():
+    started = []
+
+    run_graph(DEPENDENCIES, lambda name, upstream: started.append(name), 1, COSTS)
+    assert started == ["base", "server", "docs", "tools"]
+
+    started.clear()
+    run_graph(DEPENDENCIES, lambda name, upstream: started.append(name), 1)
+    assert started == ["base", "server", "tools", "docs"]
+
+
+def test_durations_are_recorded_and_estimated(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM ubuntu:22.04\n")
+    inventory = {
+        "images": [
+            {
+                "name": "image0",
+                "vars": {"context": str(tmp_path)},
+                "stages": [
+                    {
+                        "name": "build",
+                        "task_type": "docker_build",
+                        "dockerfile": str(tmp_path / "Dockerfile"),
+                        "output": [{"registry": "quay.io/org/image0", "tag": "1.0"}],
+                    },
+                    {
+                        "name": "release",
+                        "task_type": "tag_image",
+                        "source": {"registry": "quay.io/org/image0", "tag": "1.0"},
+                        "destination": [{"registry": "quay.io/org/image0", "tag": "latest"}],
+                    },
+                ],
+            }
+        ]
+    }
+    backend = FakeBackend(latency={"build": 0.05})
+    process_image("image0", [], [], inventory=inventory, build_options={"backend": backend, "history": True})
+
+    durations = history.get_history()
+    for operation in ("build", "push", history.STAGE):
+        assert durations.estimate("image0", "build", operation) > 0
+    assert durations.estimate_image("image0") >= durations.estimate("image0", "build")
+
+    plan = compile_plan("image0", [], [], inventory=inventory)
+    estimate = estimate_plans({"image0": plan}, {"image0": []})
+    assert estimate.duration >= 0.05
+    assert [s[:2] for s in estimate.bottlenecks()] == [("image0", "build"), ("image0", "release")]
+
+    report = format_estimate(estimate)
+    assert "Critical path: image0" in report
+    assert "No history" not in report
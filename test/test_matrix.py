@@ -0,0 +1,124 @@
+from unittest.mock import ANY, patch, call
+
+import pytest
+
+from sonar.matrix import combinations, expand, matrix_errors
+from sonar.sonar import find_image, process_image
+
+
+def test_combinations_are_the_cross_product():
+    matrix = {"a": ["1", "2"], "b": ["x", "y"]}
+
+    assert list(combinations(matrix)) == [
+        {"a": "1", "b": "x"},
+        {"a": "1", "b": "y"},
+        {"a": "2", "b": "x"},
+        {"a": "2", "b": "y"},
+    ]
+
+
+def test_combinations_filters():
+    matrix = {
+        "a": ["1", "2"],
+        "b": ["x", "y"],
+        "exclude": [{"a": "1", "b": "y"}],
+    }
+    assert {"a": "1", "b": "y"} not in list(combinations(matrix))
+    assert len(list(combinations(matrix))) == 3
+
+    matrix = {
+        "a": ["1", "2", "3"],
+        "b": ["x", "y"],
+        "include": [{"a": "1"}, {"b": "x"}],
+    }
+    assert list(combinations(matrix)) == [
+        {"a": "1", "b": "x"},
+        {"a": "1", "b": "y"},
+        {"a": "2", "b": "x"},
+        {"a": "3", "b": "x"},
+    ]
+
+
+def test_combinations_with_tags():
+    matrix = {"a": ["1", "2", "3"], "b": ["x", "y"]}
+
+    assert list(combinations(matrix, skip_tags=["1", "y"])) == [
+        {"a": "2", "b": "x"},
+        {"a": "3", "b": "x"},
+    ]
+
+    # Any combination with one of the included values, each one only once.
+    assert list(combinations(matrix, include_tags=["1", "x"])) == [
+        {"a": "1", "b": "x"},
+        {"a": "1", "b": "y"},
+        {"a": "2", "b": "x"},
+        {"a": "3", "b": "x"},
+    ]
+
+    # The item itself is included, so all of its combinations are.
+    assert len(list(combinations(matrix, tags=["t"], include_tags=["t"]))) == 6
+
+
+def test_include_tags_do_not_visit_every_combination():
+    axes = {str(i): [str(v) for v in range(1000)] for i in range(6)}
+
+    selected = combinations(axes, include_tags=["_"])
+    assert list(selected) == []
+
+    selected = combinations(axes, skip_tags=[str(v) for v in range(1, 1000)])
+    assert list(selected) == [{str(i): "0" for i in range(6)}]
+
+
+def test_expand_stage():
+    stage = {
+        "name": "build",
+        "tags": ["release"],
+        "vars": {"a": "b"},
+        "matrix": {"distro": ["ubi"], "arch": ["amd64", "arm64"]},
+    }
+
+    concrete = list(expand(stage))
+    assert concrete[0] == {
+        "name": "build-ubi-amd64",
+        "tags": ["release", "ubi", "amd64"],
+        "vars": {"a": "b", "distro": "ubi", "arch": "amd64"},
+    }
+    assert concrete[1]["name"] == "build-ubi-arm64"
+
+    assert list(expand({"name": "no-matrix"})) == [{"name": "no-matrix"}]
+
+
+def test_find_image_in_matrix():
+    image = find_image("image0-ubuntu", "test/yaml_scenario13.yaml")
+    assert image["name"] == "image0-ubuntu"
+    assert image["vars"] == {"context": ".", "distro": "ubuntu"}
+
+
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build", return_value="image")
+def test_process_image_expands_stages(_docker_build, _docker_tag, _docker_push):
+    process_image(
+        image_name="image0-ubi",
+        skip_tags=["2.0"],
+        include_tags=[],
+        build_args={},
+        inventory="test/yaml_scenario13.yaml",
+    )
+
+    _docker_build.assert_called_once_with(
+        ".", "Dockerfile.ubi", buildargs={}, labels={}, platform=None, progress=None, tag=ANY
+    )
+    _docker_push.assert_called_once_with("somereg/image-ubi", "1.0-amd64")
+
+
+def test_matrix_errors():
+    assert matrix_errors({"name": "stage"}) == []
+    assert matrix_errors({"matrix": {"a": []}}) == [
+        "matrix without a name",
+        "matrix axis a has no values",
+    ]
+    assert matrix_errors({"name": "stage", "matrix": {"exclude": []}}) == ["matrix without axes"]
+
+    with pytest.raises(ValueError, match="matrix without a name"):
+        list(expand({"matrix": {"a": ["1"]}}))
@@ -0,0 +1,139 @@
+import math
+from types import SimpleNamespace
+
+import boto3
+import pytest
+from botocore.config import Config
+from botocore.exceptions import EndpointConnectionError
+from botocore.stub import Stubber
+from pytest_mock import MockerFixture
+
+from sonar import metrics, ratelimit
+from sonar.builders import SonarAPIError
+from sonar.builders.docker import count_cached_steps, docker_push
+from sonar.sonar import instrument_aws_client
+
+
+def test_render_counter_and_histogram():
+    registry = metrics.Registry()
+    counter = registry.counter("test_total", "A counter.", ["status"])
+    histogram = registry.register(
+        metrics.Histogram("test_seconds", "A histogram.", buckets=(1, 10, math.inf))
+    )
+
+    counter.inc(status="success")
+    counter.inc(2, status="failure")
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render() == "\n".join(
+        [
+            "# HELP test_total A counter.",
+            "# TYPE test_total counter",
+            'test_total{status="failure"} 2',
+            'test_total{status="success"} 1',
+            "# HELP test_seconds A histogram.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="1"} 1',
+            'test_seconds_bucket{le="10"} 2',
+            'test_seconds_bucket{le="+Inf"} 2',
+            "test_seconds_sum 5.5",
+            "test_seconds_count 2",
+            "",
+        ]
+    )
+
+
+def test_write_textfile(tmp_path):
+    registry = metrics.Registry()
+    registry.counter("test_total", "A counter.").inc()
+
+    path = tmp_path / "sonar.prom"
+    registry.write_textfile(str(path))
+
+    assert path.read_text() == registry.render()
+    assert [p.name for p in tmp_path.iterdir()] == ["sonar.prom"]
+
+
+def test_docker_push_metrics(mocker: MockerFixture):
+    failed = SimpleNamespace(returncode=1, stderr="some-error")
+    ok = SimpleNamespace(
+        returncode=0,
+        stdout=b"abc: Pushed\ndef: Layer already exists\nghi: Pushed\n",
+    )
+    sp = mocker.patch("sonar.builders.docker.subprocess")
+    sp.run.side_effect = [failed, ok]
+
+    pushes = metrics.PUSHES.get(status="success")
+    retries = metrics.PUSH_RETRIES.get()
+    pushed = metrics.PUSHED_LAYERS.get(result="pushed")
+    durations = metrics.PUSH_DURATION.count()
+
+    docker_push("reg", "tag")
+
+    assert metrics.PUSHES.get(status="success") == pushes + 1
+    assert metrics.PUSH_RETRIES.get() == retries + 1
+    assert metrics.PUSHED_LAYERS.get(result="pushed") == pushed + 2
+    assert metrics.PUSH_DURATION.count() == durations + 1
+
+
+def test_count_cached_steps():
+    output = b"#1 [internal] load build definition\n#5 CACHED\n#6 [2/3] RUN x\n#7 CACHED\n"
+    assert count_cached_steps(output) == 2
+
+
+def test_aws_api_calls_are_counted():
+    client = instrument_aws_client(
+        boto3.client(
+            "secretsmanager",
+            region_name="us-east-1",
+            aws_access_key_id="a",
+            aws_secret_access_key="b",
+        ),
+        "secretsmanager",
+    )
+    calls = metrics.AWS_API_CALLS.get(service="secretsmanager", operation="GetSecretValue")
+
+    with Stubber(client) as stubber:
+        stubber.add_response("get_secret_value", {"SecretString": "secret"})
+        client.get_secret_value(SecretId="some-secret")
+
+    assert (
+        metrics.AWS_API_CALLS.get(service="secretsmanager", operation="GetSecretValue")
+        == calls + 1
+    )
+
+
+def test_aws_connection_errors_release_the_limit():
+    client = instrument_aws_client(
+        boto3.client(
+            "secretsmanager",
+            region_name="us-east-1",
+            endpoint_url="http://127.0.0.1:1",
+            aws_access_key_id="a",
+            aws_secret_access_key="b",
+            config=Config(retries={"max_attempts": 0}, connect_timeout=1),
+        ),
+        "secretsmanager",
+    )
+    calls = metrics.AWS_API_CALLS.get(service="secretsmanager", operation="GetSecretValue")
+
+    with pytest.raises(EndpointConnectionError):
+        client.get_secret_value(SecretId="some-secret")
+
+    assert ratelimit.limiter("127.0.0.1:1").concurrency.in_flight == 0
+    assert (
+        metrics.AWS_API_CALLS.get(service="secretsmanager", operation="GetSecretValue")
+        == calls + 1
+    )
+
+
+def test_throttled_docker_pushes_are_not_retried(mocker: MockerFixture):
+    throttled = SimpleNamespace(returncode=1, stderr=b"toomanyrequests: rate limit reached")
+    sp = mocker.patch("sonar.builders.docker.subprocess")
+    sp.run.side_effect = [throttled]
+
+    # The caller retries them, once it lowered its limit of the registry.
+    with pytest.raises(SonarAPIError, match="toomanyrequests"):
+        docker_push("reg", "tag")
+    assert sp.run.call_count == 1
@@ -0,0 +1,323 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from sonar import registry as registry_api
+from sonar.builders.fake import FakeBackend
+from sonar.oci import BUILD_ID_ANNOTATION, add_metadata, build_image, collect_files, write_layout
+from sonar.registry import find_build_id, push_image, split_reference
+from sonar.sonar import process_image
+
+
+@pytest.fixture
+def context(tmp_path):
+    path = tmp_path / "context"
+    (path / "data" / "nested").mkdir(parents=True)
+    (path / "data" / "b.txt").write_text("b")
+    (path / "data" / "nested" / "a.txt").write_text("a")
+    (path / "script.sh").write_text("#!/bin/sh\n")
+    os.chmod(path / "script.sh", 0o775)
+    return path
+
+
+def layer_members(image):
+    with open(image.layers[0].path, "rb") as f:
+        data = gzip.decompress(f.read())
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return [(m.name, m.mode, m.mtime, m.uid) for m in tar.getmembers()]
+
+
+def test_collect_files(context):
+    files = collect_files(str(context), [("data", "/files"), ("script.sh", "/usr/bin/")])
+
+    assert [name for name, _ in files] == [
+        "/files/b.txt",
+        "/files/nested/a.txt",
+        "/usr/bin/script.sh",
+    ]
+
+    with pytest.raises(ValueError, match="missing"):
+        collect_files(str(context), [("missing", "/")])
+
+
+def test_images_are_reproducible(context):
+    static_files = [("data", "/files"), ("script.sh", "/usr/bin/")]
+    first = build_image(collect_files(str(context), static_files), labels={"a": "b"})
+
+    assert layer_members(first) == [
+        ("files", 0o755, 0, 0),
+        ("files/b.txt", 0o644, 0, 0),
+        ("files/nested", 0o755, 0, 0),
+        ("files/nested/a.txt", 0o644, 0, 0),
+        ("usr", 0o755, 0, 0),
+        ("usr/bin", 0o755, 0, 0),
+        ("usr/bin/script.sh", 0o755, 0, 0),
+    ]
+
+    os.utime(context / "data" / "b.txt", (1000, 1000))
+    second = build_image(collect_files(str(context), static_files), labels={"a": "b"})
+    assert second.digest == first.digest
+
+    (context / "data" / "b.txt").write_text("changed")
+    third = build_image(collect_files(str(context), static_files), labels={"a": "b"})
+    assert third.digest != first.digest
+
+    for image in (first, second, third):
+        image.cleanup()
+
+
+def test_write_layout(context, tmp_path):
+    image = build_image(collect_files(str(context), [("data", "/")]))
+    layout = tmp_path / "layout"
+
+    write_layout(image, str(layout), "v1")
+    write_layout(image, str(layout), "v2")
+    write_layout(image, str(layout), "v1")
+    image.cleanup()
+
+    index = json.loads((layout / "index.json").read_text())
+    assert [m["annotations"]["org.opencontainers.image.ref.name"] for m in index["manifests"]] == [
+        "v2",
+        "v1",
+    ]
+
+    manifest_path = layout / "blobs" / "sha256" / image.digest.split(":")[1]
+    manifest = json.loads(manifest_path.read_text())
+    for descriptor in manifest["layers"] + [manifest["config"]]:
+        blob = (layout / "blobs" / "sha256" / descriptor["digest"].split(":")[1]).read_bytes()
+        assert "sha256:" + hashlib.sha256(blob).hexdigest() == descriptor["digest"]
+
+
+def test_split_reference():
+    assert split_reference("quay.io/org/image") == ("quay.io", "org/image")
+    assert split_reference("localhost:5000/image") == ("localhost:5000", "image")
+    assert split_reference("ubuntu") == ("registry-1.docker.io", "library/ubuntu")
+    assert split_reference("org/image") == ("registry-1.docker.io", "org/image")
+
+
+class FakeRegistry(BaseHTTPRequestHandler):
+    """A registry asking for Bearer tokens, keeping blobs and manifests in memory."""
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, headers=None, body=b""):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        state = self.server.state
+        state["requests"].append((self.command, self.path.split("?")[0]))
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+
+        if self.path.startswith("/token"):
+            return self.reply(200, body=json.dumps({"token": "secret"}).encode())
+        if self.headers.get("Authorization") != "Bearer secret":
+            realm = "http://{}:{}/token".format(*self.server.server_address)
+            challenge = 'Bearer realm="{}",service="fake"'.format(realm)
+            return self.reply(401, {"WWW-Authenticate": challenge})
+
+        parts = self.path.split("?")[0].split("/")
+        if "blobs" in parts and parts[-1] != "":
+            digest = parts[-1]
+            if "uploads" in parts:
+                query = dict(p.split("=") for p in self.path.split("?")[1].split("&"))
+                state["blobs"][query["digest"].replace("%3A", ":")] = body
+                return self.reply(201)
+            if digest not in state["blobs"]:
+                return self.reply(404)
+            if "storage" in state and self.command == "GET":
+                return self.reply(307, {"Location": "{}/{}".format(state["storage"], digest)})
+            return self.reply(200, body=state["blobs"][digest] if self.command == "GET" else b"")
+        if "uploads" in parts:
+            return self.reply(202, {"Location": "/v2/repo/blobs/uploads/1"})
+        if "manifests" in parts:
+            if self.command == "PUT":
+                state["manifests"][parts[-1]] = body
+                return self.reply(201)
+            manifest = state["manifests"].get(parts[-1])
+            if manifest is None:
+                return self.reply(404)
+            digest = "sha256:" + hashlib.sha256(manifest).hexdigest()
+            body = manifest if self.command == "GET" else b""
+            return self.reply(200, {"Docker-Content-Digest": digest}, body)
+
+        return self.reply(404)
+
+    do_GET = do_HEAD = do_POST = do_PUT = handle_request
+
+
+class FakeStorage(BaseHTTPRequestHandler):
+    """Blob storage a registry redirects to, rejecting the registry's
+    credentials like S3 does for presigned URLs."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        state = self.server.state
+        if "Authorization" in self.headers:
+            self.send_response(400)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = state["blobs"][self.path.split("/")[-1]]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def registry():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeRegistry)
+    server.state = {"requests": [], "blobs": {}, "manifests": {}}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_push_through_the_registry_api(context, registry):
+    host = "127.0.0.1:{}".format(registry.server_address[1])
+    image = build_image(collect_files(str(context), [("data", "/")]))
+    no_credentials = lambda host: None
+
+    assert push_image(image, host + "/repo", "v1", no_credentials)
+    assert set(registry.state["blobs"]) == {b.digest for b in image.blobs}
+    assert registry.state["manifests"]["v1"] == image.manifest
+
+    # The same image is not pushed again, and its blobs are not uploaded
+    # again for a new tag.
+    registry.state["requests"].clear()
+    assert not push_image(image, host + "/repo", "v1", no_credentials)
+    assert push_image(image, host + "/repo", "v2", no_credentials)
+    assert ("POST", "/v2/repo/blobs/uploads/") not in registry.state["requests"]
+    image.cleanup()
+
+
+def test_blobs_are_fetched_from_redirects_without_credentials(registry):
+    storage = ThreadingHTTPServer(("127.0.0.1", 0), FakeStorage)
+    storage.state = registry.state
+    thread = threading.Thread(target=storage.serve_forever, daemon=True)
+    thread.start()
+
+    digest = "sha256:" + hashlib.sha256(b"blob").hexdigest()
+    registry.state["blobs"][digest] = b"blob"
+    registry.state["storage"] = "http://localhost:{}/bucket".format(storage.server_address[1])
+    host = "127.0.0.1:{}".format(registry.server_address[1])
+    try:
+        client = registry_api.RegistryClient(host, lambda host: None)
+        assert client.get_blob("repo", digest) == b"blob"
+    finally:
+        storage.shutdown()
+        storage.server_close()
+
+
+def test_metadata_is_added_to_docker_manifests():
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+        "config": {
+            "mediaType": "application/vnd.docker.container.image.v1+json",
+            "digest": "sha256:config",
+            "size": 2,
+        },
+        "layers": [
+            {
+                "mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+                "digest": "sha256:layer",
+                "size": 10,
+            }
+        ],
+    }
+
+    data, config = add_metadata(manifest, b"{}", "sha256:build", annotations={"version_id": "1"})
+    result = json.loads(data)
+    assert config is None
+    assert result["mediaType"] == "application/vnd.oci.image.manifest.v1+json"
+    assert result["config"]["digest"] == "sha256:config"
+    assert result["layers"][0]["mediaType"] == "application/vnd.oci.image.layer.v1.tar+gzip"
+    assert result["annotations"] == {"version_id": "1", BUILD_ID_ANNOTATION: "sha256:build"}
+
+    labelled = b'{"config": {"Labels": {"a": "b"}}}'
+    data, config = add_metadata(manifest, labelled, "sha256:build", {"c": "d"})
+    assert json.loads(config.data)["config"]["Labels"] == {"a": "b", "c": "d"}
+    assert json.loads(data)["config"]["digest"] == config.digest
+
+
+def test_metadata_is_added_through_the_registry_api(context, registry):
+    host = "127.0.0.1:{}".format(registry.server_address[1])
+    image = build_image(collect_files(str(context), [("data", "/")]))
+    no_credentials = lambda host: None
+    push_image(image, host + "/repo", "v1", no_credentials)
+    assert find_build_id(host + "/repo", "v1", no_credentials) is None
+
+    digest = registry_api.add_metadata(
+        host + "/repo", "v1", image.config.digest, {"version_id": "1"}, {"a": "b"}, no_credentials
+    )
+    assert find_build_id(host + "/repo", "v1", no_credentials) == (image.config.digest, digest)
+
+    manifest = json.loads(registry.state["manifests"]["v1"])
+    assert manifest["annotations"]["a"] == "b"
+    config = json.loads(registry.state["blobs"][manifest["config"]["digest"]])
+    assert config["config"]["Labels"] == {"version_id": "1"}
+    # The layers are not uploaded again.
+    assert [layer["digest"] for layer in manifest["layers"]] == [b.digest for b in image.layers]
+    image.cleanup()
+
+
+def test_context_image_stage(context, tmp_path):
+    backend = FakeBackend()
+    inventory = {
+        "images": [
+            {
+                "name": "image0",
+                "vars": {"context": str(context)},
+                "stages": [
+                    {
+                        "name": "context",
+                        "task_type": "context_image",
+                        "static_files": [{"src": "data", "dst": "/data"}],
+                        "output": [
+                            {"registry": "quay.io/org/context", "tag": "1.0"},
+                            {"oci_layout": str(tmp_path / "layout"), "tag": "1.0"},
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
+
+    def run():
+        return process_image(
+            "image0",
+            skip_tags=[],
+            include_tags=[],
+            inventory=inventory,
+            build_options={"pipeline": True, "backend": backend},
+        )
+
+    pipeline = run()
+    digest = pipeline["image0"]["context"]["image-digest"]
+    assert backend.registry["quay.io/org/context:1.0"].id == digest
+    assert (tmp_path / "layout" / "index.json").exists()
+
+    pipeline = run()
+    assert pipeline["image0"]["context"]["image-digest"] == digest
+    assert "docker-image-push/unchanged" in pipeline["image0"]["context"]
+    assert backend.counts["build"] == 0
@@ -0,0 +1,155 @@
+from unittest.mock import patch
+
+import pytest
+
+from sonar import ratelimit
+from sonar.plan import InventoryValidationError, Plan, compile_plan, run_plan
+from sonar.sonar import find_inventory, find_setting
+
+
+def test_compile_plan():
+    plan = compile_plan(
+        image_name="image0",
+        skip_tags=[],
+        include_tags=[],
+        build_args={"input0": "value0"},
+        inventory="test/yaml_scenario14.yaml",
+    )
+
+    assert plan.dag() == {"stage0": [], "stage1": ["stage0"]}
+    assert plan.stages[0].variables == {"registry": "somereg", "input0": "value0"}
+    assert plan.stages[0].targets == ["somereg/value0:$(inputs.params.version_id)"]
+    assert plan.stages[1].targets == ["somereg/other:latest"]
+
+    # Stage outputs and run values are resolved when the plan runs.
+    assert plan.stages[1].stage["source"]["tag"] == "$(stages['stage0'].outputs[0].tag)"
+
+
+def test_compile_plan_reports_every_error():
+    with pytest.raises(InventoryValidationError) as e:
+        compile_plan(
+            image_name="image1",
+            skip_tags=[],
+            include_tags=[],
+            inventory="test/yaml_scenario14.yaml",
+        )
+
+    assert e.value.errors == [
+        "stage stage0: no value for variable not_defined",
+        "stage stage0: unknown function not_a_function",
+        "stage stage1: reference to stage stage2 which does not run before",
+        "stage stage2: task_type not_a_task not supported",
+        "stage stage3: missing dockerfile",
+        "stage stage3: missing output",
+    ]
+
+
+def test_compile_plan_missing_input():
+    with pytest.raises(InventoryValidationError, match="input input0 has not been provided"):
+        compile_plan(
+            image_name="image0",
+            skip_tags=[],
+            include_tags=[],
+            inventory="test/yaml_scenario14.yaml",
+        )
+
+
+def test_compile_plan_only_includes_selected_stages():
+    plan = compile_plan(
+        image_name="image0-ubi",
+        skip_tags=["2.0"],
+        include_tags=[],
+        inventory="test/yaml_scenario13.yaml",
+    )
+    assert [s.name for s in plan.stages] == ["build-amd64-1.0"]
+
+
+@patch("sonar.sonar.create_ecr_repository")
+@patch("sonar.sonar.docker_pull", return_value="image")
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build", return_value="image")
+def test_run_serialized_plan(_docker_build, _docker_tag, _docker_push, _docker_pull, _create_ecr):
+    plan = compile_plan(
+        image_name="image0",
+        skip_tags=[],
+        include_tags=[],
+        build_args={"input0": "value0"},
+        inventory="test/yaml_scenario14.yaml",
+    )
+    plan = Plan.from_json(plan.to_json())
+
+    with patch("sonar.sonar.find_inventory") as patched_find_inventory:
+        output = run_plan(plan, build_options={"pipeline": True})
+
+    patched_find_inventory.assert_not_called()
+    assert _docker_push.call_args_list[0].args[0] == "somereg/value0"
+    _docker_pull.assert_called_once_with("somereg/value0", _docker_push.call_args_list[0].args[1])
+    assert output["image0"]["stage1"]["docker-image-push"] == "somereg/other:latest"
+
+
+def test_compile_plan_rejects_volatile_buildargs_used_by_the_dockerfile(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM scratch\nARG VERSION\nRUN echo $VERSION > /version\n")
+    inventory = {
+        "images": [
+            {
+                "name": "image0",
+                "vars": {"context": str(tmp_path)},
+                "stages": [
+                    {
+                        "name": "build",
+                        "task_type": "docker_build",
+                        "dockerfile": str(tmp_path / "Dockerfile"),
+                        "buildargs": {"VERSION": "$(inputs.params.version_id)"},
+                        "volatile_buildargs": ["VERSION"],
+                        "output": [{"registry": "registry/image", "tag": "latest"}],
+                    }
+                ],
+            }
+        ]
+    }
+
+    with pytest.raises(InventoryValidationError, match="VERSION is used by RUN at line 3"):
+        compile_plan("image0", [], [], inventory=inventory)
+
+
+def test_plans_keep_the_settings_of_the_inventory():
+    inventory = find_inventory("test/yaml_scenario14.yaml")
+    inventory["builders"] = [{"name": "a"}]
+    inventory["rate_limits"] = {"somereg": {"max_concurrency": 3}}
+    inventory["max_size_increase"] = 10
+    plan = compile_plan("image0", [], [], {"input0": "value0"}, inventory)
+    plan = Plan.from_json(plan.to_json())
+
+    try:
+        with patch("sonar.plan.run_image") as patched_run_image:
+            run_plan(plan)
+
+        ctx = patched_run_image.call_args.args[0]
+        assert [b.name for b in ctx.builders.builders] == ["a"]
+        assert find_setting(ctx, "max_size_increase") == 10
+        assert ratelimit.limiter("somereg").concurrency.max_concurrency == 3
+    finally:
+        ratelimit.reset()
+
+
+def test_compile_plan_reports_matrix_errors():
+    inventory = {
+        "images": [
+            {
+                "name": "image0",
+                "stages": [
+                    {"task_type": "tag_image", "matrix": {"distro": ["ubi", "ubuntu"]}},
+                    {"name": "build", "task_type": "docker_build", "matrix": {"arch": []}},
+                ],
+            }
+        ]
+    }
+
+    with pytest.raises(InventoryValidationError) as e:
+        compile_plan("image0", [], [], inventory=inventory)
+
+    assert e.value.errors == [
+        "stage without a name in image image0",
+        "stage build: matrix axis arch has no values",
+    ]
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+from sonar.builders.fake import FakeBackend
+from sonar.builders.pool import Builder, BuilderPool
+from sonar.sonar import process_images
+
+
+def test_builders_from_config():
+    assert Builder.from_config("remote=4") == Builder(name="remote", capacity=4)
+    assert Builder.from_config("tcp://builder:2376") == Builder(docker_host="tcp://builder:2376")
+    assert Builder.from_config({"name": "remote"}) == Builder(name="remote")
+
+    with pytest.raises(ValueError, match="either a name or a docker_host"):
+        Builder.from_config({"name": "remote", "docker_host": "tcp://builder:2376"})
+    with pytest.raises(ValueError, match="capacity"):
+        Builder.from_config("remote=0")
+    with pytest.raises(ValueError, match="more than once"):
+        BuilderPool.from_config(["remote", "remote=2"])
+
+
+def test_builds_go_to_the_least_loaded_builder():
+    pool = BuilderPool.from_config(["a=2", "b=1"])
+
+    with pool.acquire("x") as first, pool.acquire("y") as second:
+        assert (first.id, second.id) == ("a", "b")
+        with pool.acquire("z") as third:
+            assert third.id == "a"
+
+
+def test_builds_go_to_the_builder_that_built_the_image():
+    pool = BuilderPool.from_config(["a", "b"])
+    with pool.acquire("other"), pool.acquire("image") as builder:
+        assert builder.id == "b"
+
+    assert BuilderPool.from_config(["a", "b"]).choose("image").id == "b"
+    assert BuilderPool.from_config(["a", "b"], persist=False).choose("image").id == "a"
+
+    # A busy builder is not waited for.
+    with pool.acquire("other") as builder:
+        assert builder.id == "a"
+        with pool.acquire("other") as builder:
+            assert builder.id == "b"
+
+
+def test_builds_wait_for_a_free_builder():
+    pool = BuilderPool.from_config(["a"], persist=False)
+    running = []
+    most_running = []
+
+    def build():
+        with pool.acquire("image"):
+            running.append(1)
+            most_running.append(len(running))
+            time.sleep(0.01)
+            running.pop()
+
+    threads = [threading.Thread(target=build) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(most_running) == 1
+
+
+def test_images_are_built_in_the_pool(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM ubuntu:22.04\n")
+    inventory = {
+        "builders": [{"name": "a"}, {"docker_host": "tcp://b:2376"}],
+        "images": [
+            {
+                "name": "image{}".format(i),
+                "vars": {"context": str(tmp_path)},
+                "stages": [
+                    {
+                        "name": "build",
+                        "task_type": "docker_build",
+                        "dockerfile": str(tmp_path / "Dockerfile"),
+                        "output": [{"registry": "quay.io/org/image{}".format(i), "tag": "1.0"}],
+                    }
+                ],
+            }
+            for i in range(2)
+        ],
+    }
+
+    def builders():
+        backend = FakeBackend(latency={"build": 0.1})
+        pipeline = process_images(
+            ["image0", "image1"],
+            [],
+            [],
+            inventory=inventory,
+            build_options={"backend": backend, "pipeline": True},
+        )
+        assert {args[-1] for name, args in backend.calls if name == "build"} == {"a", "tcp://b:2376"}
+        return {name: pipeline[name]["build"]["docker-builder"] for name in pipeline}
+
+    first = builders()
+    assert builders() == first
@@ -0,0 +1,113 @@
+from unittest.mock import patch
+
+from sonar.prefetch import find_base_images, split_image
+from sonar.sonar import process_image
+
+
+def test_find_base_images():
+    dockerfile = """
+# syntax=docker/dockerfile:1
+ARG BASE=ubuntu
+ARG VERSION=22.04
+ARG REGISTRY
+FROM --platform=linux/amd64 ${BASE}:${VERSION} AS builder
+RUN make \\
+    all
+
+FROM builder AS tests
+FROM $REGISTRY/runtime:latest
+FROM scratch
+COPY --from=builder /out /out
+FROM ubuntu:22.04
+"""
+    assert find_base_images(dockerfile) == ["ubuntu:22.04"]
+    assert find_base_images(dockerfile, {"BASE": "debian", "REGISTRY": "quay.io"}) == [
+        "debian:22.04",
+        "quay.io/runtime:latest",
+        "ubuntu:22.04",
+    ]
+
+
+def test_split_image():
+    assert split_image("ubuntu") == ("ubuntu", "latest")
+    assert split_image("ubuntu:22.04") == ("ubuntu", "22.04")
+    assert split_image("localhost:5000/app") == ("localhost:5000/app", "latest")
+    assert split_image("localhost:5000/app:1") == ("localhost:5000/app", "1")
+    assert split_image("app@sha256:abc") == ("app", "sha256:abc")
+
+
+@patch("sonar.sonar.create_ecr_repository")
+@patch("sonar.sonar.save_dockerfile")
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_pull", side_effect=lambda repository, tag: repository + ":" + tag)
+def test_images_are_pulled_once_before_the_stages(
+    patched_docker_pull,
+    patched_docker_tag,
+    _docker_push,
+    _save_dockerfile,
+    _create_ecr_repository,
+    tmp_path,
+):
+    dockerfile = tmp_path / "Dockerfile"
+    dockerfile.write_text("FROM python:3.9-slim\nFROM busybox\n")
+
+    source = {"registry": "python", "tag": "3.9-slim"}
+    inventory = {
+        "images": [
+            {
+                "name": "image0",
+                "vars": {"context": ".", "template_context": "docker"},
+                "stages": [
+                    {
+                        "name": "template",
+                        "task_type": "dockerfile_template",
+                        "template_file_extensions": ["template"],
+                        "template_parameters": [
+                            {"from_base": "python:3.8-slim"},
+                            {"from_base": "python:3.9-slim"},
+                        ],
+                        "output": [{"dockerfile": "Dockerfile.out"}],
+                    },
+                    {
+                        "name": "build",
+                        "task_type": "docker_build",
+                        "dockerfile": str(dockerfile),
+                        "output": [{"registry": "registry", "tag": "tag"}],
+                    },
+                    {
+                        "name": "build-from-template",
+                        "task_type": "docker_build",
+                        "dockerfile": "$(stages['template'].outputs[0].dockerfile)",
+                        "output": [{"registry": "registry", "tag": "tag"}],
+                    },
+                    {
+                        "name": "tag",
+                        "task_type": "tag_image",
+                        "source": source,
+                        "destination": [{"registry": "dest", "tag": "tag"}],
+                    },
+                ],
+            }
+        ]
+    }
+
+    with patch("sonar.sonar.task_docker_build"):
+        pipeline = process_image(
+            "image0",
+            skip_tags=[],
+            include_tags=[],
+            inventory=inventory,
+            build_options={"pipeline": True, "prefetch": True},
+        )
+
+    pulled = sorted(c.args for c in patched_docker_pull.call_args_list)
+    assert pulled == [
+        ("busybox", "latest"),
+        ("python", "3.8-slim"),
+        ("python", "3.9-slim"),
+    ]
+    assert "prefetch python:3.9-slim" in pipeline["image0"]
+
+    # The tag_image stage uses the prefetched image.
+    assert patched_docker_tag.call_args.args == ("python:3.9-slim", "dest", "tag")
@@ -0,0 +1,119 @@
+import threading
+import time
+
+import pytest
+
+import sonar.sonar
+from sonar import ratelimit
+from sonar.builders.fake import FakeBackend
+from sonar.ratelimit import AdaptiveLimit, TokenBucket, is_throttled, limited
+from sonar.sonar import process_image
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(ratelimit, "DECREASE_INTERVAL", 0)
+    monkeypatch.setattr(sonar.sonar, "PUSH_RETRY_DELAY", 0)
+    ratelimit.reset()
+    yield
+    ratelimit.reset()
+
+
+def test_is_throttled():
+    assert is_throttled("toomanyrequests: You have reached your pull rate limit")
+    assert is_throttled("received unexpected HTTP status: 503 Service Unavailable")
+    assert is_throttled("An error occurred (ThrottlingException): Rate exceeded")
+    assert not is_throttled("denied: requested access to the resource is denied")
+    assert not is_throttled("sha256:ab500cd")
+    assert is_throttled("unexpected status code 429")
+    assert is_throttled("HTTP/1.1 502 Bad Gateway")
+    assert is_throttled("received 504 Gateway Timeout")
+    assert not is_throttled("error at line 500 of the Dockerfile")
+    assert not is_throttled("blob of 503 bytes is unknown")
+
+
+def test_token_buckets_wait():
+    bucket = TokenBucket(rate=20, burst=2)
+    start = time.monotonic()
+    for _ in range(4):
+        bucket.wait()
+
+    # Two tokens in the burst, and two more at 20 per second.
+    assert 0.09 < time.monotonic() - start < 0.5
+
+
+def test_concurrency_is_increased_additively_and_decreased_multiplicatively():
+    limit = AdaptiveLimit("registry", min_concurrency=1, max_concurrency=8)
+    assert limit.limit == 8
+
+    limit.acquire()
+    limit.release(throttled=True)
+    limit.acquire()
+    limit.release(throttled=True)
+    assert limit.limit == 2
+
+    for _ in range(4):
+        limit.acquire()
+        limit.release(throttled=False)
+    assert int(limit.limit) == 3
+
+    # Other failures do not change the limit.
+    limit.acquire()
+    limit.release(throttled=None)
+    assert int(limit.limit) == 3
+    assert ratelimit.CONCURRENCY_LIMIT.get(host="registry") == 3
+
+
+def test_calls_wait_for_the_concurrency_limit():
+    ratelimit.configure({"registry": {"max_concurrency": 2}})
+    running = []
+    most_running = []
+
+    def call():
+        with limited("registry", "push"):
+            running.append(1)
+            most_running.append(len(running))
+            time.sleep(0.01)
+            running.pop()
+
+    threads = [threading.Thread(target=call) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(most_running) == 2
+
+    with pytest.raises(ValueError, match="unknown rate limits"):
+        ratelimit.configure({"registry": {"concurrency": 2}})
+
+
+def test_throttled_pushes_lower_the_limit(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM scratch\n")
+    inventory = {
+        "rate_limits": {"quay.io": {"max_concurrency": 4}},
+        "images": [
+            {
+                "name": "image0",
+                "vars": {"context": str(tmp_path)},
+                "stages": [
+                    {
+                        "name": "build",
+                        "task_type": "docker_build",
+                        "dockerfile": str(tmp_path / "Dockerfile"),
+                        "output": [
+                            {"registry": "quay.io/org/image0", "tag": str(i)} for i in range(3)
+                        ],
+                    }
+                ],
+            }
+        ],
+    }
+    backend = FakeBackend(rate_limits={"push": 0.01})
+
+    process_image("image0", [], [], inventory=inventory, build_options={"backend": backend})
+
+    assert ratelimit.limiter("quay.io").concurrency.limit == 1
+    assert ratelimit.THROTTLED_CALLS.get(host="quay.io", operation="push") >= 2
+    # The first push is allowed, and the other two are retried until they give up.
+    assert backend.counts["push"] == 1 + 2 * (sonar.sonar.THROTTLED_PUSH_RETRIES + 1)
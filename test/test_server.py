@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.request
+from unittest.mock import patch
+
+import pytest
+
+from sonar import ratelimit
+from sonar.server import InventoryCache, Server, make_server
+
+
+@pytest.fixture()
+def server():
+    # The server pools AWS clients for the whole process.
+    with patch("sonar.sonar.CLIENT_POOL", None):
+        httpd = make_server(Server(max_concurrency=2), port=0)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+
+        yield "http://127.0.0.1:{}".format(httpd.server_address[1])
+
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def post_build(url: str, request: dict):
+    req = urllib.request.Request(
+        url + "/build",
+        data=json.dumps(request).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req) as response:
+        return [json.loads(line) for line in response]
+
+
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build")
+def test_build_streams_messages(_docker_build, _docker_tag, _docker_push, server):
+    request = {
+        "image": "image1",
+        "inventory": "test/yaml_scenario6.yaml",
+        "include_tags": "test_continue_on_errors",
+        "options": {"pipeline": True},
+    }
+    messages = post_build(server, request)
+
+    assert messages[0]["type"] == "image_start"
+    pushes = [m for m in messages if m.get("type") == "push_result"]
+    assert [m["stage"] for m in pushes] == ["stage0", "stage1", "stage2"]
+
+    assert messages[-1]["result"] == "success"
+    assert messages[-1]["output"]["image1"]["stage2"]["docker-image-push"] == "some-registry:something"
+    assert _docker_push.call_count == 3
+
+    # A second build reuses the parsed inventory.
+    with patch("sonar.server.find_inventory") as patched_find_inventory:
+        messages = post_build(server, request)
+
+    patched_find_inventory.assert_not_called()
+    assert messages[-1]["result"] == "success"
+
+
+def test_build_reports_errors(server):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post_build(server, {"image": "image1", "inventory": "test/not-found.yaml"})
+    assert e.value.code == 400
+
+    messages = post_build(
+        server, {"image": "image1", "inventory": "test/yaml_scenario14.yaml"}
+    )
+    assert messages[-1]["result"] == "failure"
+
+
+def test_build_rejects_bad_requests(server, tmp_path):
+    (tmp_path / "broken.yaml").write_text("images: [\n")
+    requests = [
+        {"image": "image1", "inventory": str(tmp_path / "broken.yaml")},
+        {"image": "image1", "inventory": "test/yaml_scenario6.yaml", "options": {"workspace_dir": "/"}},
+        {"image": "image1", "inventory": "test/yaml_scenario6.yaml", "options": {"backend": None}},
+        {"image": "image1", "inventory": "test/yaml_scenario6.yaml", "options": {"pipeline": "yes"}},
+    ]
+
+    for request in requests:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            post_build(server, request)
+        assert e.value.code == 400
+
+
+def test_inventory_cache_reloads_changed_inventories(tmp_path):
+    path = str(tmp_path / "inventory.yaml")
+    shutil.copyfile("test/yaml_scenario6.yaml", path)
+
+    cache = InventoryCache()
+    inventory = cache.get(path)
+    assert cache.get(path) is inventory
+    assert [image["name"] for image in inventory["images"]] == ["image0", "image1"]
+
+    shutil.copyfile("test/yaml_scenario0.yaml", path)
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 1_000_000))
+
+    inventory = cache.get(path)
+    assert [image["name"] for image in inventory["images"]] == ["image0"]
+
+
+def test_builds_use_the_settings_of_the_inventory(tmp_path):
+    path = tmp_path / "inventory.yaml"
+    path.write_text(
+        "builders:\n  - name: a\n"
+        "rate_limits:\n  quay.io:\n    max_concurrency: 3\n"
+        "images:\n  - name: image0\n    stages: []\n"
+    )
+
+    try:
+        with patch("sonar.sonar.CLIENT_POOL", None):
+            ctx = Server().build_context({"image": "image0", "inventory": str(path)})
+
+        assert [b.name for b in ctx.builders.builders] == ["a"]
+        assert ratelimit.limiter("quay.io").concurrency.max_concurrency == 3
+    finally:
+        ratelimit.reset()
@@ -0,0 +1,144 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from sonar import history, shard
+from sonar.shard import merge_outputs, parse_shard, split_shards, write_partial_output
+from sonar.sonar import find_image_names, find_shards
+
+
+def test_parse_shard():
+    assert parse_shard("2/4") == (2, 4)
+
+    for value in ("0/4", "5/4", "1/0", "a/b", "1"):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_connected_images_go_to_the_same_shard():
+    dependencies = {
+        "base": [],
+        "server": ["base"],
+        "tools": [],
+        "docs": [],
+        "bundle": ["tools"],
+    }
+    costs = {"base": 3, "server": 3, "tools": 1, "docs": 4, "bundle": 1}
+
+    assert split_shards(dependencies, costs, 2) == [["base", "server"], ["tools", "docs", "bundle"]]
+    assert split_shards(dependencies, costs, 3) == [["base", "server"], ["docs"], ["tools", "bundle"]]
+    assert split_shards(dependencies, costs, 6)[3:] == [[], [], []]
+
+
+@pytest.fixture
+def inventory(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM quay.io/org/image0:1.0\n")
+
+    def image(i, weight):
+        return {
+            "name": "image{}".format(i),
+            "weight": weight,
+            "vars": {"context": str(tmp_path)},
+            "stages": [
+                {
+                    "name": "build",
+                    "task_type": "docker_build",
+                    "dockerfile": str(tmp_path / "Dockerfile"),
+                    "output": [{"registry": "quay.io/org/image{}".format(i), "tag": "1.0"}],
+                }
+            ],
+        }
+
+    return {
+        "images": [image(0, 1), image(1, 5), image(2, 1), image(3, 1)]
+        + [{"name": "tests", "matrix": {"distro": ["ubi", "ubuntu"]}, "stages": []}]
+    }
+
+
+def test_every_image_is_in_one_shard(inventory):
+    names = find_image_names(inventory)
+    assert names == ["image0", "image1", "image2", "image3", "tests-ubi", "tests-ubuntu"]
+
+    shards = find_shards(names, 3, [], [], inventory=inventory)
+
+    # Everything builds FROM image0, so they are all in one shard.
+    assert shards == [["image0", "image1", "image2", "image3"], ["tests-ubi"], ["tests-ubuntu"]]
+
+
+def test_partial_outputs_are_merged(tmp_path, capsys):
+    for i in (1, 2):
+        write_partial_output(
+            str(tmp_path / "{}.json".format(i)),
+            (i, 2),
+            ["image{}".format(i)],
+            {"image{}".format(i): {"build": {"docker-image-push": "image{}:1.0".format(i)}}},
+            ["image1", "image2"],
+            [["image1"], ["image2"]],
+        )
+
+    assert shard.main([str(tmp_path / "2.json"), str(tmp_path / "1.json")]) == 0
+    assert json.loads(capsys.readouterr().out) == {
+        "image1": {"build": {"docker-image-push": "image1:1.0"}},
+        "image2": {"build": {"docker-image-push": "image2:1.0"}},
+    }
+
+    assert shard.main([str(tmp_path / "1.json")]) == 1
+    assert "missing the outputs of shards [2]" in capsys.readouterr().err
+
+    with pytest.raises(ValueError, match="more than once"):
+        merge_outputs([{"shard": "1/1", "output": {}}, {"shard": "1/1", "output": {}}])
+
+
+def partial(index, images, shards, selected=("image1", "image2", "image3")):
+    return {
+        "shard": "{}/{}".format(index, len(shards)),
+        "images": images,
+        "selected": list(selected),
+        "shards": shards,
+        "output": {},
+    }
+
+
+def test_partial_outputs_from_different_splits_are_not_merged():
+    # Each runner split the images with its own history.
+    with pytest.raises(ValueError, match="split the images differently"):
+        merge_outputs(
+            [
+                partial(1, ["image1"], [["image1"], ["image2", "image3"]]),
+                partial(2, ["image1", "image2"], [["image3"], ["image1", "image2"]]),
+            ]
+        )
+
+    with pytest.raises(ValueError, match=r"images \['image3'\] are in no shard"):
+        merge_outputs(
+            [
+                partial(1, ["image1"], [["image1"], ["image2"]]),
+                partial(2, ["image2"], [["image1"], ["image2"]]),
+            ]
+        )
+
+    with pytest.raises(ValueError, match="selected different images"):
+        merge_outputs(
+            [
+                partial(1, ["image1"], [["image1"], ["image2"]], ["image1", "image2"]),
+                partial(2, ["image2"], [["image1"], ["image2"]]),
+            ]
+        )
+
+
+def test_history_is_only_used_when_every_image_has_one(inventory, monkeypatch):
+    names = ["image1", "image2", "image3", "tests-ubi"]
+    estimates = {"image1": 100.0, "image2": 1.0, "image3": 1.0}
+    monkeypatch.setattr(
+        history, "get_history", lambda: SimpleNamespace(estimate_image=estimates.get)
+    )
+
+    # tests-ubi has no history, so every image is split by weight.
+    assert find_shards(names, 2, [], [], inventory=inventory, use_history=True) == (
+        find_shards(names, 2, [], [], inventory=inventory)
+    )
+
+    estimates["tests-ubi"] = 100.0
+    shards = find_shards(names, 2, [], [], inventory=inventory, use_history=True)
+    assert shards == [["image1", "image2"], ["image3", "tests-ubi"]]
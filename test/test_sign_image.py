@@ -1,4 +1,5 @@
-from sonar.sonar import process_image, is_signing_enabled
+from sonar.builders import SonarAPIError
+from sonar.sonar import SIGNING_LOCK, process_image, is_signing_enabled
 
 import pytest
 import os
@@ -152,3 +153,32 @@ def test_sign_image(
         call("foo3", "evergreen_ci_foo"),
     ]
     patched_get_private_key_id.assert_has_calls(private_key_calls)
+
+
+@patch("sonar.sonar.get_secret", side_effect=SonarAPIError("secret not found"))
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build")
+@patch("sonar.sonar.urlretrieve")
+@patch("sonar.sonar.create_ecr_repository")
+def test_failed_signing_releases_the_lock(
+    patched_create_ecr_repository,
+    patched_urlretrive,
+    patched_docker_build,
+    patched_docker_tag,
+    patched_docker_push,
+    patched_get_secret,
+    ys7,
+):
+    with patch("builtins.open", mock_open(read_data=ys7)):
+        with pytest.raises(SonarAPIError, match="secret not found"):
+            process_image(
+                image_name="image0",
+                skip_tags=[],
+                include_tags=[],
+                build_args={},
+                build_options={"continue_on_errors": False},
+            )
+
+    assert not SIGNING_LOCK.locked()
+    patched_docker_push.assert_not_called()
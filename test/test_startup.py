@@ -0,0 +1,60 @@
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+# Modules that should only be imported by the tasks using them.
+HEAVY_MODULES = ("boto3", "botocore", "click", "docker", "jinja2", "yaml")
+
+# Cumulative time, in microseconds, that importing what sonar.py needs can take.
+STARTUP_BUDGET_US = 250_000
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """Returns the cumulative import time of every module imported by
+    `import module`, as reported by `python -X importtime`."""
+    return run_import_times(["-c", "import {}".format(module)])
+
+
+def run_import_times(arguments: List[str]) -> Dict[str, int]:
+    """Returns the cumulative import time of every module imported by
+    `python arguments`, as reported by `python -X importtime`."""
+    cp = subprocess.run(
+        [sys.executable, "-X", "importtime"] + arguments,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=Path(__file__).parent.parent,
+        universal_newlines=True,
+        check=True,
+    )
+
+    times = {}
+    for line in cp.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line.partition(":")[2].split("|")
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+def test_heavy_modules_are_not_imported_on_startup():
+    times = import_times("sonar.plan")
+
+    assert [m for m in HEAVY_MODULES if m in times] == []
+
+
+def test_startup_budget():
+    times = import_times("sonar.plan")
+
+    assert times["sonar.plan"] < STARTUP_BUDGET_US
+
+
+def test_cli_only_imports_what_the_command_needs():
+    times = run_import_times(["sonar.py", "--help"])
+
+    assert [m for m in HEAVY_MODULES if m in times] == []
+    # The builds, plans and analyses are only imported to run them.
+    assert [m for m in ("sonar.sonar", "sonar.plan", "sonar.analyze") if m in times] == []
+    assert sum(t for m, t in times.items() if m.startswith("sonar")) < STARTUP_BUDGET_US
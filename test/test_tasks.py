@@ -0,0 +1,103 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+from sonar import tasks
+from sonar.plan import InventoryValidationError, compile_plan
+from sonar.sonar import process_image
+from sonar.tasks import TaskSpec, get_task
+
+COPIED = []
+
+
+def registry_copy(ctx):
+    COPIED.append(ctx.I(ctx.stage["source"]))
+
+
+REGISTRY_COPY = TaskSpec(
+    "registry_copy",
+    "test.test_tasks:registry_copy",
+    required_keys=("source",),
+    resources={"network": 1},
+)
+
+
+def inventory(task_type, **stage):
+    return {
+        "vars": {"registry": "quay.io"},
+        "images": [
+            {
+                "name": "image0",
+                "stages": [dict(stage, name="stage0", task_type=task_type)],
+            }
+        ],
+    }
+
+
+@pytest.fixture
+def entry_points(monkeypatch):
+    monkeypatch.setattr(tasks, "TASKS", dict(tasks.TASKS))
+
+    found = {}
+    patched = Mock(side_effect=lambda name: found.get(name, []))
+    monkeypatch.setattr(tasks, "find_entry_points", patched)
+    return found
+
+
+def entry_point(value, loaded):
+    return Mock(value=value, load=Mock(return_value=loaded))
+
+
+def test_builtin_tasks_do_not_load_plugins(entry_points):
+    for task_type in ("dockerfile_create", "dockerfile_template", "docker_build", "tag_image"):
+        assert get_task(task_type).target == "sonar.sonar:task_{}".format(task_type)
+
+    tasks.find_entry_points.assert_not_called()
+
+
+def test_plugins_are_loaded_when_their_stages_run(entry_points):
+    plugin = entry_point("test.test_tasks:REGISTRY_COPY", REGISTRY_COPY)
+    entry_points["registry_copy"] = [plugin]
+    COPIED.clear()
+
+    process_image(
+        "image0",
+        skip_tags=[],
+        include_tags=[],
+        inventory=inventory("registry_copy", source="$(inputs.params.registry)/image"),
+    )
+    process_image(
+        "image0",
+        skip_tags=[],
+        include_tags=[],
+        inventory=inventory("registry_copy", source="$(inputs.params.registry)/image"),
+    )
+
+    assert COPIED == ["quay.io/image", "quay.io/image"]
+    plugin.load.assert_called_once()
+
+
+def test_plugin_functions_are_tasks(entry_points):
+    entry_points["copy"] = [entry_point("test.test_tasks:registry_copy", registry_copy)]
+
+    spec = get_task("copy")
+
+    assert spec == TaskSpec("copy", "test.test_tasks:registry_copy")
+
+
+def test_plugins_are_validated_in_plans(entry_points):
+    entry_points["registry_copy"] = [entry_point("test.test_tasks:REGISTRY_COPY", REGISTRY_COPY)]
+
+    plan = compile_plan("image0", [], [], inventory=inventory("registry_copy", source="a"))
+    assert plan.stages[0].resources == {"network": 1}
+
+    with pytest.raises(InventoryValidationError, match="missing source"):
+        compile_plan("image0", [], [], inventory=inventory("registry_copy"))
+
+    with pytest.raises(InventoryValidationError, match="task_type sbom not supported"):
+        compile_plan("image0", [], [], inventory=inventory("sbom"))
+
+
+def test_unknown_task_types_fail(entry_points):
+    with pytest.raises(NotImplementedError, match="task_type sbom not supported"):
+        process_image("image0", skip_tags=[], include_tags=[], inventory=inventory("sbom"))
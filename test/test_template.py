@@ -15,3 +15,34 @@ def test_key_error_is_not_raised_on_empty_inputs(patched_render: Mock):
         inventory="test/yaml_scenario10.yaml",
     )
     patched_render.assert_called()
+
+
+@patch("sonar.sonar.save_dockerfile")
+def test_template_variants_are_rendered_in_one_stage(patched_save_dockerfile: Mock):
+    # Rendered Dockerfiles are removed with the workspace of the run, so they
+    # are read when they are saved.
+    rendered = []
+    patched_save_dockerfile.side_effect = lambda path, *args: rendered.append(open(path).read())
+
+    pipeline = process_image(
+        image_name="image0",
+        skip_tags=[],
+        include_tags=[],
+        build_args={},
+        build_options={"pipeline": True},
+        inventory="test/yaml_scenario12.yaml",
+    )
+
+    destinations = [c.args[1] for c in patched_save_dockerfile.call_args_list]
+    assert destinations == [
+        "Dockerfile.template-0",
+        "Dockerfile.template-1",
+        "Dockerfile.3.10rc-2",
+        "Dockerfile.3.10rc-3",
+    ]
+    # The pipeline keeps the output of the last variant.
+    stage = pipeline["image0"]["template-variants"]
+    assert stage["dockerfile-save-location"] == "Dockerfile.3.10rc-3"
+
+    assert rendered[0].startswith("FROM python:3.8-slim")
+    assert rendered[1].startswith("FROM python:3.9-slim")
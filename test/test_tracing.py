@@ -0,0 +1,105 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+
+from sonar import tracing
+from sonar.sonar import process_image
+
+TRACEPARENT = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+def read_spans(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@patch("sonar.sonar.docker_push")
+@patch("sonar.sonar.docker_tag")
+@patch("sonar.sonar.docker_build")
+def test_spans_are_nested(_docker_build, _docker_tag, _docker_push, tmp_path, monkeypatch):
+    path = str(tmp_path / "spans.jsonl")
+    monkeypatch.setattr(tracing, "EXPORTERS", [tracing.JSONFileExporter(path)])
+    monkeypatch.setenv("TRACEPARENT", TRACEPARENT)
+
+    process_image(
+        image_name="image1",
+        skip_tags=[],
+        include_tags=["test_continue_on_errors"],
+        build_args={},
+        inventory="test/yaml_scenario6.yaml",
+    )
+
+    spans = read_spans(path)
+    assert [s["name"] for s in spans] == ["task_docker_build"] * 3 + ["process_image"]
+    assert all(s["trace_id"] == "0af7651916cd43dd8448eb211c80319c" for s in spans)
+
+    root = spans[-1]
+    assert root["parent_id"] == "b7ad6b7169203331"
+    assert root["attributes"] == {"image": "image1"}
+    assert all(s["parent_id"] == root["span_id"] for s in spans[:-1])
+    assert [s["attributes"]["stage"] for s in spans[:-1]] == ["stage0", "stage1", "stage2"]
+
+
+def test_failed_spans_record_the_error(tmp_path, monkeypatch):
+    path = str(tmp_path / "spans.jsonl")
+    monkeypatch.setattr(tracing, "EXPORTERS", [tracing.JSONFileExporter(path)])
+    monkeypatch.delenv("TRACEPARENT", raising=False)
+
+    try:
+        with tracing.span("outer"):
+            with tracing.span("inner", registry="reg"):
+                raise ValueError("some error")
+    except ValueError:
+        pass
+
+    inner, outer = read_spans(path)
+    assert inner["error"] == "ValueError: some error"
+    assert inner["parent_id"] == outer["span_id"]
+    assert outer["parent_id"] is None
+    assert tracing.current_span.get() is None
+
+
+def test_spans_are_not_recorded_without_exporters(monkeypatch):
+    monkeypatch.setattr(tracing, "EXPORTERS", [])
+
+    with tracing.span("something") as span:
+        assert span is None
+
+
+def test_otlp_exporter(monkeypatch):
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            received.append((self.path, json.loads(self.rfile.read(length))))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    exporter = tracing.OTLPExporter(
+        "http://127.0.0.1:{}/v1/traces".format(server.server_address[1]), batch_size=2
+    )
+    monkeypatch.setattr(tracing, "EXPORTERS", [exporter])
+
+    with tracing.span("first"):
+        pass
+    assert received == []
+
+    with tracing.span("second", tag="latest"):
+        pass
+
+    server.shutdown()
+    server.server_close()
+
+    path, payload = received[0]
+    assert path == "/v1/traces"
+    spans = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert [s["name"] for s in spans] == ["first", "second"]
+    assert spans[1]["attributes"] == [{"key": "tag", "value": {"stringValue": "latest"}}]
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import subprocess
+
+import pytest
+
+from sonar.builders.fake import FakeBackend
+from sonar.sonar import Context, process_image
+from sonar.workspace import Workspace
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    workspace = Workspace(str(tmp_path / "workspaces"))
+    yield workspace
+    workspace.close()
+
+
+def test_workspace_is_created_in_the_workspace_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("SONAR_WORKSPACE_DIR", str(tmp_path / "shm"))
+    workspace = Workspace()
+
+    assert os.path.dirname(workspace.directory) == str(tmp_path / "shm")
+    path = workspace.mkstemp()
+    assert os.path.dirname(path) == workspace.directory
+
+    workspace.close()
+    assert not os.path.exists(workspace.directory)
+
+
+def test_function_results_are_memoized(workspace, tmp_path):
+    assert workspace.call("tempfile") != workspace.call("tempfile")
+    assert workspace.call("tempfile", "cache") == workspace.call("tempfile", "cache")
+    assert workspace.call("tempfile", "cache") != workspace.call("tempfile", "other")
+
+    (tmp_path / "requirements.txt").write_text("requests\n")
+    path = str(tmp_path / "requirements.txt")
+    assert workspace.call("file_hash", path) == hashlib.sha256(b"requests\n").hexdigest()
+    # The file changing during the run does not change its hash.
+    (tmp_path / "requirements.txt").write_text("requests==2.0\n")
+    assert workspace.call("file_hash", path) == hashlib.sha256(b"requests\n").hexdigest()
+
+    assert workspace.call("timestamp") == workspace.call("timestamp")
+    assert len(workspace.call("timestamp", "%Y")) == 4
+
+    with pytest.raises(ValueError, match="Unknown function not_a_function"):
+        workspace.call("not_a_function")
+    with pytest.raises(ValueError, match="file_hash"):
+        workspace.call("file_hash", str(tmp_path / "missing"))
+
+
+def test_git_sha(workspace, tmp_path):
+    repo = str(tmp_path / "repo")
+    try:
+        subprocess.run(["git", "init", "-q", repo], check=True)
+        subprocess.run(
+            ["git", "-C", repo, "-c", "user.name=sonar", "-c", "user.email=sonar@example.com",
+             "commit", "-q", "--allow-empty", "-m", "initial"],
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("git is not available")
+
+    sha = workspace.call("git_sha", repo)
+    assert len(sha) == 40
+    assert workspace.call("git_sha", repo) == sha
+
+    with pytest.raises(ValueError, match="git_sha"):
+        workspace.call("git_sha", str(tmp_path))
+
+
+def test_functions_are_interpolated_with_arguments(workspace):
+    ctx = Context(inventory={}, image="image0", parameters=[], workspace=workspace)
+
+    string = ctx.I("$(functions.tempfile('cache')) $(functions.timestamp(%Y))")
+    path, year = string.split(" ")
+    assert path == workspace.call("tempfile", "cache")
+    assert year == workspace.call("timestamp", "%Y")
+
+
+def test_workspace_is_removed_when_the_run_ends(tmp_path):
+    backend = FakeBackend()
+    inventory = {
+        "images": [
+            {
+                "name": "image0",
+                "vars": {"context": "."},
+                "stages": [
+                    {
+                        "name": "build{}".format(i),
+                        "task_type": "docker_build",
+                        "dockerfile": "Dockerfile",
+                        "buildargs": {
+                            "BUILT": "$(functions.timestamp)",
+                            "CACHE": "$(functions.tempfile(cache))",
+                        },
+                        "output": [{"registry": "registry/image", "tag": str(i)}],
+                    }
+                    for i in range(2)
+                ],
+            }
+        ]
+    }
+
+    process_image(
+        "image0",
+        skip_tags=[],
+        include_tags=[],
+        inventory=inventory,
+        build_options={"backend": backend, "workspace_dir": str(tmp_path)},
+    )
+
+    # Every stage sees the same values.
+    buildargs = [args[2] for name, args in backend.calls if name == "build"]
+    assert len(buildargs) == 2
+    assert buildargs[0] == buildargs[1]
+    assert os.path.dirname(buildargs[0]["CACHE"]).startswith(str(tmp_path))
+
+    assert os.listdir(str(tmp_path)) == []